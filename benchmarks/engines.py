@@ -0,0 +1,134 @@
+"""
+Compares the files per second downloaded by the thread and asyncio
+engines from a local server, e.g.::
+
+    python benchmarks/engines.py --files 5000 --latency 0.05
+
+The server is a minimal HTTP/1.1 server with keep-alive, run in a process
+of its own, serving ``--files`` files of ``--size`` bytes and answering
+each request after ``--latency`` seconds to stand in for the round trip
+to a remote server.  Each engine downloads every file into a temporary
+directory, with the sizes known up front unless ``--probe`` is given, in
+which case the HEAD requests are part of the run.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from wgot.aio import AsyncHandler  # noqa: E402
+from wgot.fileinfo import FileInfo  # noqa: E402
+from wgot.handler import Handler  # noqa: E402
+
+
+def serve(port, size, latency, ready):
+    body = b'x' * size
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) not in (b'\r\n', b''):
+                    pass
+                if latency:
+                    await asyncio.sleep(latency)
+                method = request_line.split(b' ', 1)[0]
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n'
+                             b'Content-Type: application/octet-stream\r\n'
+                             b'\r\n' % size)
+                if method != b'HEAD':
+                    writer.write(body)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, '127.0.0.1', port,
+                                            backlog=4096)
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def run(handler_class, num_threads, urls, size, probe):
+    dest_dir = tempfile.mkdtemp()
+    try:
+        files = [FileInfo(url,
+                          dest=os.path.join(dest_dir, url.rsplit('/')[-1]),
+                          size=None if probe else size) for url in urls]
+        kwargs = {}
+        if num_threads is not None:
+            kwargs = {'num_threads': num_threads,
+                      'num_probe_threads': num_threads}
+        handler = handler_class({'quiet': True}, **kwargs)
+        start_time = time.time()
+        result = handler.call(files)
+        elapsed = time.time() - start_time
+        num_downloaded = len(os.listdir(dest_dir))
+    finally:
+        shutil.rmtree(dest_dir)
+    stats = handler.connection_stats()
+    return (elapsed, num_downloaded, result.num_tasks_failed,
+            stats.num_connections, handler.executor.num_threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=16 * 1024)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--port', type=int, default=8799)
+    parser.add_argument('--probe', action='store_true',
+                        help="Leave the sizes to be found by HEAD requests.")
+    parser.add_argument('--threads', type=int, action='append',
+                        metavar='N', help="Run the thread engine with N "
+                        "threads, may be given more than once.  The default "
+                        "is the number of threads of the engine.")
+    parser.add_argument('--asyncio', type=int, action='append',
+                        metavar='N', help="Run the asyncio engine with N "
+                        "downloads at once, may be given more than once.")
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=serve, args=(args.port, args.size, args.latency, ready))
+    server.daemon = True
+    server.start()
+    ready.wait()
+    urls = ['http://127.0.0.1:%s/f%06d' % (args.port, i)
+            for i in range(args.files)]
+    runs = [('threads', Handler, n) for n in args.threads or [None]] + \
+        [('asyncio', AsyncHandler, n) for n in args.asyncio or [None]]
+    print("%s files of %s bytes, %.0f ms latency%s" % (
+        args.files, args.size, args.latency * 1000,
+        ', probed' if args.probe else ''))
+    print("%-8s %6s %10s %10s %7s %12s" % (
+        'engine', 'conc', 'seconds', 'files/s', 'failed', 'connections'))
+    try:
+        for name, handler_class, num_threads in runs:
+            elapsed, num_downloaded, num_failed, num_connections, \
+                concurrency = run(handler_class, num_threads, urls,
+                                  args.size, args.probe)
+            if num_downloaded != args.files:
+                num_failed = max(num_failed, args.files - num_downloaded)
+            print("%-8s %6s %10.2f %10.1f %7s %12s" % (
+                name, concurrency, elapsed, args.files / elapsed,
+                num_failed, num_connections))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+Compares the requests, connections and time taken to download a large
+file in parts over https with the HTTP/2 transport of ``--http2`` and
+with the pooled HTTP/1.1 one, from a local server, e.g.::
+
+    python benchmarks/http2.py --size 256 --latency 0 --latency 0.1
+
+The server is hypercorn, which negotiates either protocol, with a
+certificate made by openssl for the run.  ``--latency`` is a round trip
+time: a proxy in front of the server holds whatever is sent either way
+for half of it, so that opening a connection and its TLS handshake take
+round trips as they would over a network, as does each request.  Both
+transports download the file of ``--size`` MiB into a temporary
+directory with ``--threads`` threads, as range requests of
+``--chunksize`` KiB each, and check its md5.  A download that fails, or
+whose data does not match, is counted in the failed column.
+"""
+import argparse
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from wgot.fileinfo import FileInfo  # noqa: E402
+from wgot.handler import Handler  # noqa: E402
+
+
+def make_certificate(dirname):
+    certfile = os.path.join(dirname, 'cert.pem')
+    keyfile = os.path.join(dirname, 'key.pem')
+    subprocess.check_call(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+         '-keyout', keyfile, '-out', certfile, '-days', '1',
+         '-subj', '/CN=localhost',
+         '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+async def pipe(reader, writer, delay):
+    # Forwards what is read after ``delay``, in order, without holding up
+    # the reads in the meantime.
+    chunks = asyncio.Queue()
+
+    async def forward():
+        while True:
+            due, data = await chunks.get()
+            if data is None:
+                break
+            await asyncio.sleep(due - time.monotonic())
+            writer.write(data)
+            await writer.drain()
+
+    forwarding = asyncio.ensure_future(forward())
+    try:
+        while True:
+            data = await reader.read(65536)
+            chunks.put_nowait((time.monotonic() + delay, data or None))
+            if not data:
+                break
+        await forwarding
+    except ConnectionError:
+        forwarding.cancel()
+    finally:
+        writer.close()
+
+
+def make_body(size):
+    # A part written at the wrong offset changes the md5, as no part size
+    # is a multiple of the length of the pattern.
+    pattern = bytes(bytearray(range(251)))
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+def serve(port, server_port, size, latency, certfile, keyfile, ready):
+    from hypercorn.asyncio import serve as serve_asgi
+    from hypercorn.config import Config
+    body = make_body(size)
+
+    async def app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        start, end = 0, size - 1
+        status = 200
+        headers = [(b'accept-ranges', b'bytes'),
+                   (b'content-type', b'application/octet-stream')]
+        range_header = dict(scope['headers']).get(b'range')
+        if range_header is not None:
+            first, last = range_header.split(b'=', 1)[1].split(b'-')
+            start = int(first)
+            if last:
+                end = min(end, int(last))
+            status = 206
+            headers.append((b'content-range',
+                            b'bytes %d-%d/%d' % (start, end, size)))
+        headers.append((b'content-length', b'%d' % (end + 1 - start)))
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body',
+                    'body': b'' if scope['method'] == 'HEAD'
+                    else body[start:end + 1]})
+
+    async def proxy(client_reader, client_writer):
+        try:
+            server_reader, server_writer = await asyncio.open_connection(
+                '127.0.0.1', server_port)
+        except ConnectionError:
+            client_writer.close()
+            return
+        await asyncio.gather(
+            pipe(client_reader, server_writer, latency / 2.0),
+            pipe(server_reader, client_writer, latency / 2.0))
+
+    async def main():
+        config = Config()
+        config.bind = ['127.0.0.1:%s' % server_port]
+        config.certfile = certfile
+        config.keyfile = keyfile
+        config.accesslog = None
+        config.keep_alive_timeout = 60
+        # A trigger that never fires, so that hypercorn leaves SIGTERM to
+        # end the process rather than shutting down gracefully.
+        asyncio.ensure_future(serve_asgi(
+            app, config, shutdown_trigger=asyncio.Event().wait))
+        while True:
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1',
+                                                          server_port)
+                writer.close()
+                break
+            except ConnectionError:
+                await asyncio.sleep(0.1)
+        server = await asyncio.start_server(proxy, '127.0.0.1', port,
+                                            backlog=4096)
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def run(http2, url, md5, chunksize, num_threads):
+    dest_dir = tempfile.mkdtemp()
+    try:
+        filename = FileInfo(url, dest=os.path.join(dest_dir, 'big.bin'),
+                            md5=md5)
+        handler = Handler({'quiet': True, 'http2': http2},
+                          multi_threshold=chunksize, chunksize=chunksize,
+                          num_threads=num_threads, num_probe_threads=1)
+        start_time = time.time()
+        result = handler.call([filename])
+        elapsed = time.time() - start_time
+    finally:
+        shutil.rmtree(dest_dir)
+    stats = handler.connection_stats()
+    return (elapsed, result.num_tasks_failed, stats.num_requests,
+            stats.num_connections)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=128, metavar='MIB')
+    parser.add_argument('--chunksize', type=int, default=1024,
+                        metavar='KIB')
+    parser.add_argument('--latency', type=float, action='append',
+                        metavar='SECONDS', help="The round trip time, may "
+                        "be given more than once.  The default is 0.1.")
+    parser.add_argument('--threads', type=int, default=10)
+    parser.add_argument('--port', type=int, default=8798)
+    args = parser.parse_args()
+    size = args.size * 1024 * 1024
+    chunksize = args.chunksize * 1024
+    md5 = hashlib.md5(make_body(size)).hexdigest()
+
+    cert_dir = tempfile.mkdtemp()
+    certfile, keyfile = make_certificate(cert_dir)
+    # Trusted by the requests of both transports.
+    os.environ['REQUESTS_CA_BUNDLE'] = certfile
+    print("%s MiB in parts of %s KiB with %s threads" % (
+        args.size, args.chunksize, args.threads))
+    print("%-8s %8s %10s %8s %8s %12s %7s" % (
+        'latency', 'protocol', 'seconds', 'MiB/s', 'requests',
+        'connections', 'failed'))
+    try:
+        for i, latency in enumerate(args.latency or [0.1]):
+            port = args.port + 2 * i
+            ready = multiprocessing.Event()
+            server = multiprocessing.Process(
+                target=serve, args=(port, port + 1, size, latency,
+                                    certfile, keyfile, ready))
+            server.daemon = True
+            server.start()
+            while not ready.wait(0.1):
+                if not server.is_alive():
+                    raise RuntimeError("The server on port %s failed to "
+                                       "start" % port)
+            url = 'https://127.0.0.1:%s/big.bin' % port
+            try:
+                for name, http2 in (('HTTP/1.1', False), ('HTTP/2', True)):
+                    elapsed, num_failed, num_requests, num_connections = \
+                        run(http2, url, md5, chunksize, args.threads)
+                    print("%-8s %8s %10.2f %8.1f %8s %12s %7s" % (
+                        '%.0f ms' % (latency * 1000), name, elapsed,
+                        args.size / elapsed, num_requests, num_connections,
+                        num_failed))
+            finally:
+                server.terminate()
+    finally:
+        shutil.rmtree(cert_dir)
+
+
+if __name__ == '__main__':
+    main()
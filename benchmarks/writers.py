@@ -0,0 +1,202 @@
+"""
+Compares the rate at which the parts of a large file are written to local
+disk by each of the ways a multipart download can write them, e.g.::
+
+    python benchmarks/writers.py --size 4 --fsync
+
+Each run writes a file of ``--size`` GiB to ``--dir`` with ``--threads``
+threads taking turns at its parts, as the workers of a download do.
+Every part is read from a body held in memory, standing in for the
+response, in chunks of ``DownloadPartTask.ITERATE_CHUNK_SIZE``, and
+written the way ``DownloadPartTask`` writes it:
+
+* ``positional``: by each thread with ``PositionalWriter``, from buffers
+  of a ``BufferPool``, as with ``--pwrite``.
+* ``iothread``: through the IO queue to the single ``IOWriterThread``,
+  the default.
+* ``mmap``: read straight into a window of a ``MappedFileWriter``, as
+  with ``--mmap``.
+
+The time includes closing the file, and flushing it to disk if
+``--fsync`` is given.  Without it, a file larger than the memory free for
+the page cache is still mostly written out during the run.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from wgot.compat import queue  # noqa: E402
+from wgot.constants import CHUNKSIZE  # noqa: E402
+from wgot.executor import IOWriterThread, ShutdownThreadRequest  # noqa: E402
+from wgot.handler import Handler  # noqa: E402
+from wgot.tasks import DownloadPartTask  # noqa: E402
+from wgot.utils import BufferPool, IOCloseRequest, IORequest, \
+    MappedFileWriter, PositionalWriter  # noqa: E402
+
+READ_SIZE = DownloadPartTask.ITERATE_CHUNK_SIZE
+
+
+class Body(object):
+    """A response body of ``size`` bytes read from memory."""
+    def __init__(self, data, size):
+        self._data = memoryview(data)
+        self._left = size
+
+    def readinto(self, view):
+        amount = min(len(view), len(self._data), self._left)
+        view[:amount] = self._data[:amount]
+        self._left -= amount
+        return amount
+
+
+def run_parts(size, chunksize, num_threads, write_part):
+    # The threads take the parts in order, as the workers do.
+    parts = queue.Queue()
+    for part_number in range(-(-size // chunksize)):
+        start = part_number * chunksize
+        parts.put((start, min(chunksize, size - start)))
+
+    def work():
+        while True:
+            try:
+                start, part_size = parts.get_nowait()
+            except queue.Empty:
+                return
+            write_part(start, part_size)
+
+    threads = [threading.Thread(target=work) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def write_positional(filename, size, chunksize, num_threads, data, fsync):
+    writer = PositionalWriter(filename)
+    writer.open()
+    pool = BufferPool(READ_SIZE)
+
+    def write_part(start, part_size):
+        body = Body(data, part_size)
+        offset = start
+        while True:
+            view = memoryview(pool.acquire())
+            amount = body.readinto(view)
+            if not amount:
+                pool.release(view)
+                return
+            writer.write(view[:amount], offset)
+            pool.release(view)
+            offset += amount
+
+    run_parts(size, chunksize, num_threads, write_part)
+    writer.close(fsync=fsync)
+
+
+def write_iothread(filename, size, chunksize, num_threads, data, fsync):
+    with open(filename, 'wb'):
+        pass
+    pool = BufferPool(READ_SIZE)
+    io_queue = queue.Queue(maxsize=Handler.MAX_IO_QUEUE_SIZE)
+    io_thread = IOWriterThread(io_queue, buffer_pool=pool)
+    io_thread.start()
+
+    def write_part(start, part_size):
+        body = Body(data, part_size)
+        offset = start
+        while True:
+            view = memoryview(pool.acquire())
+            amount = body.readinto(view)
+            if not amount:
+                pool.release(view)
+                return
+            io_queue.put(IORequest(filename, offset, view[:amount], False))
+            offset += amount
+
+    run_parts(size, chunksize, num_threads, write_part)
+    io_queue.put(IOCloseRequest(filename, fsync))
+    io_queue.put(ShutdownThreadRequest())
+    io_thread.join()
+
+
+def write_mmap(filename, size, chunksize, num_threads, data, fsync):
+    writer = MappedFileWriter(filename, size)
+    writer.open()
+
+    def write_part(start, part_size):
+        body = Body(data, part_size)
+        window = writer.window(start, part_size)
+        try:
+            amount_read = 0
+            while amount_read < part_size:
+                chunk = window[amount_read:amount_read + READ_SIZE]
+                try:
+                    amount_read += body.readinto(chunk)
+                finally:
+                    chunk.release()
+        finally:
+            writer.release_window(window)
+
+    run_parts(size, chunksize, num_threads, write_part)
+    writer.close(fsync=fsync)
+
+
+WRITERS = [
+    ('positional', write_positional, PositionalWriter.SUPPORTED),
+    ('iothread', write_iothread, True),
+    ('mmap', write_mmap, MappedFileWriter.SUPPORTED),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=float, default=2,
+                        help="The size of the file in GiB.")
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE,
+                        help="The size of each part in bytes.")
+    parser.add_argument('--threads', type=int, default=10)
+    parser.add_argument('--dir', default=None,
+                        help="Where to write the file, by default the "
+                        "temporary directory.")
+    parser.add_argument('--fsync', action='store_true',
+                        help="Flush the file to disk before it is closed.")
+    parser.add_argument('--writer', action='append',
+                        choices=[name for name, _, _ in WRITERS],
+                        help="Run only this writer, may be given more than "
+                        "once.")
+    args = parser.parse_args()
+
+    size = int(args.size * 1024 ** 3)
+    data = os.urandom(READ_SIZE)
+    print("%.1f GiB in parts of %s bytes with %s threads%s" % (
+        size / 1024.0 ** 3, args.chunksize, args.threads,
+        ', fsync' if args.fsync else ''))
+    print("%-10s %10s %8s" % ('writer', 'seconds', 'GB/s'))
+    for name, write, supported in WRITERS:
+        if args.writer and name not in args.writer:
+            continue
+        if not supported:
+            print("%-10s %10s" % (name, 'unsupported'))
+            continue
+        fd, filename = tempfile.mkstemp(dir=args.dir, suffix='.wgot-bench')
+        os.close(fd)
+        try:
+            start_time = time.time()
+            write(filename, size, args.chunksize, args.threads, data,
+                  args.fsync)
+            elapsed = time.time() - start_time
+            if os.path.getsize(filename) != size:
+                raise AssertionError("%s wrote %s of %s bytes" % (
+                    name, os.path.getsize(filename), size))
+        finally:
+            os.remove(filename)
+        print("%-10s %10.2f %8.2f" % (name, elapsed, size / elapsed / 1e9))
+
+
+if __name__ == '__main__':
+    main()
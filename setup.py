@@ -21,6 +21,9 @@ setup_options = dict(
     author_email='l@lrowe.co.uk',
     packages=['wgot'],
     install_requires=requires,
+    extras_require={
+        'http2': ['httpx[http2]'],
+    },
     license="Apache License 2.0",
     classifiers=(
         'Intended Audience :: Developers',
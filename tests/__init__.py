@@ -0,0 +1,26 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from .server import FileServer
+
+
+class ServerTestCase(unittest.TestCase):
+    """
+    Runs each test with a ``FileServer`` in ``self.server`` and a
+    temporary directory for the downloads in ``self.dest_dir``.
+    """
+    def setUp(self):
+        self.server = FileServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.dest_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dest_dir)
+
+    def dest(self, name):
+        return os.path.join(self.dest_dir, name)
+
+    def read(self, name):
+        with open(self.dest(name), 'rb') as f:
+            return f.read()
@@ -0,0 +1,176 @@
+"""
+A local HTTP server for the tests, serving files held in memory with
+support for HEAD and Range requests, e.g.::
+
+    with FileServer() as server:
+        server.add('big.bin', data)
+        url = server.url('big.bin')
+
+Each file may be served with a delay before its body, to keep its
+download in flight, may fail its range requests, and may lose the
+connection of its first requests.
+"""
+import email.utils
+import gzip
+import hashlib
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class ServedFile(object):
+    """
+    The data of a served file, and how to serve it.
+
+    * delay: The seconds to wait before sending each response body.
+    * fail_ranges: Whether range requests are answered with a 500.
+    * gzip: Whether the body is sent gzip encoded to clients accepting it.
+    * metadata: Whether the ETag and Last-Modified headers are sent.
+    * drop: The number of requests whose connection is closed before
+      they are answered.
+    * cut: The number of GET requests whose connection is closed half
+      way through the body.
+    """
+    def __init__(self, data, delay=0, fail_ranges=False, gzip=False,
+                 metadata=True, last_modified=1400000000, drop=0, cut=0):
+        self.data = data
+        self.delay = delay
+        self.fail_ranges = fail_ranges
+        self.gzip = gzip
+        self.metadata = metadata
+        self.last_modified = last_modified
+        self.drop = drop
+        self.cut = cut
+
+    @property
+    def etag(self):
+        return '"%s"' % hashlib.md5(self.data).hexdigest()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def _respond(self, send_body):
+        server = self.server.file_server
+        path = self.path.split('?', 1)[0].lstrip('/')
+        served = server.files.get(path)
+        server.record(self.command, path, self.headers.get('Range'))
+        if served is None:
+            self._send_error(404)
+            return
+        if server.take(served, 'drop'):
+            self.close_connection = True
+            return
+        data = served.data
+        status = 200
+        headers = [('Accept-Ranges', 'bytes')]
+        if served.metadata:
+            headers.extend([('ETag', served.etag),
+                            ('Last-Modified', email.utils.formatdate(
+                                served.last_modified, usegmt=True))])
+        range_header = self.headers.get('Range')
+        if range_header is not None:
+            if served.fail_ranges:
+                self._send_error(500)
+                return
+            match = re.match(r'bytes=(\d+)-(\d*)$', range_header)
+            start = int(match.group(1))
+            end = len(data) - 1
+            if match.group(2):
+                end = min(end, int(match.group(2)))
+            headers.append(('Content-Range', 'bytes %s-%s/%s' % (
+                start, end, len(data))))
+            data = data[start:end + 1]
+            status = 206
+        elif served.gzip and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data)
+            headers.append(('Content-Encoding', 'gzip'))
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if send_body:
+            if served.delay:
+                time.sleep(served.delay)
+            if server.take(served, 'cut'):
+                self.wfile.write(data[:len(data) // 2])
+                self.close_connection = True
+                return
+            self.wfile.write(data)
+
+    def _send_error(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class FileServer(object):
+    """Serves the files added with ``add`` from a thread of its own."""
+    def __init__(self):
+        self.files = {}
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _RequestHandler)
+        self._server.file_server = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add(self, path, data, **kwargs):
+        """Serves ``data`` at ``path``, see ``ServedFile`` for ``kwargs``."""
+        self.files[path] = ServedFile(data, **kwargs)
+        return self.url(path)
+
+    def url(self, path):
+        return 'http://127.0.0.1:%s/%s' % (self._server.server_address[1],
+                                           path)
+
+    def record(self, method, path, range_header):
+        with self._lock:
+            self.requests.append((method, path, range_header))
+
+    def take(self, served, name):
+        """Counts down the attribute ``name`` of ``served`` if not zero."""
+        with self._lock:
+            if not getattr(served, name):
+                return False
+            setattr(served, name, getattr(served, name) - 1)
+            return True
+
+    def requests_for(self, path, method='GET'):
+        """The ranges requested for ``path``, None for a whole file."""
+        with self._lock:
+            return [range_header for request_method, request_path,
+                    range_header in self.requests
+                    if request_method == method and request_path == path]
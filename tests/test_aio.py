@@ -0,0 +1,70 @@
+import hashlib
+import os
+import unittest
+
+from wgot.fileinfo import FileInfo
+
+try:
+    from wgot.aio import AsyncHandler, httpx
+except SyntaxError:
+    httpx = None
+
+from . import ServerTestCase
+
+MB = 1024 * 1024
+
+
+@unittest.skipIf(httpx is None, "httpx is not installed")
+class TestAsyncHandler(ServerTestCase):
+    def create_handler(self, **params):
+        params.setdefault('quiet', True)
+        return AsyncHandler(params, multi_threshold=MB, chunksize=MB,
+                            num_threads=50, num_probe_threads=10)
+
+    def test_downloads_many_files(self):
+        urls = [self.server.add('f%s' % i, os.urandom(i * 100))
+                for i in range(100)]
+        result = self.create_handler().call(
+            [FileInfo(url, dest=self.dest(url.rsplit('/')[-1]))
+             for url in urls])
+        self.assertEqual(result.num_tasks_failed, 0)
+        for i in range(100):
+            self.assertEqual(self.read('f%s' % i),
+                             self.server.files['f%s' % i].data)
+
+    def test_downloads_in_parts(self):
+        data = os.urandom(3 * MB + 1)
+        url = self.server.add('big.bin', data)
+        result = self.create_handler().call(
+            [FileInfo(url, dest=self.dest('big.bin'))])
+        self.assertEqual(result.num_tasks_failed, 0)
+        self.assertEqual(self.read('big.bin'), data)
+        self.assertEqual(len(self.server.requests_for('big.bin')), 3)
+
+    def test_reuses_connections(self):
+        urls = [self.server.add('f%s' % i, b'x') for i in range(100)]
+        handler = self.create_handler()
+        handler.call([FileInfo(url, dest=self.dest(url.rsplit('/')[-1]))
+                      for url in urls])
+        stats = handler.connection_stats()
+        self.assertEqual(stats.num_requests, 200)
+        self.assertLess(stats.num_connections, stats.num_requests)
+        # The idle clients are closed with the executor.
+        self.assertFalse(handler.executor._clients)
+
+    def test_cached_file_has_time_of_source(self):
+        data = os.urandom(1000)
+        url = self.server.add('small.bin', data)
+        md5 = hashlib.md5(data).hexdigest()
+        cache_dir = self.dest('cache')
+        # The copy is made from the cache, with the time of its source
+        # rather than of the first download.
+        for name, last_modified in (('small.bin', 1400000000),
+                                    ('copy.bin', 1500000000)):
+            self.server.files['small.bin'].last_modified = last_modified
+            result = self.create_handler(cache_dir=cache_dir).call(
+                [FileInfo(url, dest=self.dest(name), md5=md5)])
+            self.assertEqual(result.num_tasks_failed, 0)
+        self.assertEqual(self.read('copy.bin'), data)
+        self.assertEqual(os.stat(self.dest('copy.bin')).st_mtime, 1500000000)
+        self.assertEqual(len(self.server.requests_for('small.bin')), 1)
@@ -0,0 +1,121 @@
+import hashlib
+import os
+import threading
+
+from wgot.downloader import Downloader
+from wgot.futures import DownloadFailedError
+from wgot.fileinfo import FileInfo
+
+from . import ServerTestCase
+
+MB = 1024 * 1024
+
+
+class TestDownloader(ServerTestCase):
+    def create_downloader(self, **params):
+        downloader = Downloader(params=params, multi_threshold=MB,
+                                chunksize=MB, num_threads=4,
+                                num_probe_threads=4)
+        self.addCleanup(downloader.close)
+        return downloader
+
+    def test_futures_are_in_order(self):
+        data = [os.urandom(2 * MB), b'small', b'']
+        files = [FileInfo(self.server.add('f%s' % i, d),
+                          dest=self.dest('f%s' % i))
+                 for i, d in enumerate(data)]
+        futures = self.create_downloader().download(files)
+        results = [future.result(10) for future in futures]
+        self.assertEqual([result.dest for result in results],
+                         [f.dest for f in files])
+        self.assertEqual([result.size for result in results],
+                         [len(d) for d in data])
+        self.assertEqual([result.status for result in results],
+                         ['downloaded'] * 3)
+        for i, d in enumerate(data):
+            self.assertEqual(self.read('f%s' % i), d)
+
+    def test_result_has_computed_md5(self):
+        small, big = b'small', os.urandom(2 * MB)
+        big_md5 = hashlib.md5(big).hexdigest()
+        files = [FileInfo(self.server.add('small', small),
+                          dest=self.dest('small')),
+                 FileInfo(self.server.add('big', big), dest=self.dest('big'),
+                          md5=big_md5),
+                 FileInfo(self.server.add('other', big),
+                          dest=self.dest('other'))]
+        futures = self.create_downloader().download(files)
+        # The parts of a file are only hashed to verify its md5.
+        self.assertEqual([future.result(10).md5 for future in futures],
+                         [hashlib.md5(small).hexdigest(), big_md5, None])
+
+    def test_same_file_given_twice(self):
+        data = os.urandom(2 * MB)
+        filename = FileInfo(self.server.add('big.bin', data),
+                            dest=self.dest('big.bin'))
+        futures = self.create_downloader().download([filename, filename])
+        # Whichever is probed first is downloaded.
+        self.assertEqual(
+            sorted(future.result(10).status for future in futures),
+            ['downloaded', 'duplicate'])
+        self.assertEqual(self.read('big.bin'), data)
+
+    def test_overlapping_batches_to_same_destination(self):
+        data = os.urandom(3 * MB)
+        big_url = self.server.add('big.bin', data, delay=0.5)
+        small_url = self.server.add('small.txt', b'small')
+        downloader = self.create_downloader()
+        first, = downloader.download(
+            [FileInfo(big_url, dest=self.dest('big.bin'))])
+        second, third = downloader.download([
+            FileInfo(small_url, dest=self.dest('big.bin')),
+            FileInfo(big_url, dest=self.dest('copy.bin')),
+        ])
+        self.assertFalse(first.done())
+        self.assertRaises(DownloadFailedError, second.result, 10)
+        self.assertEqual(first.result(10).status, 'downloaded')
+        self.assertEqual(third.result(10).status, 'copied')
+        self.assertEqual(self.read('big.bin'), data)
+        self.assertEqual(self.read('copy.bin'), data)
+        self.assertEqual(len(self.server.requests_for('big.bin')), 3)
+        # Once done, the destination may be downloaded to again.
+        future, = downloader.download(
+            [FileInfo(small_url, dest=self.dest('big.bin'))])
+        self.assertEqual(future.result(10).status, 'downloaded')
+        self.assertEqual(self.read('big.bin'), b'small')
+
+    def test_failed_download_raises(self):
+        url = self.server.add('big.bin', os.urandom(3 * MB),
+                              fail_ranges=True)
+        future, = self.create_downloader().download(
+            [FileInfo(url, dest=self.dest('big.bin'))])
+        self.assertRaises(DownloadFailedError, future.result, 10)
+
+    def test_progress_callback(self):
+        data = os.urandom(3 * MB)
+        url = self.server.add('big.bin', data)
+        lock = threading.Lock()
+        progress = []
+
+        def progress_callback(future, num_bytes):
+            with lock:
+                progress.append(num_bytes)
+
+        future, = self.create_downloader().download(
+            [FileInfo(url, dest=self.dest('big.bin'))], progress_callback)
+        future.result(10)
+        self.assertEqual(sum(progress), len(data))
+        self.assertEqual(future.num_bytes, len(data))
+
+    def test_batches_share_connections(self):
+        urls = [self.server.add('f%s' % i, b'x' * 100) for i in range(20)]
+        downloader = self.create_downloader()
+        for batch in (urls[:10], urls[10:]):
+            futures = downloader.download(
+                [FileInfo(url, dest=self.dest(url.rsplit('/')[-1]))
+                 for url in batch])
+            for future in futures:
+                self.assertEqual(future.result(10).status, 'downloaded')
+        stats = downloader._handler.connection_stats()
+        self.assertLessEqual(stats.num_connections, 8)
+        self.assertEqual(len(os.listdir(self.dest_dir)), 20)
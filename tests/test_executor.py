@@ -0,0 +1,104 @@
+import threading
+import unittest
+
+import requests
+
+from wgot.compat import queue
+from wgot.executor import MetadataResolver
+from wgot.fileinfo import FileInfo
+from wgot.tasks import DownloadCancelledError, StreamReorderBuffer
+
+from . import ServerTestCase
+
+
+class TestMetadataResolver(ServerTestCase):
+    def test_probes_sizes(self):
+        urls = [self.server.add('f%s' % i, b'x' * i) for i in range(10)]
+        resolver = MetadataResolver(requests.Session(), 4, ordered=True)
+        results = list(resolver.resolve((FileInfo(url), i)
+                                        for i, url in enumerate(urls)))
+        self.assertEqual([tag for result, tag in results], list(range(10)))
+        self.assertEqual([result.filename.src for result, tag in results],
+                         urls)
+        self.assertEqual([result.filename.size for result, tag in results],
+                         list(range(10)))
+        self.assertEqual(resolver.num_probes, 10)
+
+    def test_resolve_closed_early_stops_reading(self):
+        url = self.server.add('f', b'x')
+        num_read = [0]
+
+        def files():
+            for i in range(1000):
+                num_read[0] += 1
+                yield FileInfo(url), None
+
+        # Without keep-alive the server has no threads left either.
+        session = requests.Session()
+        session.headers['Connection'] = 'close'
+        threads = set(threading.enumerate())
+        resolver = MetadataResolver(session, 2, ordered=True)
+        results = resolver.resolve(files())
+        next(results)
+        results.close()
+        for thread in set(threading.enumerate()) - threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        self.assertLess(num_read[0], 1000)
+
+
+class TestStreamReorderBuffer(unittest.TestCase):
+    def setUp(self):
+        self.io_queue = queue.Queue()
+        self.buffer = StreamReorderBuffer(self.io_queue, 1024)
+
+    def written(self):
+        data = []
+        while not self.io_queue.empty():
+            data.append(self.io_queue.get().data)
+        return b''.join(data)
+
+    def test_holds_later_slots(self):
+        first, second, third = [self.buffer.allocate() for i in range(3)]
+        self.buffer.write(third, b'c')
+        self.buffer.write(second, b'b')
+        self.assertEqual(self.written(), b'')
+        self.buffer.write(first, b'a')
+        self.buffer.finish(first)
+        self.buffer.finish(second)
+        self.buffer.finish(third)
+        self.assertEqual(self.written(), b'abc')
+
+    def test_discards_abandoned_slot(self):
+        first, second, third = [self.buffer.allocate() for i in range(3)]
+        self.buffer.write(second, b'b')
+        self.buffer.write(third, b'c')
+        self.buffer.finish(second, discard=True)
+        self.buffer.finish(third)
+        self.buffer.finish(first)
+        self.assertEqual(self.written(), b'c')
+
+    def test_discards_all_slots_of_a_file(self):
+        first = self.buffer.allocate()
+        parts = self.buffer.allocate(3)
+        last = self.buffer.allocate()
+        self.buffer.write(parts + 1, b'b')
+        self.buffer.finish(parts + 1)
+        self.buffer.write(last, b'd')
+        self.buffer.finish(last)
+        self.buffer.discard(range(parts, parts + 3))
+        # Discarded again by the other parts as they fail.
+        self.buffer.discard(range(parts, parts + 3))
+        self.buffer.write(first, b'a')
+        self.buffer.finish(first)
+        self.assertEqual(self.written(), b'ad')
+
+    def test_cancels_after_writing_part_of_a_file(self):
+        parts = self.buffer.allocate(2)
+        last = self.buffer.allocate()
+        self.buffer.write(parts, b'a')
+        self.buffer.write(last, b'c')
+        self.buffer.discard(range(parts, parts + 2))
+        self.assertEqual(self.written(), b'a')
+        self.assertRaises(DownloadCancelledError, self.buffer.write,
+                          last, b'c')
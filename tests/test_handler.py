@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+
+from wgot.fileinfo import FileInfo
+from wgot.handler import Handler
+
+from . import ServerTestCase
+
+MB = 1024 * 1024
+
+
+class TestHandler(ServerTestCase):
+    def create_handler(self, **params):
+        params.setdefault('quiet', True)
+        return Handler(params, multi_threshold=MB, chunksize=MB,
+                       num_threads=4, num_probe_threads=4)
+
+    def test_downloads_in_parts(self):
+        data = os.urandom(3 * MB + 123)
+        url = self.server.add('big.bin', data)
+        result = self.create_handler().call(
+            [FileInfo(url, dest=self.dest('big.bin'))])
+        self.assertEqual(result.num_tasks_failed, 0)
+        self.assertEqual(self.read('big.bin'), data)
+        self.assertEqual(len(self.server.requests_for('big.bin')), 3)
+
+    def test_downloads_in_parts_with_positional_writes(self):
+        data = os.urandom(3 * MB + 123)
+        url = self.server.add('big.bin', data)
+        result = self.create_handler(pwrite=True).call(
+            [FileInfo(url, dest=self.dest('big.bin'))])
+        self.assertEqual(result.num_tasks_failed, 0)
+        self.assertEqual(self.read('big.bin'), data)
+
+    def test_failed_part_removes_file(self):
+        url = self.server.add('big.bin', os.urandom(3 * MB),
+                              fail_ranges=True)
+        result = self.create_handler().call(
+            [FileInfo(url, dest=self.dest('big.bin'))])
+        self.assertEqual(result.num_tasks_failed, 1)
+        self.assertFalse(os.path.exists(self.dest('big.bin')))
+
+    def test_download_cut_short_is_retried(self):
+        data = os.urandom(100000)
+        url = self.server.add('small.bin', data, cut=1)
+        result = self.create_handler().call(
+            [FileInfo(url, dest=self.dest('small.bin'))])
+        self.assertEqual(result.num_tasks_failed, 0)
+        self.assertEqual(self.read('small.bin'), data)
+        self.assertEqual(len(self.server.requests_for('small.bin')), 2)
+
+    def test_json_summary_has_probe_rate_and_connections(self):
+        urls = [self.server.add('f%s' % i, b'x') for i in range(5)]
+        events = self.dest('events.jsonl')
+        self.create_handler(json=events).call(
+            [FileInfo(url, dest=self.dest(url.rsplit('/')[-1]))
+             for url in urls])
+        with open(events) as f:
+            summary = json.loads(f.readlines()[-1])
+        self.assertEqual(summary['event'], 'summary')
+        self.assertEqual(summary['num_probes'], 5)
+        self.assertGreater(summary['probes_per_second'], 0)
+        # A HEAD and a GET for each file.
+        self.assertEqual(summary['num_requests'], 10)
+        self.assertLessEqual(summary['num_connections'], 10)
+
+    def test_duplicate_source_is_downloaded_once(self):
+        data = os.urandom(3 * MB)
+        url = self.server.add('big.bin', data)
+        result = self.create_handler().call([
+            FileInfo(url, dest=self.dest('big.bin')),
+            FileInfo(url, dest=self.dest('copy.bin')),
+        ])
+        self.assertEqual(result.num_tasks_failed, 0)
+        self.assertEqual(result.num_duplicates, 1)
+        self.assertEqual(self.read('big.bin'), data)
+        self.assertEqual(self.read('copy.bin'), data)
+        self.assertEqual(len(self.server.requests_for('big.bin')), 3)
+
+    def test_destination_collision_is_skipped(self):
+        url = self.server.add('a.txt', b'a')
+        other_url = self.server.add('b.txt', b'b')
+        result = self.create_handler().call([
+            FileInfo(url, dest=self.dest('out.txt')),
+            FileInfo(other_url, dest=self.dest('out.txt')),
+        ])
+        self.assertEqual(result.num_collisions, 1)
+        self.assertEqual(self.read('out.txt'), b'a')
+
+    def test_timestamping_skips_unchanged_file(self):
+        data = os.urandom(3 * MB)
+        url = self.server.add('big.bin', data)
+        self.create_handler(sync=True).call(
+            [FileInfo(url, dest=self.dest('big.bin'))])
+        inode = os.stat(self.dest('big.bin')).st_ino
+        self.create_handler(sync=True).call(
+            [FileInfo(url, dest=self.dest('big.bin'))])
+        self.assertEqual(os.stat(self.dest('big.bin')).st_ino, inode)
+        self.assertEqual(len(self.server.requests_for('big.bin')), 3)
+
+    def test_timestamping_skips_unchanged_copies(self):
+        data = os.urandom(3 * MB)
+        url = self.server.add('big.bin', data)
+        files = [FileInfo(url, dest=self.dest('big.bin')),
+                 FileInfo(url, dest=self.dest('copy.bin'))]
+        self.create_handler(sync=True).call(files)
+        inodes = [os.stat(f.dest).st_ino for f in files]
+        for i in range(2):
+            files = [FileInfo(url, dest=self.dest('big.bin')),
+                     FileInfo(url, dest=self.dest('copy.bin'))]
+            result = self.create_handler(sync=True).call(files)
+            self.assertEqual(result.num_tasks_failed, 0)
+            self.assertEqual([os.stat(f.dest).st_ino for f in files],
+                             inodes)
+        self.assertEqual(self.read('copy.bin'), data)
+        self.assertEqual(len(self.server.requests_for('big.bin')), 3)
+
+    def test_timestamping_compares_md5_before_parts(self):
+        data = os.urandom(3 * MB)
+        url = self.server.add('big.bin', data, metadata=False)
+        with open(self.dest('big.bin'), 'wb') as f:
+            f.write(data)
+        inode = os.stat(self.dest('big.bin')).st_ino
+        md5 = hashlib.md5(data).hexdigest()
+        result = self.create_handler(sync=True).call(
+            [FileInfo(url, dest=self.dest('big.bin'), md5=md5)])
+        self.assertEqual(result.num_tasks_failed, 0)
+        self.assertEqual(os.stat(self.dest('big.bin')).st_ino, inode)
+        self.assertEqual(self.server.requests_for('big.bin'), [])
+
+    def test_timestamping_downloads_changed_file_in_parts(self):
+        data = os.urandom(3 * MB)
+        url = self.server.add('big.bin', data, metadata=False)
+        with open(self.dest('big.bin'), 'wb') as f:
+            f.write(os.urandom(3 * MB))
+        md5 = hashlib.md5(data).hexdigest()
+        result = self.create_handler(sync=True).call(
+            [FileInfo(url, dest=self.dest('big.bin'), md5=md5)])
+        self.assertEqual(result.num_tasks_failed, 0)
+        self.assertEqual(self.read('big.bin'), data)
+        self.assertEqual(len(self.server.requests_for('big.bin')), 3)
+
+    def test_cached_file_has_time_of_source(self):
+        data = os.urandom(1000)
+        url = self.server.add('small.bin', data)
+        md5 = hashlib.md5(data).hexdigest()
+        cache_dir = self.dest('cache')
+        # The copy is made from the cache, with the time of its source
+        # rather than of the first download.
+        for name, last_modified in (('small.bin', 1400000000),
+                                    ('copy.bin', 1500000000)):
+            self.server.files['small.bin'].last_modified = last_modified
+            result = self.create_handler(cache_dir=cache_dir).call(
+                [FileInfo(url, dest=self.dest(name), md5=md5)])
+            self.assertEqual(result.num_tasks_failed, 0)
+        self.assertEqual(self.read('copy.bin'), data)
+        self.assertEqual(os.stat(self.dest('copy.bin')).st_mtime, 1500000000)
+        self.assertEqual(len(self.server.requests_for('small.bin')), 1)
@@ -0,0 +1,61 @@
+import io
+import os
+import sys
+
+from wgot.fileinfo import FileInfo
+from wgot.handler import StreamHandler
+
+from . import ServerTestCase
+
+MB = 1024 * 1024
+
+
+class TestStreamHandler(ServerTestCase):
+    def setUp(self):
+        super(TestStreamHandler, self).setUp()
+        # The documents are written to the buffer of standard out.
+        self.output = io.BytesIO()
+        stdout = sys.stdout
+        sys.stdout = io.TextIOWrapper(self.output)
+        self.addCleanup(setattr, sys, 'stdout', stdout)
+
+    def call(self, urls, **params):
+        params.update({'quiet': True, 'only_show_errors': True,
+                       'is_stream': True})
+        handler = StreamHandler(params, multi_threshold=MB, chunksize=MB)
+        return handler.call([FileInfo(url, is_stream=True) for url in urls])
+
+    def test_writes_documents_in_order(self):
+        first = os.urandom(3 * MB + 5)
+        second = b'second'
+        third = os.urandom(2 * MB + 1)
+        # The first part is the slowest, so the others are held back.
+        urls = [self.server.add('first', first, delay=0.2),
+                self.server.add('second', second),
+                self.server.add('third', third)]
+        result = self.call(urls)
+        self.assertEqual(result.num_tasks_failed, 0)
+        self.assertEqual(self.output.getvalue(), first + second + third)
+
+    def test_failed_part_fails_download(self):
+        urls = [self.server.add('first', b'first'),
+                self.server.add('big', os.urandom(3 * MB),
+                                fail_ranges=True),
+                self.server.add('last', b'last')]
+        result = self.call(urls)
+        self.assertEqual(result.num_tasks_failed, 1)
+        self.assertEqual(self.output.getvalue(), b'firstlast')
+
+    def test_cut_part_cancels_stream(self):
+        data = os.urandom(3 * MB)
+        # Every request of the file is cut half way through its body, so
+        # some of its first part is written before the part fails.
+        urls = [self.server.add('first', b'first'),
+                self.server.add('big', data, cut=100),
+                self.server.add('last', b'last')]
+        result = self.call(urls)
+        self.assertGreaterEqual(result.num_tasks_failed, 1)
+        output = self.output.getvalue()
+        self.assertTrue(output.startswith(b'first' + data[:1]))
+        self.assertLess(len(output), len(b'first') + MB)
+        self.assertFalse(output.endswith(b'last'))
@@ -0,0 +1,109 @@
+import os
+import socket
+import unittest
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from wgot.transport import HTTP2Adapter, PooledHTTPAdapter, \
+    mount_pooled_adapters, connection_stats
+
+from . import ServerTestCase
+
+
+class TLSAdapter(HTTPAdapter):
+    pass
+
+
+class TestMountPooledAdapters(unittest.TestCase):
+    def test_replaces_default_adapters(self):
+        session = requests.Session()
+        adapters = mount_pooled_adapters(session, 10, 5)
+        self.assertEqual([type(adapter) for adapter in adapters],
+                         [PooledHTTPAdapter, PooledHTTPAdapter])
+        self.assertIs(session.adapters['https://'], adapters[0])
+
+    def test_keeps_retries(self):
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(max_retries=3))
+        adapter = mount_pooled_adapters(session, 10, 5)[0]
+        self.assertIsInstance(adapter, PooledHTTPAdapter)
+        self.assertEqual(adapter.max_retries.total, 3)
+
+    def test_keeps_adapters_of_the_caller(self):
+        session = requests.Session()
+        adapter = TLSAdapter()
+        session.mount('https://', adapter)
+        adapters = mount_pooled_adapters(session, 10, 5)
+        self.assertIs(adapters[0], adapter)
+        self.assertIs(session.adapters['https://'], adapter)
+        self.assertEqual(connection_stats(adapters).num_connections, 0)
+
+    @unittest.skipUnless(HTTP2Adapter.SUPPORTED, "httpx is not installed")
+    def test_pools_retrying_adapter_instead_of_http2(self):
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(max_retries=3))
+        adapter = mount_pooled_adapters(session, 10, 5, http2=True)[0]
+        self.assertIsInstance(adapter, PooledHTTPAdapter)
+
+
+@unittest.skipUnless(HTTP2Adapter.SUPPORTED, "httpx is not installed")
+class TestHTTP2Adapter(ServerTestCase):
+    def setUp(self):
+        super(TestHTTP2Adapter, self).setUp()
+        # httpx falls back to HTTP/1.1 over plain http, which is enough to
+        # test the responses.
+        self.session = requests.Session()
+        self.adapter = HTTP2Adapter(max_connections=2)
+        self.session.mount('http://', self.adapter)
+        self.addCleanup(self.adapter.close)
+
+    def test_decodes_gzip(self):
+        data = b'line\n' * 1000
+        url = self.server.add('lines.txt', data, gzip=True)
+        response = self.session.get(url, stream=True)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(list(response.iter_lines()),
+                         [b'line'] * 1000)
+
+    def test_reads_raw_body(self):
+        data = b'line\n' * 1000
+        url = self.server.add('lines.txt', data, gzip=True)
+        response = self.session.get(url, stream=True)
+        raw = b''.join(response.raw.stream(1024, decode_content=False))
+        self.assertNotEqual(raw, data)
+        self.assertEqual(self.adapter.stats().num_requests, 1)
+
+    def test_sends_request_again_when_connection_is_lost(self):
+        url = self.server.add('a.txt', b'a', drop=1)
+        response = self.session.get(url)
+        self.assertEqual(response.content, b'a')
+        self.assertEqual(len(self.server.requests_for('a.txt')), 2)
+        self.assertEqual(self.adapter.stats().num_requests, 2)
+
+    def test_reads_body_again_when_connection_is_lost(self):
+        data = os.urandom(100000)
+        url = self.server.add('a.bin', data, cut=1)
+        response = self.session.get(url)
+        self.assertEqual(response.content, data)
+        self.assertEqual(len(self.server.requests_for('a.bin')), 2)
+
+    def test_gives_up_when_connection_is_lost_again(self):
+        url = self.server.add('a.txt', b'a',
+                              drop=HTTP2Adapter.CONNECTION_RETRIES + 1)
+        with self.assertRaises(requests.ConnectionError):
+            self.session.get(url)
+        # The next request can still open a stream.
+        self.assertEqual(self.session.get(url).content, b'a')
+
+    def test_sends_through_proxy(self):
+        url = self.server.add('small.bin', b'small')
+        # Nothing listens on the port of the proxy.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        proxy = 'http://127.0.0.1:%s' % sock.getsockname()[1]
+        sock.close()
+        self.session.proxies = {'http': proxy}
+        self.assertRaises(requests.ConnectionError, self.session.get, url)
+        self.session.proxies = {}
+        self.assertEqual(self.session.get(url).content, b'small')
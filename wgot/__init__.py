@@ -0,0 +1,2 @@
+from .downloader import Downloader
+from .futures import DownloadFailedError, DownloadFuture, DownloadResult
@@ -0,0 +1,667 @@
+"""
+An engine downloading with coroutines on an ``httpx.AsyncClient`` rather
+than with a thread per download, so thousands of small files can be in
+flight at once.  The files are planned by the ``Handler`` as with the
+threads and report to the same result queue; only the requests, and the
+reads of their responses, run on the event loop.  Writing, hashing and
+the rest of the blocking work is handed to a small pool of threads.
+
+httpx is an optional dependency, installed with the ``http2`` extra.
+This module needs Python 3.
+"""
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from .compat import queue
+from .compat import urlparse
+from .constants import NUM_THREADS, ASYNC_NUM_REQUESTS, ASYNC_NUM_PROBES
+from .executor import Executor, MetadataResolver, ShutdownThreadRequest, \
+    set_info_from_probe
+from .fileinfo import check_status, prepare_local_file, set_last_update
+from .handler import Handler
+from .tasks import BasicTask, DownloadPartTask, DownloadCancelledError, \
+    RetriesExeededError, print_skip
+from .transport import ConnectionStats
+from .utils import MD5Error, IncompleteReadError, PositionalWriter, \
+    PrintTask, ProbeResult, set_local_etag
+
+
+LOGGER = logging.getLogger(__name__)
+
+# The data read from a response is written in blocks of at least this
+# size, so the thread pool isn't handed every chunk received.
+WRITE_SIZE = 256 * 1024
+
+
+def response_info(response):
+    """
+    Returns a ``requests.Response`` with the status and headers of the
+    httpx ``response``, for the functions taking one, e.g.
+    ``FileInfo.set_info_from_headers``.  It has no body, the httpx
+    response is read and closed by its caller.
+    """
+    info = requests.Response()
+    info.status_code = response.status_code
+    info.headers = CaseInsensitiveDict(response.headers)
+    info.reason = response.reason_phrase
+    info.url = str(response.url)
+    info.request = response.request
+    # There is nothing for ``close`` to release.
+    info._content_consumed = True
+    return info
+
+
+async def _report_read(future, delay, num_bytes):
+    # Reports a read to the future of the file and waits out the rate
+    # limit, see ``RateLimiter.delay_for``.
+    if future is not None:
+        future.update(num_bytes)
+    if delay is not None:
+        seconds = delay(num_bytes)
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+
+class AsyncExecutor(Executor):
+    """
+    An ``Executor`` running the tasks as coroutines on an event loop of
+    its own.  A dispatcher thread takes the tasks from the queue, in the
+    same order as the worker threads would, and runs up to
+    ``num_threads`` of them at once.  Tasks with a ``run_async`` method
+    are awaited with the executor, the others are called in the pool of
+    ``num_blocking_threads`` threads.
+
+    The requests are made with the headers, auth and TLS settings of
+    ``session``.  Each request in flight borrows an ``httpx.AsyncClient``
+    of its own, which keeps its connection alive for the next request to
+    the same host, as each worker thread would: the connection pool of a
+    client looks through all of its requests and connections whenever one
+    starts or ends, so sharing one client between thousands of requests is
+    far slower.  The clients share one SSL context, and at most
+    ``max_idle_clients``, by default ``num_threads``, are kept between
+    requests, the others are closed.  With ``http2`` every request shares
+    one client instead, multiplexed over a connection to each host that
+    supports HTTP/2.
+    """
+    def __init__(self, session, http2=False,
+                 num_blocking_threads=NUM_THREADS, max_idle_clients=None,
+                 **kwargs):
+        super(AsyncExecutor, self).__init__(**kwargs)
+        self.session = session
+        self.http2 = http2
+        self.num_blocking_threads = num_blocking_threads
+        if max_idle_clients is None:
+            max_idle_clients = self.num_threads
+        self.max_idle_clients = max_idle_clients
+        self._ssl_context = None
+        # Every client not closed yet, only used in the loop once started.
+        self._clients = set()
+        self._shared_client = None
+        # The clients not lent to a request, by the host of the connection
+        # each keeps alive, only used in the loop.
+        self._idle_clients = {}
+        self._num_idle_clients = 0
+        self._loop = None
+        self._loop_thread = None
+        self._pool = None
+        self._slots = threading.Semaphore(self.num_threads)
+        # The coroutines of the tasks running, only used in the loop.
+        self._running = set()
+        self._num_requests = 0
+        self._num_connections = 0
+
+    def start(self):
+        self.io_thread.start()
+        self.print_thread.start()
+        self._pool = ThreadPoolExecutor(self.num_blocking_threads)
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever)
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+        self._ssl_context = self._create_ssl_context()
+        if self.http2:
+            # The client shared by every request.
+            self._shared_client = self._create_client()
+        dispatcher = threading.Thread(target=self._dispatch)
+        dispatcher.daemon = True
+        self.threads_list.append(dispatcher)
+        dispatcher.start()
+
+    def _create_ssl_context(self):
+        # Made once for every client, loading the certificates is slow.
+        session = self.session
+        verify = session.verify
+        if verify is True and session.trust_env:
+            # As requests does.
+            verify = os.environ.get('REQUESTS_CA_BUNDLE') or \
+                os.environ.get('CURL_CA_BUNDLE') or True
+        if verify is True or verify is False:
+            context = httpx.create_ssl_context(verify=verify)
+        elif os.path.isdir(verify):
+            context = ssl.create_default_context(capath=verify)
+        else:
+            context = ssl.create_default_context(cafile=verify)
+        if isinstance(session.cert, tuple):
+            context.load_cert_chain(*session.cert)
+        elif session.cert:
+            context.load_cert_chain(session.cert)
+        return context
+
+    def _create_client(self):
+        session = self.session
+        headers = dict(session.headers)
+        # httpx manages its connections itself.
+        headers.pop('Connection', None)
+        # A client lent to one request at a time needs one connection.
+        max_keepalive = 1
+        if self.http2:
+            max_keepalive = self.num_threads
+        client = httpx.AsyncClient(
+            http2=self.http2, headers=headers, auth=session.auth,
+            verify=self._ssl_context,
+            limits=httpx.Limits(max_connections=None,
+                                max_keepalive_connections=max_keepalive),
+            timeout=httpx.Timeout(DownloadPartTask.READ_TIMEOUT,
+                                  connect=DownloadPartTask.CONNECT_TIMEOUT),
+            follow_redirects=True, max_redirects=session.max_redirects)
+        self._clients.add(client)
+        return client
+
+    def _acquire_client(self, host):
+        idle_clients = self._idle_clients.get(host)
+        if not idle_clients:
+            return self._create_client()
+        self._num_idle_clients -= 1
+        client = idle_clients.pop()
+        if not idle_clients:
+            del self._idle_clients[host]
+        return client
+
+    async def _release_client(self, client, host):
+        if self._num_idle_clients >= self.max_idle_clients:
+            self._clients.discard(client)
+            await client.aclose()
+            return
+        self._num_idle_clients += 1
+        self._idle_clients.setdefault(host, []).append(client)
+
+    def initiate_shutdown(self, priority=Executor.STANDARD_PRIORITY):
+        # There is a single dispatcher to stop.
+        LOGGER.debug("Queueing end sentinel for dispatcher (priority: %s)",
+                     priority)
+        self.queue.put(ShutdownThreadRequest(priority))
+
+    def run_coroutine(self, coroutine):
+        """
+        Runs ``coroutine`` on the loop from another thread, returning a
+        ``concurrent.futures.Future`` of its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def run_blocking(self, function, *args):
+        """Awaits ``function`` called with ``args`` in the thread pool."""
+        return self._loop.run_in_executor(self._pool,
+                                          partial(function, *args))
+
+    @contextlib.asynccontextmanager
+    async def request(self, method, url, headers=None):
+        """
+        Makes a request, giving the httpx response once its headers have
+        been received.  The body is left for the caller to read, the
+        response is closed on leaving the context.
+        """
+        host = urlparse(url).netloc.lower()
+        if self.http2:
+            client = self._shared_client
+        else:
+            client = self._acquire_client(host)
+        try:
+            request = client.build_request(
+                method, url, headers=headers,
+                extensions={'trace': self._trace})
+            self._num_requests += 1
+            response = await client.send(request, stream=True)
+            try:
+                yield response
+            finally:
+                await response.aclose()
+        finally:
+            if not self.http2:
+                await self._release_client(client, host)
+
+    async def _trace(self, event_name, info):
+        if event_name == 'connection.connect_tcp.complete':
+            self._num_connections += 1
+
+    def stats(self):
+        """Return the ``ConnectionStats`` of the requests so far."""
+        return ConnectionStats(self._num_requests, self._num_connections)
+
+    def _dispatch(self):
+        while True:
+            task = self.queue.get(True)
+            if isinstance(task, ShutdownThreadRequest):
+                LOGGER.debug("Shutdown request received in dispatcher, "
+                             "shutting down the event loop.")
+                break
+            # Waits for one of the tasks running to finish.
+            self._slots.acquire()
+            LOGGER.debug("Dispatcher scheduling task: %s", task)
+            self.run_coroutine(self._run_task(task))
+        if task.PRIORITY == self.IMMEDIATE_PRIORITY:
+            self._loop.call_soon_threadsafe(self._cancel_running)
+        for i in range(self.num_threads):
+            self._slots.acquire()
+        self.run_coroutine(self._close_clients()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        self._pool.shutdown()
+
+    async def _run_task(self, task):
+        coroutine = asyncio.current_task()
+        self._running.add(coroutine)
+        try:
+            run_async = getattr(task, 'run_async', None)
+            if run_async is not None:
+                await run_async(self)
+            else:
+                await self.run_blocking(task)
+        except Exception as e:
+            LOGGER.debug('Error calling task: %s', e, exc_info=True)
+        finally:
+            self._running.discard(coroutine)
+            self.queue.release(task)
+            self._slots.release()
+
+    async def _close_clients(self):
+        clients, self._clients = self._clients, set()
+        self._idle_clients = {}
+        self._num_idle_clients = 0
+        for client in clients:
+            await client.aclose()
+
+    def _cancel_running(self):
+        for coroutine in self._running:
+            coroutine.cancel()
+
+
+class AsyncProbeThread(threading.Thread):
+    """
+    This thread makes the HEAD request of each ``FileInfo`` pulled from
+    ``probe_queue`` on the loop of ``engine``, with up to ``num_probes``
+    of them in flight, and passes the results on to ``resolved_queue``.
+    It stands in for the ``MetadataProbeThread`` threads, and counts
+    towards the per host limit of ``host_limiter`` the same way.
+    """
+    def __init__(self, engine, probe_queue, resolved_queue, num_probes,
+                 host_limiter=None):
+        threading.Thread.__init__(self)
+        self.engine = engine
+        self.probe_queue = probe_queue
+        self.resolved_queue = resolved_queue
+        self.host_limiter = host_limiter
+        self.num_probes = 0
+        self._max_probes = num_probes
+        self._slots = threading.Semaphore(num_probes)
+        # The results of the probes, waiting for room in resolved_queue.
+        self._done = queue.Queue()
+
+    def run(self):
+        collector = threading.Thread(target=self._collect)
+        collector.daemon = True
+        collector.start()
+        while True:
+            item = self.probe_queue.get(True)
+            if isinstance(item, ShutdownThreadRequest):
+                LOGGER.debug("Shutdown request received in probe thread, "
+                             "shutting down probe thread.")
+                break
+            self._slots.acquire()
+            sequence, filename = item
+            host = None
+            if self.host_limiter is not None:
+                host = filename.host
+                self.host_limiter.acquire_host(host)
+            self.engine.run_coroutine(self._probe(sequence, filename, host))
+        for i in range(self._max_probes):
+            self._slots.acquire()
+        self._done.put(item)
+        collector.join()
+        self.resolved_queue.put(item)
+
+    async def _probe(self, sequence, filename, host):
+        error = None
+        try:
+            async with self.engine.request('HEAD', filename.src) as response:
+                info = response_info(response)
+            set_info_from_probe(filename, info)
+        except Exception as e:
+            LOGGER.debug('Error probing %s: %s', filename.src, e,
+                         exc_info=True)
+            error = e
+        finally:
+            if host is not None:
+                self.host_limiter.release_host(host)
+        self.num_probes += 1
+        self._done.put((sequence, ProbeResult(filename, error)))
+
+    def _collect(self):
+        while True:
+            item = self._done.get(True)
+            if isinstance(item, ShutdownThreadRequest):
+                break
+            self.resolved_queue.put(item)
+            self._slots.release()
+
+
+class AsyncMetadataResolver(MetadataResolver):
+    """
+    A ``MetadataResolver`` making up to ``num_threads`` HEAD requests at
+    once on the loop of ``engine``, an ``AsyncExecutor``.
+    """
+    def __init__(self, engine, **kwargs):
+        super(AsyncMetadataResolver, self).__init__(**kwargs)
+        self.engine = engine
+
+    def _create_probe_threads(self, probe_queue, resolved_queue):
+        return [AsyncProbeThread(self.engine, probe_queue, resolved_queue,
+                                 self.num_threads, self.host_limiter)]
+
+
+class LocalFile(object):
+    """
+    The local file of a download made in one go, written in blocks from
+    the thread pool and checked against ``md5_hex`` if given.
+    """
+    def __init__(self, filename, md5_hex=None):
+        self.filename = filename
+        self.md5_hex = md5_hex
+        self._md5 = hashlib.md5()
+        self._file = None
+
+    def write(self, chunks):
+        if self._file is None:
+            prepare_local_file(self.filename)
+            self._file = open(self.filename, 'wb')
+        for chunk in chunks:
+            self._md5.update(chunk)
+            self._file.write(chunk)
+
+    def finish(self, chunks, last_update, etag):
+        """
+        Writes the last ``chunks`` and closes the file, then sets its
+        modification time and ETag once its md5 has been checked.
+        Returns the md5 of the file.
+        """
+        self.write(chunks)
+        self._file.close()
+        md5_hex = self._md5.hexdigest()
+        if self.md5_hex and self.md5_hex != md5_hex:
+            os.remove(self.filename)
+            raise MD5Error(self.filename)
+        set_last_update(self.filename, last_update)
+        set_local_etag(self.filename, etag)
+        return md5_hex
+
+    def abort(self):
+        # Don't leave a partial file behind, it could be taken for an up
+        # to date one.
+        if self._file is not None:
+            self._file.close()
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+
+
+class AsyncBasicTask(BasicTask):
+    """A ``BasicTask`` made as a coroutine by ``run_async``."""
+    TOTAL_ATTEMPTS = 3
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncBasicTask, self).__init__(*args, **kwargs)
+        self._delay = self._read_size = None
+        if self.rate_limiter is not None:
+            self._delay = self.rate_limiter.delay_for(self.filename.host)
+            self._read_size = self.rate_limiter.read_size_for(
+                self.filename.host)
+
+    async def run_async(self, engine):
+        if self.future is not None:
+            self.future.set_running()
+        if not await engine.run_blocking(self._skip_unchanged):
+            await self._execute_async(engine)
+        if self.fan_out is not None:
+            await engine.run_blocking(self.fan_out.complete,
+                                      not self._failed, self._md5_verified)
+
+    async def _execute_async(self, engine):
+        filename = self.filename
+        dryrun = self.parameters['dryrun']
+        last_error = ''
+        for attempt in range(self.TOTAL_ATTEMPTS):
+            if attempt and self.future is not None:
+                self.future.retried()
+            try:
+                if not dryrun:
+                    if self.cache is not None and \
+                            await engine.run_blocking(self._fetch_from_cache):
+                        return
+                    self._md5 = await self._download(engine)
+                    if self._md5 is None:
+                        self.result_queue.put(PrintTask(
+                            message=print_skip(filename), error=False))
+                        self._set_result('unchanged')
+                        return
+                    # The data was found to match the md5, if one is
+                    # known by then.
+                    self._md5_verified = bool(filename.md5)
+                    if self.cache is not None and filename.md5:
+                        await engine.run_blocking(
+                            self.cache.store, filename.md5, filename.dest)
+            except (httpx.TransportError, IncompleteReadError) as e:
+                LOGGER.debug("%s %s failure: %s", filename.src,
+                             filename.operation_name, e)
+                last_error = str(e)
+                continue
+            except MD5Error as e:
+                LOGGER.debug("%s %s failure: Data was corrupted: %s",
+                             filename.src, filename.operation_name, e)
+                last_error = str(e)
+                continue
+            except Exception as e:
+                LOGGER.debug(str(e), exc_info=True)
+                await engine.run_blocking(
+                    self._queue_print_message, filename, True, dryrun,
+                    str(e))
+                return
+            await engine.run_blocking(self._queue_print_message, filename,
+                                      False, dryrun)
+            return
+        # We've run out of retries.
+        await engine.run_blocking(self._queue_print_message, filename, True,
+                                  dryrun, last_error)
+
+    async def _download(self, engine):
+        # Returns None if the local file was up to date, the md5 of the
+        # data downloaded otherwise.
+        filename = self.filename
+        headers = {}
+        if self.parameters['sync'] and not self.compare_md5:
+            headers = filename.conditional_headers()
+        async with engine.request('GET', filename.src, headers) as response:
+            if response.status_code == 304:
+                filename.status_code = response.status_code
+                return None
+            filename.set_info_from_headers(response_info(response))
+            return await self._save(engine, response)
+
+    async def _save(self, engine, response):
+        filename = self.filename
+        local_file = LocalFile(filename.dest, filename.md5)
+        chunks = []
+        buffered = amount_read = 0
+        try:
+            async for chunk in response.aiter_raw(self._read_size):
+                chunks.append(chunk)
+                buffered += len(chunk)
+                amount_read += len(chunk)
+                await _report_read(self.future, self._delay, len(chunk))
+                if buffered >= WRITE_SIZE:
+                    await engine.run_blocking(local_file.write, chunks)
+                    chunks = []
+                    buffered = 0
+            _check_content_length(response, amount_read)
+            return await engine.run_blocking(
+                local_file.finish, chunks, filename.last_update,
+                filename.etag)
+        except BaseException:
+            local_file.abort()
+            raise
+
+
+class AsyncDownloadPartTask(DownloadPartTask):
+    """A ``DownloadPartTask`` made as a coroutine by ``run_async``."""
+    def __init__(self, *args, **kwargs):
+        super(AsyncDownloadPartTask, self).__init__(*args, **kwargs)
+        self._delay = None
+        rate_limiter = kwargs.get('rate_limiter')
+        if rate_limiter is not None:
+            self._delay = rate_limiter.delay_for(self._filename.host)
+        # Unthrottled responses are read as the data arrives.
+        if self._delay is None:
+            self._read_size = None
+
+    async def run_async(self, engine):
+        try:
+            await self._download_part_async(engine)
+        except Exception as e:
+            await engine.run_blocking(self._part_failed, e)
+
+    async def _download_part_async(self, engine):
+        start_range, end_range = self._start_part()
+        if self._context.create_file_first:
+            await engine.run_blocking(self._context.wait_for_file_created)
+        for i in range(self.TOTAL_ATTEMPTS):
+            self._retries = i
+            if i and self._future is not None:
+                self._future.retried()
+            try:
+                if self._amount_read < self._part_size:
+                    range_param = 'bytes=%s-%s' % (
+                        start_range + self._amount_read, end_range)
+                    LOGGER.debug(
+                        "Making GetObject requests with byte range: %s",
+                        range_param)
+                    async with engine.request(
+                            'GET', self._filename.src,
+                            {'Range': range_param}) as response:
+                        self._http_status = response.status_code
+                        info = response_info(response)
+                        # Anything but the range asked for would be
+                        # written at the wrong place.
+                        check_status(info, 206)
+                        self._filename.set_info_from_headers(info)
+                        await engine.run_blocking(
+                            self._context.wait_for_file_created)
+                        await self._write_body(engine, response)
+                await engine.run_blocking(self._part_completed)
+                return
+            except (httpx.TransportError, IncompleteReadError) as e:
+                LOGGER.debug("Error after %s bytes: %s, retrying request, "
+                             "(attempt %s / %s)", self._amount_read, e, i,
+                             self.TOTAL_ATTEMPTS)
+                continue
+        raise RetriesExeededError("Maximum number of attempts exceeded: %s" %
+                                  self.TOTAL_ATTEMPTS)
+
+    async def _write_body(self, engine, response):
+        # Only the data written counts as read, so a retry requests the
+        # bytes after it.
+        chunks = []
+        buffered = amount_read = 0
+        async for chunk in response.aiter_raw(self._read_size):
+            if self._context.is_cancelled():
+                raise DownloadCancelledError("Download has been cancelled.")
+            chunks.append(chunk)
+            buffered += len(chunk)
+            amount_read += len(chunk)
+            await _report_read(self._future, self._delay, len(chunk))
+            if buffered >= WRITE_SIZE:
+                await self._write(engine, chunks)
+                chunks = []
+                buffered = 0
+        await self._write(engine, chunks)
+        _check_content_length(response, amount_read)
+
+    async def _write(self, engine, chunks):
+        if not chunks:
+            return
+        data = b''.join(chunks)
+        offset = self._part_number * self._chunk_size + self._amount_read
+        await engine.run_blocking(self._writer.write, data, offset)
+        self._amount_read += len(data)
+
+
+def _check_content_length(response, amount_read):
+    content_length = response.headers.get('Content-Length')
+    if content_length is not None and amount_read != int(content_length):
+        raise IncompleteReadError(actual_bytes=amount_read,
+                                  expected_bytes=int(content_length))
+
+
+class AsyncHandler(Handler):
+    """
+    A ``Handler`` downloading with an ``AsyncExecutor``, making up to
+    ``num_threads`` downloads and ``num_probe_threads`` HEAD requests at
+    once, by default far more than it would with threads.  Files are
+    written with positional writes, so it neither writes to a stream nor
+    memory maps files.
+    """
+    EXECUTOR_NUM_THREADS = ASYNC_NUM_REQUESTS
+    PROBE_NUM_THREADS = ASYNC_NUM_PROBES
+    # The coroutines can't wait on a ThroughputTuner.
+    SUPPORTS_AUTO_TUNE = False
+    # The parts are written from the thread pool, not the IO thread.
+    POSITIONAL_WRITES = True
+    BASIC_TASK_CLASS = AsyncBasicTask
+    PART_TASK_CLASS = AsyncDownloadPartTask
+
+    def __init__(self, *args, **kwargs):
+        if httpx is None:
+            raise ValueError("The asyncio engine requires the httpx "
+                             "package, install wgot[http2]")
+        if not PositionalWriter.SUPPORTED:
+            raise ValueError("The asyncio engine requires os.pwrite")
+        super(AsyncHandler, self).__init__(*args, **kwargs)
+
+    def _create_executor(self, **kwargs):
+        # Checked here as the executor is the first thing made from the
+        # params.
+        if self.params['is_stream']:
+            raise ValueError("The asyncio engine does not write to a "
+                             "stream")
+        if self.params['mmap']:
+            raise ValueError("The asyncio engine does not memory map files")
+        return AsyncExecutor(session=self.session,
+                             http2=self.params['http2'], **kwargs)
+
+    def _create_metadata_resolver(self, **kwargs):
+        return AsyncMetadataResolver(self.executor, **kwargs)
+
+    def connection_stats(self):
+        return self.executor.stats()
@@ -0,0 +1,211 @@
+import errno
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+LOGGER = logging.getLogger(__name__)
+
+# The ioctl cloning a file on filesystems with copy on write.
+FICLONE = 0x40049409
+
+
+class ContentCache(object):
+    """
+    A directory of downloaded files named by their md5, so a file whose
+    md5 is known can be made from an earlier download of the same
+    content instead of being downloaded again.  Files are reflinked into
+    and out of the cache where possible, otherwise copied, and never
+    hardlinked: a change to a downloaded file must not change the copy
+    in the cache.  An entry whose size is not the expected one is
+    dropped rather than used.
+
+    The least recently used files are evicted once the cache holds more
+    than ``max_size`` bytes.  The size of the cache is found by walking
+    it once and then kept as a running total, so the cache is only
+    walked again when it has to be evicted from.  The last use of each
+    entry is recorded by touching a separate ``.used`` file.  The cache
+    may be shared by several processes: entries are added by renaming
+    them into place and a missing entry is just a miss.
+    """
+    USED_SUFFIX = '.used'
+
+    def __init__(self, directory, max_size):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self.num_hits = 0
+        self.num_stored = 0
+        self._total_size = None
+        self._lock = threading.Lock()
+
+    def _entry_path(self, md5):
+        md5 = md5.lower()
+        return os.path.join(self.directory, md5[:2], md5)
+
+    def contains(self, md5, size=None):
+        try:
+            entry_size = os.path.getsize(self._entry_path(md5))
+        except OSError:
+            return False
+        return size is None or entry_size == size
+
+    def fetch(self, md5, dest, size=None):
+        """
+        Make ``dest`` from the cached file with ``md5``.  Returns False if
+        there is no such file, or if it is not ``size`` bytes long.
+        """
+        entry = self._entry_path(md5)
+        try:
+            entry_size = os.path.getsize(entry)
+            if size is not None and entry_size != size:
+                LOGGER.debug("Dropping %s from the cache, it has %s bytes "
+                             "rather than %s.", entry, entry_size, size)
+                self._remove(entry, entry_size)
+                return False
+            place_file(entry, dest)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        self._touch(entry)
+        with self._lock:
+            self.num_hits += 1
+        LOGGER.debug("Made %s from the cached file %s.", dest, entry)
+        return True
+
+    def store(self, md5, filename):
+        """Add the downloaded ``filename``, whose md5 has been verified."""
+        entry = self._entry_path(md5)
+        if os.path.isfile(entry):
+            self._touch(entry)
+            return
+        try:
+            size = os.path.getsize(filename)
+            if size > self.max_size:
+                # Caching it would only evict everything else.
+                return
+            place_file(filename, entry)
+        except (IOError, OSError) as e:
+            LOGGER.debug("Could not cache %s: %s", filename, e,
+                         exc_info=True)
+            return
+        self._touch(entry)
+        with self._lock:
+            self.num_stored += 1
+            if self._total_size is None:
+                # The walk already counts the new entry.
+                self._total_size = self._scan()[1]
+            else:
+                self._total_size += size
+            is_full = self._total_size > self.max_size
+        LOGGER.debug("Cached %s as %s.", filename, entry)
+        if is_full:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used files down to ``max_size``."""
+        with self._lock:
+            entries, total_size = self._scan()
+            entries.sort()
+            for used, size, entry in entries:
+                if total_size <= self.max_size:
+                    break
+                LOGGER.debug("Evicting %s from the cache.", entry)
+                self._remove_files(entry)
+                total_size -= size
+            self._total_size = total_size
+
+    def _scan(self):
+        """
+        Walk the cache, returning a list of ``(last use, size, entry)``
+        and the total size of the entries.
+        """
+        entries = []
+        total_size = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.endswith(self.USED_SUFFIX) or name.startswith('.'):
+                    continue
+                entry = os.path.join(dirpath, name)
+                try:
+                    size = os.path.getsize(entry)
+                except OSError:
+                    continue
+                try:
+                    used = os.path.getmtime(entry + self.USED_SUFFIX)
+                except OSError:
+                    used = 0
+                entries.append((used, size, entry))
+                total_size += size
+        return entries, total_size
+
+    def _remove(self, entry, size):
+        self._remove_files(entry)
+        with self._lock:
+            if self._total_size is not None:
+                self._total_size -= size
+
+    def _remove_files(self, entry):
+        for path in (entry, entry + self.USED_SUFFIX):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _touch(self, entry):
+        used = entry + self.USED_SUFFIX
+        try:
+            with open(used, 'a'):
+                os.utime(used, None)
+        except (IOError, OSError) as e:
+            LOGGER.debug("Could not record the use of %s: %s", entry, e)
+
+
+def place_file(src, dest):
+    """
+    Reflink or copy ``src`` to a temporary file next to ``dest`` and
+    rename it into place, so ``dest`` is never seen partially written.
+    """
+    dirname = os.path.dirname(dest)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    fd, tmp_name = tempfile.mkstemp(dir=dirname, prefix='.wgot-')
+    os.close(fd)
+    try:
+        _clone_or_copy(src, tmp_name)
+        os.rename(tmp_name, dest)
+    except Exception:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+
+def _clone_or_copy(src, dest):
+    with open(src, 'rb') as src_file:
+        with open(dest, 'wb') as dest_file:
+            if not _clone(src_file, dest_file):
+                shutil.copyfileobj(src_file, dest_file, 1024 * 1024)
+    shutil.copystat(src, dest)
+
+
+def _clone(src_file, dest_file):
+    # Shares the blocks of the file where the file system supports it.
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+    except (IOError, OSError):
+        return False
+    return True
+
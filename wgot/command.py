@@ -2,17 +2,21 @@
 """
 EPILOG = __doc__
 
+import io
+import itertools
 import logging
-import os.path
 import pkg_resources
 import requests
 import sys
-from .fileinfo import FileInfo
+from .fileinfo import info_from_url
 from .handler import Handler, StreamHandler
+from .constants import MULTI_THRESHOLD, CHUNKSIZE, MAX_PARTS, \
+    MAX_CACHE_SIZE, MAX_STREAM_BUFFER_SIZE, ASYNC_NUM_REQUESTS, \
+    ASYNC_NUM_PROBES
+from .utils import DownloadJournal, human_readable_to_bytes, uni_print
 from .compat import (
     PY3,
     http_client,
-    parse_qsl,
     urlparse,
 )
 
@@ -35,25 +39,51 @@ def enable_debug_logging():
     http_client.HTTPSConnection.debuglevel = 1
 
 
-def info_from_url(src, is_stream=False):
-    """ read data from url, e.g:
-            http://example.com/path.tgz#md5=1234567890abcd;size=1234
+def read_urls(session, input_file):
+    """ lazily yield the urls listed one per line in a local file, a remote
+        file or, if input_file is '-', the standard input.
     """
-    parsed = urlparse(src)
-    info = {}
-    info['dest'] = os.path.basename(parsed.path)
-    hash_params = dict(parse_qsl(parsed.fragment))
-    if 'md5' in hash_params:
-        info['md5'] = hash_params['md5']
-    if 'size' in hash_params:
-        info['size'] = int(hash_params['size'])
-    if 'filename' in hash_params:
-        info['dest'] = os.path.basename(hash_params['filename'])
-    return FileInfo(src, is_stream=is_stream, **info)
+    resource = None
+    if input_file == '-':
+        lines = sys.stdin
+    elif urlparse(input_file).scheme:
+        response = session.get(input_file, stream=True)
+        response.raise_for_status()
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        lines = response.iter_lines(decode_unicode=True)
+        resource = response
+    else:
+        lines = resource = open(input_file)
+    try:
+        for line in lines:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        if resource is not None:
+            resource.close()
+
+
+def host_limit_rate(value):
+    """ parse a HOST=RATE argument, e.g. example.com=2m
+    """
+    host, sep, rate = value.partition('=')
+    if not sep or not host:
+        raise ValueError("Invalid host rate: %s" % value)
+    return host.lower(), human_readable_to_bytes(rate)
 
 
 def run(debug, input_file, max_redirect, output_document, user, password,
-        quiet, urls, user_agent, version):
+        quiet, urls, user_agent, version, resume=False, fsync=False,
+        mmap=False, pwrite=False, stream_verify='spool', num_threads=None,
+        multipart_threshold=MULTI_THRESHOLD, multipart_chunksize=CHUNKSIZE,
+        max_queue_size=None, max_io_queue_size=None, num_probe_threads=None,
+        auto_tune=False, max_per_host=None, limit_rate=None,
+        host_limit_rates=None, http2=False, sync=False, cache_dir=None,
+        cache_size=MAX_CACHE_SIZE,
+        stream_buffer_size=MAX_STREAM_BUFFER_SIZE, json=None,
+        engine='threads'):
     if version:
         print(default_user_agent())
     if debug:
@@ -68,32 +98,64 @@ def run(debug, input_file, max_redirect, output_document, user, password,
         session.auth = (user, password)
 
     if input_file:
-        if input_file == '-':
-            input_file_data = sys.stdin.read()
-        elif urlparse(input_file).scheme:
-            input_file_data = session.get(input_file).text
-        else:
-            input_file_data = open(input_file).read()
-        urls.extend(
-            line.strip() for line in input_file_data.split('\n')
-            if line.strip())
+        urls = itertools.chain(urls, read_urls(session, input_file))
 
     is_stream = False
     if output_document:
         is_stream = True
         if output_document != '-':
             if PY3:
-                sys.stdout.buffer = open(output_document, 'wb')
+                # The documents are written to ``sys.stdout.buffer``.
+                sys.stdout = io.TextIOWrapper(open(output_document, 'wb'))
             else:
                 sys.stdout = open(output_document, 'wb')
 
-    if is_stream:
-        handler = StreamHandler(
-            {'quiet': True, 'is_stream': True}, session=session)
-    else:
-        handler = Handler({'quiet': quiet}, session=session)
-    fileinfos = [info_from_url(url, is_stream=is_stream) for url in urls]
-    handler.call(fileinfos)
+    transfer_config = {
+        'multi_threshold': multipart_threshold,
+        'chunksize': multipart_chunksize,
+        'num_threads': num_threads,
+        'max_queue_size': max_queue_size,
+        'max_io_queue_size': max_io_queue_size,
+        'num_probe_threads': num_probe_threads,
+        'max_per_host': max_per_host,
+    }
+    handler_class = Handler
+    try:
+        if engine == 'asyncio':
+            if is_stream:
+                raise ValueError("--output-document can't be used with "
+                                 "--engine asyncio")
+            if not PY3:
+                raise ValueError("--engine asyncio requires Python 3")
+            from .aio import AsyncHandler
+            handler_class = AsyncHandler
+        if is_stream:
+            handler = StreamHandler(
+                {'quiet': quiet, 'only_show_errors': True, 'is_stream': True,
+                 'stream_verify': stream_verify,
+                 'stream_buffer_size': stream_buffer_size,
+                 'limit_rate': limit_rate,
+                 'host_limit_rates': host_limit_rates, 'http2': http2,
+                 'json': json},
+                session=session,
+                **transfer_config)
+        else:
+            handler = handler_class(
+                {'quiet': quiet, 'resume': resume, 'fsync': fsync,
+                 'mmap': mmap, 'pwrite': pwrite, 'auto_tune': auto_tune,
+                 'limit_rate': limit_rate,
+                 'host_limit_rates': host_limit_rates, 'http2': http2,
+                 'sync': sync, 'cache_dir': cache_dir,
+                 'cache_size': cache_size, 'json': json},
+                session=session, **transfer_config)
+    except ValueError as e:
+        uni_print(u'wgot: error: %s\n' % e, sys.stderr)
+        return 2
+    fileinfos = (info_from_url(url, is_stream=is_stream) for url in urls)
+    result = handler.call(fileinfos)
+    if result.num_tasks_failed:
+        return 1
+    return 0
 
 
 def main():
@@ -105,8 +167,48 @@ def main():
     )
     parser.add_argument(
         'urls', metavar='URL', default=[], nargs='*', help="URLs to download")
+    parser.add_argument(
+        '--auto-tune', action='store_true',
+        help="Adjust the number of parts downloaded at once, up to "
+        "--num-threads, and the part size of files not yet started to the "
+        "throughput observed.  Decisions are logged with --debug.  Not "
+        "used with --output-document.")
+    parser.add_argument(
+        '-c', '--continue', action='store_true', dest='resume',
+        help="Continue getting partially-downloaded files.  The parts "
+        "completed by a previous run are recorded in a '%s' file next to "
+        "the download." % DownloadJournal.SUFFIX)
+    parser.add_argument(
+        '--cache-dir', metavar='DIR',
+        help="Keep the downloaded files with a known md5 in DIR, and make "
+        "files with the same md5 from them rather than downloading them "
+        "again.  Files are reflinked where possible, otherwise copied.")
+    parser.add_argument(
+        '--cache-size', metavar='SIZE', default=MAX_CACHE_SIZE,
+        type=human_readable_to_bytes,
+        help="The size the cache is kept to by evicting the least recently "
+        "used files, e.g. 100GB.  The default is %s bytes." %
+        MAX_CACHE_SIZE)
     parser.add_argument(
         '-d', '--debug', action='store_true', help="Turn on debug output")
+    parser.add_argument(
+        '--engine', choices=['threads', 'asyncio'], default='threads',
+        help="How the downloads are run.  'threads' runs each on a thread "
+        "of its own, 'asyncio' runs them as coroutines on an event loop, "
+        "so many more small files can be downloaded at once.  'asyncio' is "
+        "experimental, it has not been found to be faster than the best "
+        "number of threads.  It requires Python 3 and the httpx package, "
+        "and can't be used with --output-document or --mmap.  The default "
+        "is 'threads'.")
+    parser.add_argument(
+        '--fsync', action='store_true',
+        help="Flush each downloaded file to disk before reporting it as "
+        "complete.")
+    parser.add_argument(
+        '--http2', action='store_true',
+        help="Make https requests over HTTP/2 where the server supports it, "
+        "so the parts of a file share a connection.  Requires the httpx "
+        "and h2 packages.")
     parser.add_argument(
         '-i', '--input-file',
         help="Read URLs from a local or external file."
@@ -116,12 +218,97 @@ def main():
         help="Specifies the maximum number of redirections to follow for a "
         "resource. The default is 20, which is usually far more than "
         "necessary.")
+    parser.add_argument(
+        '--mmap', action='store_true',
+        help="Preallocate large files and read their parts straight into "
+        "a memory mapping of the file.")
+    parser.add_argument(
+        '--multipart-chunksize', metavar='SIZE', default=CHUNKSIZE,
+        type=human_readable_to_bytes,
+        help="The size of the parts of a multipart download, e.g. 8MB.  It "
+        "is raised for files that would otherwise have more than %s "
+        "parts.  The default is %s bytes." % (MAX_PARTS, CHUNKSIZE))
+    parser.add_argument(
+        '--multipart-threshold', metavar='SIZE', default=MULTI_THRESHOLD,
+        type=human_readable_to_bytes,
+        help="Files larger than this are downloaded in parts, e.g. 64MB.  "
+        "It must be at least the chunksize.  The default is %s bytes." %
+        MULTI_THRESHOLD)
+    parser.add_argument(
+        '-N', '--timestamping', action='store_true', dest='sync',
+        help="Skip files whose local copy is up to date, going by its size, "
+        "ETag, last modified time or md5.  Small files are requested "
+        "with If-None-Match or If-Modified-Since instead.")
+    parser.add_argument(
+        '--num-threads', metavar='N', type=int,
+        help="The number of concurrent downloads.  The default is %s, %s "
+        "with --output-document or %s with --engine asyncio." % (
+            Handler.EXECUTOR_NUM_THREADS, StreamHandler.EXECUTOR_NUM_THREADS,
+            ASYNC_NUM_REQUESTS))
+    parser.add_argument(
+        '--num-probe-threads', metavar='N', type=int,
+        help="The number of concurrent HEAD requests for files whose size "
+        "is not known.  The default is %s, or %s with --engine asyncio." % (
+            Handler.PROBE_NUM_THREADS, ASYNC_NUM_PROBES))
+    parser.add_argument(
+        '--json', metavar='FILE',
+        help="Write an event for the start and end of each file, and the "
+        "end of each part, as a line of JSON to FILE, or to the file "
+        "descriptor FILE if it is a number, e.g. --json 3 3>events.jsonl.  "
+        "The events have the bytes, duration, retries, HTTP status and md5 "
+        "result of the file or part.  A summary event at the end has the "
+        "rate at which the metadata of the files was probed, and the "
+        "number of requests made over how many connections.")
+    parser.add_argument(
+        '--limit-rate', metavar='RATE', type=human_readable_to_bytes,
+        help="Limit the download speed of all downloads together to RATE "
+        "bytes per second, e.g. 20k or 2MB.")
+    parser.add_argument(
+        '--limit-rate-host', metavar='HOST=RATE', type=host_limit_rate,
+        action='append', dest='host_limit_rates',
+        help="Limit the download speed from HOST to RATE bytes per second, "
+        "e.g. example.com=2m.  May be given more than once.")
+    parser.add_argument(
+        '--max-per-host', metavar='N', type=int,
+        help="The maximum number of downloads in flight to any one host.  "
+        "Downloads take turns between hosts regardless.  Not used with "
+        "--output-document.")
+    parser.add_argument(
+        '--max-queue-size', metavar='N', type=int,
+        help="The maximum number of tasks waiting for a thread.  The "
+        "default is %s, or %s with --output-document." % (
+            Handler.MAX_EXECUTOR_QUEUE_SIZE,
+            StreamHandler.MAX_EXECUTOR_QUEUE_SIZE))
+    parser.add_argument(
+        '--max-io-queue-size', metavar='N', type=int,
+        help="The maximum number of chunks waiting to be written by the IO "
+        "thread.  The default is %s." % Handler.MAX_IO_QUEUE_SIZE)
     parser.add_argument(
         '-O', '--output-document', metavar='file',
         help="The documents will not be written to the appropriate files, "
-        "but all will be concatenated together and written to file."
+        "but all will be concatenated together, in the order given, and "
+        "written to file."
         " If '-'' is used as file, documents will be printed to standard "
         "output.")
+    parser.add_argument(
+        '--pwrite', action='store_true',
+        help="Write the parts of large files with positional writes from the "
+        "threads downloading them rather than through the IO thread.  "
+        "Requires os.pwrite.")
+    parser.add_argument(
+        '--stream-buffer-size', metavar='SIZE',
+        default=MAX_STREAM_BUFFER_SIZE, type=human_readable_to_bytes,
+        help="The memory used to hold the parts and documents of "
+        "--output-document that finish downloading before the one being "
+        "written, e.g. 256MB.  The default is %s bytes." %
+        MAX_STREAM_BUFFER_SIZE)
+    parser.add_argument(
+        '--stream-verify', choices=['spool', 'after'], default='spool',
+        help="How documents with an md5 are verified when written to "
+        "--output-document.  'spool' holds each document back in a "
+        "temporary file until it has been verified, 'after' writes it "
+        "through and exits with an error if it did not match.  The "
+        "default is 'spool'.")
     parser.add_argument(
         '-q', '--quiet', action='store_true', help="Turn off output")
     parser.add_argument(
@@ -136,8 +323,10 @@ def main():
         '--version', action='store_true', help='Print version and exit')
 
     args = parser.parse_args()
+    if args.host_limit_rates is not None:
+        args.host_limit_rates = dict(args.host_limit_rates)
     return run(**vars(args))
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -22,3 +22,10 @@ else:
     import Queue as queue
     from urlparse import urlparse, parse_qsl
     import httplib as http_client
+
+try:
+    from concurrent.futures import TimeoutError
+except ImportError:
+    # Python 2 without the futures backport.
+    class TimeoutError(Exception):
+        pass
@@ -13,8 +13,17 @@
 MULTI_THRESHOLD = 8 * (1024 ** 2)
 CHUNKSIZE = 7 * (1024 ** 2)
 NUM_THREADS = 10
+NUM_PROBE_THREADS = 10
+# The downloads and HEAD requests in flight at once with the asyncio engine.
+ASYNC_NUM_REQUESTS = 1000
+ASYNC_NUM_PROBES = 1000
+WORKER_STACK_SIZE = 512 * 1024
 QUEUE_TIMEOUT_WAIT = 0.2
 MAX_PARTS = 950
 MAX_SINGLE_UPLOAD_SIZE = 5 * (1024 ** 3)
 MAX_UPLOAD_SIZE = 5 * (1024 ** 4)
 MAX_QUEUE_SIZE = 1000
+MAX_SPOOL_MEMORY_SIZE = 8 * (1024 ** 2)
+POOL_NUM_HOSTS = 10
+MAX_CACHE_SIZE = 10 * (1024 ** 3)
+MAX_STREAM_BUFFER_SIZE = 64 * (1024 ** 2)
@@ -0,0 +1,76 @@
+import threading
+
+from .fileinfo import FileInfo, info_from_url
+from .futures import DownloadFuture
+from .handler import Handler
+
+
+class Downloader(object):
+    """
+    Downloads files from Python rather than the command line, e.g.::
+
+        with Downloader(num_threads=4) as downloader:
+            for future in downloader.download(urls):
+                print(future.result().num_bytes)
+
+    ``params`` are those of ``Handler``, e.g. ``resume`` or
+    ``limit_rate``, and the other keyword arguments its transfer settings,
+    e.g. ``num_threads`` or ``chunksize``.  The threads and connections
+    are kept for every batch of files given to ``download`` until the
+    downloader is closed.
+
+    If given, ``session`` is used for every request.  Its adapters are
+    kept, except requests' own ``HTTPAdapter``, which is replaced by one
+    with a connection for each thread, keeping its ``max_retries``, see
+    ``mount_pooled_adapters``.
+    """
+    def __init__(self, session=None, params=None, **kwargs):
+        handler_params = {'quiet': True}
+        if params:
+            handler_params.update(params)
+        self._handler = Handler(handler_params, session=session, **kwargs)
+        self._handler.start()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def download(self, files, progress_callback=None):
+        """
+        Downloads ``files``, urls as given on the command line or
+        ``FileInfo`` objects, and returns a ``DownloadFuture`` for each,
+        in the same order.  It returns once they have all been queued,
+        which may take as long as the last of them to start.
+
+        If given, ``progress_callback`` is called with the future of a
+        file and the number of bytes of each read of it.
+        """
+        filenames = [self._fileinfo(f) for f in files]
+        futures = [DownloadFuture(f, progress_callback,
+                                  reporter=self._handler.reporter)
+                   for f in filenames]
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Cannot download after the downloader "
+                                   "has been closed")
+            self._handler.submit(filenames, futures)
+        return futures
+
+    def close(self):
+        """
+        Waits for the files given to ``download`` and stops the threads.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._handler.close()
+
+    def _fileinfo(self, filename):
+        if isinstance(filename, FileInfo):
+            return filename
+        return info_from_url(filename)
@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import threading
+from collections import namedtuple
+
+
+LOGGER = logging.getLogger(__name__)
+
+# A file has started downloading.
+FileStartEvent = namedtuple('FileStartEvent',
+                            ['time', 'src', 'dest', 'size'])
+# A part of a multipart download is done, or failed if ``error`` is set.
+PartEvent = namedtuple('PartEvent',
+                       ['time', 'src', 'dest', 'part_number', 'num_bytes',
+                        'duration', 'retries', 'http_status', 'error'])
+# A file is done, see ``DownloadResult`` for the fields.  ``status`` is
+# 'failed' if ``error`` is set.  ``md5_verified`` is None if the md5 of the
+# file is not known, otherwise whether the data downloaded for the file,
+# or for the file it was copied from, was compared with it and matched.
+FileEvent = namedtuple('FileEvent',
+                       ['time', 'src', 'dest', 'status', 'size', 'num_bytes',
+                        'duration', 'retries', 'http_status', 'md5',
+                        'md5_verified', 'error'])
+# The handler is done, with the number of HEAD requests made to probe the
+# metadata of the files, the seconds spent resolving it and their ratio,
+# and the number of requests made over how many connections, the rest of
+# the requests having reused a kept-alive connection.
+SummaryEvent = namedtuple('SummaryEvent',
+                          ['time', 'num_probes', 'probe_duration',
+                           'probes_per_second', 'num_requests',
+                           'num_connections'])
+
+EVENT_TYPES = {
+    FileStartEvent: 'file_start',
+    PartEvent: 'part',
+    FileEvent: 'file',
+    SummaryEvent: 'summary',
+}
+
+# The keys and the leading value of the JSON of each type of event.  Zipping
+# them with the event is about twice as fast as going through _asdict().
+_EVENT_KEYS = dict((event_type, (('event',) + event_type._fields, (name,)))
+                   for event_type, name in EVENT_TYPES.items())
+_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+
+class JsonReporter(object):
+    """
+    Writes each event reported to it as a line of JSON to ``fileobj``,
+    e.g.::
+
+        {"event":"file","time":1476662400.0,"src":"https://...",...}
+
+    Events may be reported from any thread.  Each line is flushed as it is
+    written, so the events can be followed as they happen.  An error
+    writing them is logged rather than failing the downloads.
+    """
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @classmethod
+    def open(cls, output):
+        """
+        Returns a reporter writing to the file descriptor ``output`` if it
+        is a number, or to the file at the path ``output`` otherwise.
+        """
+        try:
+            if output.isdigit():
+                fileobj = os.fdopen(int(output), 'w')
+            else:
+                fileobj = open(output, 'w')
+        except (IOError, OSError) as e:
+            raise ValueError("Cannot write events to %s: %s" % (output, e))
+        return cls(fileobj)
+
+    def report(self, event):
+        keys, name = _EVENT_KEYS[type(event)]
+        line = _ENCODER.encode(dict(zip(keys, name + event))) + '\n'
+        with self._lock:
+            if self._closed:
+                return
+            try:
+                self._fileobj.write(line)
+                self._fileobj.flush()
+            except (IOError, OSError, ValueError) as e:
+                LOGGER.debug("Error writing event: %s", e, exc_info=True)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            try:
+                self._fileobj.close()
+            except (IOError, OSError) as e:
+                LOGGER.debug("Error closing events: %s", e, exc_info=True)
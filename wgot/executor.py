@@ -11,11 +11,14 @@
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
 import logging
+import os
 import sys
 import threading
+import time
 
 from .utils import uni_print, bytes_print, \
-    IORequest, IOCloseRequest, StablePriorityQueue
+    IORequest, IOCloseRequest, IOCallbackRequest, PrintCallbackRequest, \
+    ProbeResult, HostFairQueue, StablePriorityQueue
 from .tasks import OrderableTask
 from .compat import queue
 
@@ -41,11 +44,24 @@ class Executor(object):
     IMMEDIATE_PRIORITY= 1
 
     def __init__(self, num_threads, result_queue, quiet,
-                 only_show_errors, max_queue_size, write_queue):
+                 only_show_errors, max_queue_size, write_queue,
+                 buffer_pool=None, worker_stack_size=None,
+                 fair_host_scheduling=False, max_per_host=None):
         self._max_queue_size = max_queue_size
-        self.queue = StablePriorityQueue(maxsize=self._max_queue_size,
-                                         max_priority=20)
+        if fair_host_scheduling:
+            # Tasks take turns between hosts, with at most max_per_host
+            # of them in flight for each.
+            self.queue = HostFairQueue(maxsize=self._max_queue_size,
+                                       max_priority=20,
+                                       max_per_host=max_per_host)
+        else:
+            self.queue = StablePriorityQueue(maxsize=self._max_queue_size,
+                                             max_priority=20)
         self.num_threads = num_threads
+        # Worker threads spend their time waiting on sockets, so they can
+        # do with a much smaller stack than the platform default.  This
+        # keeps the cost of running thousands of them low.
+        self.worker_stack_size = worker_stack_size
         self.result_queue = result_queue
         self.quiet = quiet
         self.only_show_errors = only_show_errors
@@ -54,7 +70,7 @@ class Executor(object):
         self.print_thread = PrintThread(self.result_queue, self.quiet,
                                         self.only_show_errors)
         self.print_thread.daemon = True
-        self.io_thread = IOWriterThread(self.write_queue)
+        self.io_thread = IOWriterThread(self.write_queue, buffer_pool)
 
     @property
     def num_tasks_failed(self):
@@ -77,11 +93,24 @@ class Executor(object):
         # explicit about it rather than relying on the threads_list order.
         # See .join() for more info.
         self.print_thread.start()
-        for i in range(self.num_threads):
-            worker = Worker(queue=self.queue)
-            worker.setDaemon(True)
-            self.threads_list.append(worker)
-            worker.start()
+        previous_stack_size = self._set_stack_size(self.worker_stack_size)
+        try:
+            for i in range(self.num_threads):
+                worker = Worker(queue=self.queue)
+                worker.setDaemon(True)
+                self.threads_list.append(worker)
+                worker.start()
+        finally:
+            self._set_stack_size(previous_stack_size)
+
+    def _set_stack_size(self, stack_size):
+        if stack_size is None:
+            return None
+        try:
+            return threading.stack_size(stack_size)
+        except (ValueError, threading.ThreadError) as e:
+            LOGGER.debug("Could not set thread stack size: %s", e)
+            return None
 
     def submit(self, task):
         """
@@ -90,6 +119,14 @@ class Executor(object):
         LOGGER.debug("Submitting task: %s", task)
         self.queue.put(task)
 
+    def wait_for_results(self):
+        """Block until the results queued so far have been printed."""
+        printed = threading.Event()
+        self.result_queue.put(PrintCallbackRequest(printed.set))
+        # Waiting in steps keeps the main thread interruptible.
+        while not printed.wait(1):
+            pass
+
     def initiate_shutdown(self, priority=STANDARD_PRIORITY):
         """Instruct all threads to shutdown.
 
@@ -140,9 +177,10 @@ class Executor(object):
 
 
 class IOWriterThread(threading.Thread):
-    def __init__(self, queue):
+    def __init__(self, queue, buffer_pool=None):
         threading.Thread.__init__(self)
         self.queue = queue
+        self.buffer_pool = buffer_pool
         self.fd_descriptor_cache = {}
 
     def run(self):
@@ -156,8 +194,8 @@ class IOWriterThread(threading.Thread):
             elif isinstance(task, IORequest):
                 filename, offset, data, is_stream = task
                 if is_stream:
-                    fileobj = sys.stdout
                     bytes_print(data)
+                    sys.stdout.flush()
                 else:
                     fileobj = self.fd_descriptor_cache.get(filename)
                     if fileobj is None:
@@ -167,14 +205,30 @@ class IOWriterThread(threading.Thread):
                     fileobj.write(data)
                 LOGGER.debug("Writing data to: %s, offset: %s",
                              filename, offset)
-                fileobj.flush()
+                if self.buffer_pool is not None and \
+                        isinstance(data, memoryview):
+                    self.buffer_pool.release(data)
             elif isinstance(task, IOCloseRequest):
                 LOGGER.debug("IOCloseRequest received for %s, closing file.",
                              task.filename)
                 fileobj = self.fd_descriptor_cache.get(task.filename)
                 if fileobj is not None:
+                    fileobj.flush()
+                    if task.fsync:
+                        os.fsync(fileobj.fileno())
                     fileobj.close()
                     del self.fd_descriptor_cache[task.filename]
+            elif isinstance(task, IOCallbackRequest):
+                # Whatever the callback does must see the writes queued
+                # before it, so they have to leave our buffers first.
+                fileobj = self.fd_descriptor_cache.get(task.filename)
+                if fileobj is not None:
+                    fileobj.flush()
+                try:
+                    task.callback()
+                except Exception as e:
+                    LOGGER.debug("Error calling IO callback for %s: %s",
+                                 task.filename, e, exc_info=True)
 
     def _cleanup(self):
         for fileobj in self.fd_descriptor_cache.values():
@@ -204,10 +258,350 @@ class Worker(threading.Thread):
                     function()
                 except Exception as e:
                     LOGGER.debug('Error calling task: %s', e, exc_info=True)
+                finally:
+                    self.queue.release(function)
             except queue.Empty:
                 pass
 
 
+class MetadataResolver(object):
+    """
+    This class resolves the metadata (size, md5, destination) of
+    ``FileInfo`` objects with a bounded pool of ``MetadataProbeThread``
+    threads.  Results are yielded as soon as each probe returns, so the
+    caller can start submitting download tasks while the remaining HEAD
+    requests are still in flight.  Files whose size is already known are
+    passed through without being probed, unless ``needs_probe`` is given
+    and returns True for them.
+
+    If ``ordered`` is set, results are yielded in the order of the input
+    files instead, holding back at most a window of completed probes.
+    This is needed when the output of the files is concatenated.
+
+    If given, ``host_limiter`` is the queue of the ``Executor``, so the
+    probes count towards its limit of requests in flight to each host.
+
+    Subclasses probe some other way by overriding ``_create_probe_threads``.
+    """
+    def __init__(self, session, num_threads, ordered=False,
+                 needs_probe=None, host_limiter=None):
+        self.session = session
+        self.num_threads = num_threads
+        self.ordered = ordered
+        self.needs_probe = needs_probe
+        self.host_limiter = host_limiter
+        self.num_probes = 0
+        self.elapsed = 0.0
+        self._feed_error = None
+
+    def resolve(self, files):
+        """
+        Yield a ``ProbeResult`` and its tag for every ``FileInfo`` and tag
+        pair in ``files``, the tag being anything to keep with the file,
+        e.g. its ``DownloadFuture``.  If the generator is closed before
+        the end, no more files are read and the threads are left to
+        finish the probes under way, with their results discarded.
+        """
+        probe_queue = queue.Queue(maxsize=self.num_threads * 2)
+        resolved_queue = queue.Queue(maxsize=self.num_threads * 2)
+        window = None
+        if self.ordered:
+            window = threading.Semaphore(self.num_threads * 4)
+        threads = self._create_probe_threads(probe_queue, resolved_queue)
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        stopped = threading.Event()
+        # The tag of each file by its sequence, until its result is
+        # yielded.
+        tags = {}
+        feeder = threading.Thread(
+            target=self._feed,
+            args=(files, tags, probe_queue, resolved_queue, window,
+                  stopped, len(threads)))
+        feeder.daemon = True
+        start_time = time.time()
+        feeder.start()
+        num_running = len(threads)
+        pending = {}
+        next_sequence = 0
+        try:
+            while num_running:
+                item = resolved_queue.get(True)
+                if isinstance(item, ShutdownThreadRequest):
+                    num_running -= 1
+                    continue
+                if not self.ordered:
+                    yield item[1], tags.pop(item[0])
+                    continue
+                pending[item[0]] = item[1]
+                while next_sequence in pending:
+                    yield pending.pop(next_sequence), \
+                        tags.pop(next_sequence)
+                    next_sequence += 1
+                    window.release()
+        finally:
+            if num_running:
+                # Closed early, e.g. as the caller failed.  The feeder and
+                # the probe threads would block on the full queues if
+                # nothing read them any more.
+                stopped.set()
+                drainer = threading.Thread(
+                    target=self._drain,
+                    args=(resolved_queue, num_running, window,
+                          len(pending) + 1))
+                drainer.daemon = True
+                drainer.start()
+        elapsed = time.time() - start_time
+        num_probes = sum(thread.num_probes for thread in threads)
+        LOGGER.debug("Resolved metadata of %s file(s) in %.2f seconds.",
+                     num_probes, elapsed)
+        # The totals of every call, for the summary of a handler kept
+        # across calls.
+        self.elapsed += elapsed
+        self.num_probes += num_probes
+        if self._feed_error is not None:
+            raise self._feed_error
+
+    def _create_probe_threads(self, probe_queue, resolved_queue):
+        """
+        Returns the threads, not yet started, that take the files to probe
+        from ``probe_queue`` until they get a ``ShutdownThreadRequest``,
+        pass it on to ``resolved_queue`` along with the results, and count
+        their ``num_probes``.
+        """
+        return [MetadataProbeThread(self.session, probe_queue,
+                                    resolved_queue, self.host_limiter)
+                for i in range(self.num_threads)]
+
+    @property
+    def probes_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.num_probes / self.elapsed
+
+    def _feed(self, files, tags, probe_queue, resolved_queue, window,
+              stopped, num_threads):
+        try:
+            for sequence, (filename, tag) in enumerate(files):
+                if stopped.is_set():
+                    break
+                tags[sequence] = tag
+                if window is not None:
+                    window.acquire()
+                if filename.size is None or (
+                        self.needs_probe is not None and
+                        self.needs_probe(filename)):
+                    probe_queue.put((sequence, filename))
+                else:
+                    resolved_queue.put(
+                        (sequence, ProbeResult(filename, None)))
+        except Exception as e:
+            LOGGER.debug('Error reading files to resolve: %s', e,
+                         exc_info=True)
+            self._feed_error = e
+        finally:
+            for i in range(num_threads):
+                probe_queue.put(ShutdownThreadRequest())
+
+    def _drain(self, resolved_queue, num_running, window, num_held):
+        # Frees the window held by results that will not be yielded, and
+        # the one being yielded when closed, so the feeder can finish.
+        if window is not None:
+            for i in range(num_held):
+                window.release()
+        while num_running:
+            item = resolved_queue.get(True)
+            if isinstance(item, ShutdownThreadRequest):
+                num_running -= 1
+            elif window is not None:
+                window.release()
+        LOGGER.debug("Discarded the metadata probes of a closed resolve.")
+
+
+class MetadataProbeThread(threading.Thread):
+    """
+    This thread issues a HEAD request for each ``FileInfo`` pulled from
+    ``probe_queue`` and passes the result on to ``resolved_queue``.  If
+    given, the requests wait for room under the per host limit of
+    ``host_limiter``.
+    """
+    def __init__(self, session, probe_queue, resolved_queue,
+                 host_limiter=None):
+        threading.Thread.__init__(self)
+        self.session = session
+        self.probe_queue = probe_queue
+        self.resolved_queue = resolved_queue
+        self.host_limiter = host_limiter
+        self.num_probes = 0
+
+    def run(self):
+        while True:
+            item = self.probe_queue.get(True)
+            if isinstance(item, ShutdownThreadRequest):
+                LOGGER.debug("Shutdown request received in probe thread, "
+                             "shutting down probe thread.")
+                self.resolved_queue.put(item)
+                break
+            sequence, filename = item
+            error = None
+            try:
+                self._probe(filename)
+            except Exception as e:
+                LOGGER.debug('Error probing %s: %s', filename.src, e,
+                             exc_info=True)
+                error = e
+            self.num_probes += 1
+            self.resolved_queue.put((sequence, ProbeResult(filename, error)))
+
+    def _probe(self, filename):
+        if self.host_limiter is None:
+            host = None
+        else:
+            host = filename.host
+            self.host_limiter.acquire_host(host)
+        try:
+            response = self.session.head(filename.src, allow_redirects=True)
+        finally:
+            if host is not None:
+                self.host_limiter.release_host(host)
+        set_info_from_probe(filename, response)
+
+
+def set_info_from_probe(filename, response):
+    """Sets the metadata of ``filename`` from the response to its HEAD."""
+    if response.status_code in (405, 501):
+        # The server does not do HEAD requests, the GET will tell.
+        LOGGER.debug("Could not probe %s: %s", filename.src,
+                     response.status_code)
+        return
+    filename.set_info_from_headers(response)
+
+
+class ThroughputTuner(object):
+    """
+    Adjusts the number of parts downloaded at once, and the part size of
+    the files that have not been planned yet, from the throughput observed
+    while downloading parts.
+
+    Every window of completed parts the aggregate throughput of the window
+    is compared with the previous one.  The concurrency keeps moving in
+    the same direction while the throughput improves by more than
+    ``IMPROVEMENT`` and turns around when it does not.  If the throughput
+    of each connection collapses below ``BACKOFF_RATIO`` of the best seen
+    while the aggregate falls, the concurrency is halved.  Part sizes are
+    chosen so a part takes about ``TARGET_PART_SECONDS`` on one
+    connection.
+    """
+    IMPROVEMENT = 1.05
+    BACKOFF_RATIO = 0.5
+    MIN_WINDOW = 4
+    TARGET_PART_SECONDS = 4
+    MAX_CHUNKSIZE_GROWTH = 8
+    CHUNKSIZE_ALIGNMENT = 1024 * 1024
+
+    def __init__(self, max_concurrency, initial_concurrency=None):
+        self.max_concurrency = max_concurrency
+        if initial_concurrency is None:
+            initial_concurrency = min(self.MIN_WINDOW, max_concurrency)
+        self.concurrency = initial_concurrency
+        self._direction = 1
+        self._active = 0
+        self._condition = threading.Condition(threading.Lock())
+        self._window_start = None
+        self._window_bytes = 0
+        self._window_seconds = 0.0
+        self._window_parts = 0
+        self._last_throughput = None
+        self._best_connection_throughput = 0.0
+        self._connection_throughput = None
+
+    def acquire(self):
+        """Block until another part may be downloaded."""
+        with self._condition:
+            while self._active >= self.concurrency:
+                self._condition.wait()
+            self._active += 1
+            if self._window_start is None:
+                self._window_start = time.time()
+
+    def release(self, num_bytes, elapsed):
+        """Record a part of ``num_bytes`` downloaded in ``elapsed`` seconds."""
+        with self._condition:
+            self._active -= 1
+            self._window_bytes += num_bytes
+            self._window_seconds += elapsed
+            self._window_parts += 1
+            if self._window_parts >= max(2 * self.concurrency,
+                                         self.MIN_WINDOW):
+                self._end_window()
+            self._condition.notify_all()
+
+    def suggest_chunksize(self, size, chunksize):
+        """
+        Return the part size to use for a file of ``size`` bytes.  It is
+        never smaller than ``chunksize`` and leaves the file enough parts
+        to use every connection.
+        """
+        with self._condition:
+            connection_throughput = self._connection_throughput
+            concurrency = self.concurrency
+        if not connection_throughput:
+            return chunksize
+        suggested = int(connection_throughput * self.TARGET_PART_SECONDS)
+        alignment = self.CHUNKSIZE_ALIGNMENT
+        suggested = (suggested + alignment - 1) // alignment * alignment
+        suggested = min(suggested, chunksize * self.MAX_CHUNKSIZE_GROWTH,
+                        size // concurrency)
+        return max(chunksize, suggested)
+
+    def _end_window(self):
+        elapsed = time.time() - self._window_start
+        throughput = self._window_bytes / max(elapsed, 1e-6)
+        connection_throughput = self._window_bytes / max(
+            self._window_seconds, 1e-6)
+        self._connection_throughput = connection_throughput
+        self._best_connection_throughput = max(
+            self._best_connection_throughput, connection_throughput)
+        previous = self.concurrency
+        if self._last_throughput is None:
+            reason = "first measurement"
+        elif throughput < self._last_throughput and \
+                connection_throughput < (self.BACKOFF_RATIO *
+                                         self._best_connection_throughput):
+            self.concurrency = max(1, self.concurrency // 2)
+            self._direction = -1
+            reason = "per connection throughput collapsed"
+        elif throughput > self._last_throughput * self.IMPROVEMENT:
+            reason = "throughput improved"
+        else:
+            self._direction = -self._direction
+            reason = "throughput did not improve"
+        if previous == self.concurrency:
+            step = max(1, self.concurrency // 8)
+            self.concurrency = min(self.max_concurrency, max(
+                1, self.concurrency + self._direction * step))
+        LOGGER.debug(
+            "Auto-tune: %.0f bytes/s over %s parts (%.0f bytes/s per "
+            "connection) at a concurrency of %s, %s; concurrency is now %s.",
+            throughput, self._window_parts, connection_throughput, previous,
+            reason, self.concurrency)
+        self._last_throughput = throughput
+        self._window_start = time.time()
+        self._window_bytes = 0
+        self._window_seconds = 0.0
+        self._window_parts = 0
+
+    def log_summary(self):
+        if self._connection_throughput is None:
+            LOGGER.debug("Auto-tune made no measurements, the concurrency "
+                         "stayed at %s.", self.concurrency)
+            return
+        LOGGER.debug("Auto-tune settled on a concurrency of %s with %.0f "
+                     "bytes/s per connection.", self.concurrency,
+                     self._connection_throughput)
+
+
 class PrintThread(threading.Thread):
     """
     This thread controls the printing of results.  When a task is
@@ -269,6 +663,9 @@ class PrintThread(threading.Thread):
                     LOGGER.debug("Shutdown request received in print thread, "
                                  "shutting down print thread.")
                     break
+                elif isinstance(print_task, PrintCallbackRequest):
+                    print_task.callback()
+                    continue
                 LOGGER.debug("Received print task: %s", print_task)
                 try:
                     self._process_print_task(print_task)
@@ -1,80 +1,157 @@
 import cgi
 import os
 import sys
+import tempfile
 import time
 from functools import partial
 import binascii
 import errno
 import hashlib
 
-from .compat import urlparse
-from .utils import MD5Error, StreamingBody, bytes_print, date_parser
+import requests
+
+from .compat import parse_qsl, urlparse
+from .constants import MAX_SPOOL_MEMORY_SIZE
+from email.utils import formatdate
+
+from .utils import MD5Error, StreamMD5Error, StreamingBody, bytes_print, \
+    date_parser, get_file_stat, get_local_etag, set_local_etag
 
 
 class CreateDirectoryError(Exception):
     pass
 
 
-def save_file(filename, response, last_update, md5_hex, is_stream=False):
+def check_status(response, expected=None):
+    """
+    Raises a ``requests.HTTPError`` unless ``response`` has the
+    ``expected`` status or, if not given, any successful one.
+    """
+    status = response.status_code
+    if status == expected or expected is None and 200 <= status < 300:
+        return
+    response.close()
+    message = "%s %s for url: %s" % (status, response.reason or '',
+                                     response.url)
+    if expected is not None:
+        message += " (expected %s)" % expected
+    raise requests.HTTPError(message, response=response)
+
+
+def save_file(filename, response, last_update, md5_hex, is_stream=False,
+              stream_verify='spool', throttle=None, stream_write=None,
+              read_size=None):
     """
     This writes to the file upon downloading.  It reads the data in the
     response.  Makes a new directory if needed and then writes the
     data to the file.  It also modifies the last modified time to that
     of the S3 object.
+
+    When writing to a stream with an md5 to check, ``stream_verify``
+    decides how: ``'spool'`` holds the data back in a temporary file until
+    it has been verified, ``'after'`` writes it through and raises a
+    ``StreamMD5Error`` afterwards if it did not match.
+
+    If given, ``throttle`` is called with the size of each read to limit
+    the download rate, and the reads are no larger than ``read_size``.
+    If given, ``stream_write`` is called with the data to write to a
+    stream rather than writing it to standard out.
+
+    Returns the md5 of the data, which is computed whether or not
+    ``md5_hex`` is given.
     """
-    body = StreamingBody(response)
+    body = StreamingBody(response, throttle)
+    if stream_write is None:
+        stream_write = bytes_print
+    if read_size is None:
+        read_size = 1024 * 1024
 
     if not is_stream:
-        d = os.path.dirname(filename)
-        try:
-            if not os.path.exists(d):
-                os.makedirs(d)
-        except OSError as e:
-            if not e.errno == errno.EEXIST:
-                raise CreateDirectoryError(
-                    "Could not create directory %s: %s" % (d, e))
+        prepare_local_file(filename)
     md5 = hashlib.md5()
-    file_chunks = iter(partial(body.read, 1024 * 1024), b'')
-    if is_stream:
+    file_chunks = iter(partial(body.read, read_size), b'')
+    if is_stream and md5_hex and stream_verify == 'spool':
         # Need to save the data to be able to check the etag for a stream
         # becuase once the data is written to the stream there is no
-        # undoing it.
-        payload = write_to_file(None, md5_hex, md5, file_chunks, True)
+        # undoing it.  Only the start of it is kept in memory.
+        with tempfile.SpooledTemporaryFile(
+                max_size=MAX_SPOOL_MEMORY_SIZE) as spool:
+            write_to_file(spool, md5_hex, md5, file_chunks)
+            if md5_hex != md5.hexdigest():
+                raise MD5Error(filename)
+            spool.seek(0)
+            write_to_file(None, None, None,
+                          iter(partial(spool.read, 1024 * 1024), b''), True,
+                          stream_write)
+    elif is_stream:
+        write_to_file(None, md5_hex, md5, file_chunks, True, stream_write)
     else:
-        with open(filename, 'wb') as out_file:
-            write_to_file(out_file, md5_hex, md5, file_chunks)
+        try:
+            with open(filename, 'wb') as out_file:
+                write_to_file(out_file, md5_hex, md5, file_chunks)
+        except Exception:
+            # Don't leave a partial file behind, it could be taken for an
+            # up to date one.
+            if os.path.exists(filename):
+                os.remove(filename)
+            raise
 
     if md5_hex:
         if md5_hex != md5.hexdigest():
-            if not is_stream:
-                os.remove(filename)
+            if is_stream:
+                raise StreamMD5Error(
+                    "md5 of data written to the stream did not match %s" %
+                    md5_hex)
+            os.remove(filename)
             raise MD5Error(filename)
 
-    if not is_stream and last_update:
+    if not is_stream:
+        set_last_update(filename, last_update)
+    elif stream_write is bytes_print:
+        sys.stdout.flush()
+    return md5.hexdigest()
+
+
+def prepare_local_file(filename):
+    """
+    Makes the directory of ``filename`` if needed, and forgets the ETag
+    of the file, before it is downloaded again.
+    """
+    # The file is no longer the one its ETag was recorded for.
+    if os.path.exists(filename):
+        set_local_etag(filename, None)
+    d = os.path.dirname(filename)
+    try:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    except OSError as e:
+        if not e.errno == errno.EEXIST:
+            raise CreateDirectoryError(
+                "Could not create directory %s: %s" % (d, e))
+
+
+def set_last_update(filename, last_update):
+    """Sets the modification time of ``filename`` to ``last_update``."""
+    if last_update:
         last_update_tuple = last_update.timetuple()
         mod_timestamp = time.mktime(last_update_tuple)
         os.utime(filename, (int(mod_timestamp), int(mod_timestamp)))
-    else:
-        # Now write the output to stdout since the md5 is correct.
-        bytes_print(payload)
-        sys.stdout.flush()
 
 
-def write_to_file(out_file, md5_hex, md5, file_chunks, is_stream=False):
+def write_to_file(out_file, md5_hex, md5, file_chunks, is_stream=False,
+                  stream_write=bytes_print):
     """
     Updates the etag for each file chunk.  It will write to the file if it a
-    file but if it is a stream it will return a byte string to be later
-    written to a stream.
+    file or with ``stream_write``, straight to standard out by default, if it
+    is a stream.
     """
-    body = b''
     for chunk in file_chunks:
-        if md5_hex:
+        if md5 is not None:
             md5.update(chunk)
         if is_stream:
-            body += chunk
+            stream_write(chunk)
         else:
             out_file.write(chunk)
-    return body
 
 
 def _is_multipart_etag(etag):
@@ -91,6 +168,12 @@ class FileInfo(object):
     :type size: integer
     :param last_update: the local time of last modification.
     :type last_update: datetime object
+    :param etag: the entity tag of the source, set from the response
+        headers.
+    :type etag: string
+    :param status_code: the HTTP status of the last response for the
+        file.
+    :type status_code: integer
     """
     operation_name = 'download'
 
@@ -104,11 +187,20 @@ class FileInfo(object):
         self.md5 = md5
         self.last_update = last_update
         self.is_stream = is_stream
+        self.etag = None
+        self.status_code = None
+
+    @property
+    def host(self):
+        """The network location of the source url."""
+        return urlparse(self.src).netloc.lower()
 
     def set_info_from_headers(self, response):
         """
         This runs a ``HeadObject`` on the s3 object and sets the size.
         """
+        self.status_code = response.status_code
+        check_status(response)
         if self.last_update is None:
             last_update = response.headers.get('Last-Modified')
             if last_update is not None:
@@ -121,6 +213,8 @@ class FileInfo(object):
             if self.dest is None:
                 self.dest = os.path.basename(urlparse(self.src).path)
             self.dest = os.path.abspath(self.dest)
+        if self.etag is None:
+            self.etag = response.headers.get('ETag')
         if self.md5 is None:
             server = response.headers.get('Server')
             if server == 'AmazonS3':
@@ -131,18 +225,120 @@ class FileInfo(object):
             elif 'Range' not in response.request.headers:
                 content_md5 = response.headers.get('Content-MD5', None)
                 if content_md5:
-                    self.md5 = binascii.hexlify(binascii.a2b_base64(content_md5))
+                    self.md5 = binascii.hexlify(
+                        binascii.a2b_base64(content_md5)).decode('ascii')
         if self.size is None:
             if 'Range' not in response.request.headers:
                 content_length = response.headers.get('Content-Length')
                 if content_length is not None:
                     self.size = int(content_length)
 
-    def download(self, session):
+    def is_unchanged(self, compare_md5=True):
+        """
+        Whether the local file is the same as the source, going by the
+        metadata known for the source.  A file whose size differs is
+        changed.  Otherwise the ETag recorded when the file was
+        downloaded is compared, then the last modified time, which is set
+        to that of the source once a download is complete, then the md5.
+        If none of those are known the file is taken to be changed.
+
+        Comparing the md5 means reading the whole file.  Unless
+        ``compare_md5`` is set, None is returned instead where only the
+        md5 could tell.
+        """
+        if self.is_stream or self.dest is None:
+            return False
+        try:
+            size, update_time = get_file_stat(self.dest)
+        except ValueError:
+            return False
+        if self.size is not None and size != self.size:
+            return False
+        if self.etag is not None:
+            local_etag = get_local_etag(self.dest)
+            if local_etag is not None:
+                return local_etag == self.etag
+        if self.last_update is not None:
+            return _timestamp(update_time) == _timestamp(self.last_update)
+        if self.md5 is not None:
+            if not compare_md5:
+                return None
+            return file_md5(self.dest) == self.md5
+        return False
+
+    def download(self, session, stream_verify='spool', throttle=None,
+                 conditional=False, stream_write=None, read_size=None):
         """
         Redirects the file to the multipart download function if the file is
         large.  If it is small enough, it gets the file as an object from s3.
+
+        If ``conditional`` is set and the local file exists, the request
+        is made conditional on the source having changed since it was
+        downloaded.  Returns None if it had not, the md5 of the data
+        downloaded otherwise.
+
+        A stream is written with ``stream_write`` if given.  The response
+        is read in chunks of at most ``read_size`` if given.
         """
-        response = session.get(self.src, stream=True)
+        headers = {}
+        if conditional:
+            headers = self.conditional_headers()
+        response = session.get(self.src, stream=True, headers=headers)
+        if response.status_code == 304:
+            self.status_code = response.status_code
+            response.close()
+            return None
         self.set_info_from_headers(response)
-        save_file(self.dest, response, self.last_update, self.md5, self.is_stream)
+        md5_hex = save_file(self.dest, response, self.last_update, self.md5,
+                            self.is_stream, stream_verify, throttle,
+                            stream_write, read_size)
+        if not self.is_stream:
+            set_local_etag(self.dest, self.etag)
+        return md5_hex
+
+    def conditional_headers(self):
+        """
+        The headers making a request conditional on the source having
+        changed since the local file was downloaded, if there is one.
+        """
+        if self.is_stream or self.dest is None or \
+                not os.path.exists(self.dest):
+            return {}
+        size, update_time = get_file_stat(self.dest)
+        if self.size is not None and size != self.size:
+            return {}
+        local_etag = get_local_etag(self.dest)
+        if local_etag is not None:
+            return {'If-None-Match': local_etag}
+        return {'If-Modified-Since': formatdate(_timestamp(update_time),
+                                                usegmt=True)}
+
+
+def _timestamp(local_time):
+    return int(time.mktime(local_time.timetuple()))
+
+
+def file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(partial(f.read, 1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def info_from_url(src, is_stream=False):
+    """ read data from url, e.g:
+            http://example.com/path.tgz#md5=1234567890abcd;size=1234
+    """
+    parsed = urlparse(src)
+    info = {}
+    info['dest'] = os.path.basename(parsed.path)
+    # Newer versions of parse_qsl no longer treat ';' as a separator.
+    hash_params = dict(parse_qsl(parsed.fragment.replace(';', '&')))
+    if 'md5' in hash_params:
+        info['md5'] = hash_params['md5']
+    if 'size' in hash_params:
+        info['size'] = int(hash_params['size'])
+    if 'filename' in hash_params:
+        info['dest'] = os.path.basename(hash_params['filename'])
+    return FileInfo(src, is_stream=is_stream, **info)
@@ -0,0 +1,222 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from .compat import TimeoutError
+from .events import FileEvent, FileStartEvent, PartEvent
+
+LOGGER = logging.getLogger(__name__)
+
+# The outcome of downloading a file.
+#
+# * src: The source url.
+# * dest: The path of the local file.
+# * status: 'downloaded', 'unchanged' if the local file was up to date,
+#   'cached' if it was made from the cache, 'copied' if it was copied
+#   from the download of the same source to another destination, or
+#   'duplicate' if the same source and destination were given before.
+# * size: The size of the file in bytes, if known.
+# * num_bytes: The number of bytes downloaded for the file.
+# * duration: The seconds from the start of the download to its end.
+# * retries: The number of requests that were made again after an error.
+# * http_status: The status of the last response for the file, if any.
+# * md5: The md5 computed from the data of the file, if it was.
+DownloadResult = namedtuple('DownloadResult',
+                            ['src', 'dest', 'status', 'size', 'num_bytes',
+                             'duration', 'retries', 'http_status', 'md5'])
+
+
+class DownloadFailedError(Exception):
+    """
+    Raised by ``DownloadFuture.result`` if the file could not be
+    downloaded.
+    """
+    def __init__(self, filename, message):
+        super(DownloadFailedError, self).__init__(message)
+        self.filename = filename
+
+
+class DownloadFuture(object):
+    """
+    The eventual result of downloading ``filename``, a ``FileInfo``.
+
+    The tasks downloading the file report to the future as they go: the
+    number of bytes of each read with ``update``, requests made again with
+    ``retried`` and finally the outcome with ``set_result`` or
+    ``set_exception``, only the first of which counts.  Whoever compared
+    the md5 of the file says so to ``set_result``.  If given,
+    ``progress_callback`` is called with the future and the number of
+    bytes of each read, in the thread that read them, so it should be
+    quick.  If given, ``reporter`` is reported the events of the file,
+    see ``JsonReporter``.
+    """
+    def __init__(self, filename, progress_callback=None, reporter=None):
+        self.filename = filename
+        self._progress_callback = progress_callback
+        self._reporter = reporter
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+        self._start_time = None
+        self._num_bytes = 0
+        self._retries = 0
+        self._md5_verified = False
+
+    @property
+    def num_bytes(self):
+        """The number of bytes downloaded so far."""
+        return self._num_bytes
+
+    @property
+    def retries(self):
+        return self._retries
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Waits for the future to be done, returns whether it is."""
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        """
+        Returns the ``DownloadResult`` once the file is done, or raises
+        the ``DownloadFailedError`` if it failed.  Raises a
+        ``TimeoutError`` if it is not done within ``timeout`` seconds.
+        """
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("Download of %s is not done" %
+                               self.filename.src)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """
+        Calls ``callback`` with the future once it is done, straight away
+        if it already is.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def set_running(self):
+        with self._lock:
+            if self._start_time is not None:
+                return
+            self._start_time = time.time()
+        if self._reporter is not None:
+            filename = self.filename
+            self._reporter.report(FileStartEvent(
+                time=self._start_time, src=filename.src, dest=filename.dest,
+                size=filename.size))
+
+    def update(self, num_bytes):
+        with self._lock:
+            self._num_bytes += num_bytes
+        if self._progress_callback is not None:
+            self._run_callback(self._progress_callback, num_bytes)
+
+    def retried(self):
+        with self._lock:
+            self._retries += 1
+
+    def part_done(self, part_number, num_bytes, duration, retries,
+                  http_status, error=None):
+        """Reports a part of the file that is done, or failed."""
+        if self._reporter is not None:
+            filename = self.filename
+            self._reporter.report(PartEvent(
+                time=time.time(), src=filename.src, dest=filename.dest,
+                part_number=part_number, num_bytes=num_bytes,
+                duration=duration, retries=retries, http_status=http_status,
+                error=error))
+
+    def set_result(self, status, md5_verified=False, md5=None):
+        """
+        Reports the file as done with ``status``.  ``md5_verified`` is
+        whether the data of the file was found to match its md5.  ``md5``
+        is the md5 computed from the data, if any, which goes without
+        saying once the md5 of the file was verified.
+        """
+        filename = self.filename
+        if md5_verified:
+            md5 = filename.md5
+        self._finish(md5_verified=md5_verified, result=DownloadResult(
+            src=filename.src, dest=filename.dest, status=status,
+            size=filename.size, num_bytes=self._num_bytes,
+            duration=self._duration(), retries=self._retries,
+            http_status=filename.status_code, md5=md5))
+
+    def set_exception(self, message):
+        self._finish(exception=DownloadFailedError(self.filename, message))
+
+    def _duration(self):
+        if self._start_time is None:
+            return 0.0
+        return time.time() - self._start_time
+
+    def _finish(self, result=None, exception=None, md5_verified=False):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._md5_verified = md5_verified
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        if self._reporter is not None:
+            self._reporter.report(self._file_event())
+        for callback in callbacks:
+            self._run_callback(callback)
+
+    def _file_event(self):
+        filename = self.filename
+        md5_verified = None
+        if filename.md5 is not None:
+            md5_verified = self._md5_verified
+        error = None
+        if self._result is not None:
+            status = self._result.status
+        else:
+            status = 'failed'
+            error = str(self._exception)
+        return FileEvent(
+            time=time.time(), src=filename.src, dest=filename.dest,
+            status=status, size=filename.size, num_bytes=self._num_bytes,
+            duration=self._duration(), retries=self._retries,
+            http_status=filename.status_code, md5=filename.md5,
+            md5_verified=md5_verified, error=error)
+
+    def _run_callback(self, callback, *args):
+        try:
+            callback(self, *args)
+        except Exception as e:
+            LOGGER.debug('Error calling download callback: %s', e,
+                         exc_info=True)
+
+
+def read_callback(throttle, future):
+    """
+    Returns what to call with the size of each read of a response to
+    limit its rate with ``throttle`` and report it to ``future``, either
+    of which may be None.
+    """
+    if future is None:
+        return throttle
+    if throttle is None:
+        return future.update
+
+    def callback(num_bytes):
+        throttle(num_bytes)
+        future.update(num_bytes)
+    return callback
@@ -11,14 +11,25 @@
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
 from collections import namedtuple
+from functools import partial
 import logging
 import os
+import time
 import requests
 
+from .cache import ContentCache
 from .constants import MULTI_THRESHOLD, CHUNKSIZE, \
-    NUM_THREADS, MAX_QUEUE_SIZE
-from .utils import find_chunksize, PrintTask
-from .executor import Executor
+    NUM_THREADS, NUM_PROBE_THREADS, MAX_QUEUE_SIZE, MAX_PARTS, \
+    POOL_NUM_HOSTS, WORKER_STACK_SIZE, MAX_CACHE_SIZE, \
+    MAX_STREAM_BUFFER_SIZE
+from .utils import find_chunksize, validate_transfer_config, BufferPool, \
+    DownloadJournal, IncrementalMD5, MappedFileWriter, PositionalWriter, \
+    PrintTask, RateLimiter
+from .events import JsonReporter, SummaryEvent
+from .executor import Executor, MetadataResolver, ThroughputTuner
+from .futures import DownloadFuture
+from .transport import connection_stats, mount_pooled_adapters, \
+    HTTP2Adapter
 from . import tasks
 from .compat import queue
 
@@ -26,7 +37,8 @@ from .compat import queue
 LOGGER = logging.getLogger(__name__)
 
 CommandResult = namedtuple('CommandResult',
-                           ['num_tasks_failed', 'num_tasks_warned'])
+                           ['num_tasks_failed', 'num_tasks_warned',
+                            'num_duplicates', 'num_collisions'])
 
 
 class Handler(object):
@@ -34,49 +46,166 @@ class Handler(object):
     This class sets up the process to perform the tasks sent to it.  It
     sources the ``self.executor`` from which threads inside the
     class pull tasks from to complete.
+
+    The number of threads and the queue sizes default to the class
+    attributes below, which subclasses tune for their use case.
     """
     MAX_IO_QUEUE_SIZE = 20
     MAX_EXECUTOR_QUEUE_SIZE = MAX_QUEUE_SIZE
     EXECUTOR_NUM_THREADS = NUM_THREADS
+    EXECUTOR_STACK_SIZE = WORKER_STACK_SIZE
+    PROBE_NUM_THREADS = NUM_PROBE_THREADS
+    # Whether files must be enqueued in the order they were given.
+    PRESERVE_ORDER = False
+    # Whether the concurrency may be limited by a ``ThroughputTuner``.
+    SUPPORTS_AUTO_TUNE = True
+    # Whether tasks take turns between hosts rather than run in the order
+    # they were submitted.
+    FAIR_HOST_SCHEDULING = True
+    # Whether a source given more than once is downloaded once, and a
+    # destination given more than once is written once.
+    DEDUPLICATE = True
+    # Whether the parts are written with positional writes by the tasks
+    # downloading them regardless of the ``pwrite`` param.
+    POSITIONAL_WRITES = False
+    # The tasks downloading a file in one go and a part of a file.
+    BASIC_TASK_CLASS = tasks.BasicTask
+    PART_TASK_CLASS = tasks.DownloadPartTask
 
     def __init__(self, params=None, session=None, result_queue=None,
-                 multi_threshold=MULTI_THRESHOLD, chunksize=CHUNKSIZE):
-        if session is None:
-            session = requests.Session()
-        self.session = session
+                 multi_threshold=MULTI_THRESHOLD, chunksize=CHUNKSIZE,
+                 num_threads=None, max_queue_size=None,
+                 max_io_queue_size=None, num_probe_threads=None,
+                 max_per_host=None):
+        if num_threads is None:
+            num_threads = self.EXECUTOR_NUM_THREADS
+        if max_queue_size is None:
+            max_queue_size = self.MAX_EXECUTOR_QUEUE_SIZE
+        if max_io_queue_size is None:
+            max_io_queue_size = self.MAX_IO_QUEUE_SIZE
+        if num_probe_threads is None:
+            num_probe_threads = self.PROBE_NUM_THREADS
+        validate_transfer_config(multi_threshold, chunksize, num_threads,
+                                 max_queue_size, max_io_queue_size,
+                                 num_probe_threads, max_per_host)
         # The write_queue has potential for optimizations, so the constant
         # for maxsize is scoped to this class (as opposed to constants.py)
         # so we have the ability to change this value later.
-        self.write_queue = queue.Queue(maxsize=self.MAX_IO_QUEUE_SIZE)
+        self.write_queue = queue.Queue(maxsize=max_io_queue_size)
         self.result_queue = result_queue
         if not self.result_queue:
             self.result_queue = queue.Queue()
         self.params = {'dryrun': False, 'quiet': False,
                        'only_show_errors': False,
-                       'is_stream': False}
+                       'is_stream': False, 'resume': False,
+                       'fsync': False, 'mmap': False, 'pwrite': False,
+                       'stream_verify': 'spool', 'auto_tune': False,
+                       'limit_rate': None, 'host_limit_rates': None,
+                       'http2': False, 'sync': False,
+                       'cache_dir': None, 'cache_size': MAX_CACHE_SIZE,
+                       'stream_buffer_size': MAX_STREAM_BUFFER_SIZE,
+                       'persistent': False, 'json': None}
         if params:
             self.params.update(params)
+        if self.params['http2'] and not HTTP2Adapter.SUPPORTED:
+            raise ValueError("HTTP/2 requires the httpx and h2 packages, "
+                             "install wgot[http2]")
+        if session is None:
+            session = requests.Session()
+        self.session = session
+        # Each worker and probe thread keeps a connection alive to every
+        # host it downloads from, or shares one over HTTP/2.
+        self._adapters = mount_pooled_adapters(
+            self.session, pool_maxsize=num_threads + num_probe_threads,
+            pool_connections=POOL_NUM_HOSTS, http2=self.params['http2'])
         self.multi_threshold = multi_threshold
         self.chunksize = chunksize
-        self.executor = Executor(
-            num_threads=self.EXECUTOR_NUM_THREADS,
+        self.buffer_pool = None
+        if BufferPool.SUPPORTED:
+            self.buffer_pool = BufferPool(
+                tasks.DownloadPartTask.ITERATE_CHUNK_SIZE)
+        self.executor = self._create_executor(
+            num_threads=num_threads,
             result_queue=self.result_queue,
             quiet=self.params['quiet'],
             only_show_errors=self.params['only_show_errors'],
-            max_queue_size=self.MAX_EXECUTOR_QUEUE_SIZE,
-            write_queue=self.write_queue
+            max_queue_size=max_queue_size,
+            write_queue=self.write_queue,
+            buffer_pool=self.buffer_pool,
+            worker_stack_size=self.EXECUTOR_STACK_SIZE,
+            fair_host_scheduling=self.FAIR_HOST_SCHEDULING,
+            max_per_host=max_per_host
         )
+        needs_probe = None
+        if self.params['sync']:
+            needs_probe = self._needs_probe
+        self.metadata_resolver = self._create_metadata_resolver(
+            session=self.session, num_threads=num_probe_threads,
+            ordered=self.PRESERVE_ORDER, needs_probe=needs_probe,
+            host_limiter=self.executor.queue)
+        self.rate_limiter = None
+        if self.params['limit_rate'] is not None or \
+                self.params['host_limit_rates']:
+            self.rate_limiter = RateLimiter(self.params['limit_rate'],
+                                            self.params['host_limit_rates'])
+        self.cache = None
+        if self.params['cache_dir'] is not None:
+            self.cache = ContentCache(self.params['cache_dir'],
+                                      self.params['cache_size'])
+        self.reporter = None
+        if self.params['json'] is not None:
+            self.reporter = JsonReporter.open(self.params['json'])
+        self.tuner = None
+        if self.params['auto_tune'] and self.SUPPORTS_AUTO_TUNE:
+            self.tuner = ThroughputTuner(max_concurrency=num_threads)
+        self.reorder_buffer = None
         self._multipart_downloads = []
+        # The FanOut of each source, or its FanOutRecord once complete,
+        # and the source of each destination planned so far, and the
+        # first source given for each destination known before its file
+        # is probed.  The destinations copied to by a worker once the
+        # download is complete are kept with their FanOutTask.
+        self._fan_outs = {}
+        self._destinations = {}
+        self._claims = {}
+        self._fan_out_tasks = []
+        self.num_duplicates = 0
+        self.num_collisions = 0
+        # The futures of the files being submitted that have not been
+        # enqueued yet.
+        self._unresolved = set()
+        self._total_files = 0
+        self._total_parts = 0
+        self._started = False
+        self._closed = False
+
+    def _create_executor(self, **kwargs):
+        return Executor(**kwargs)
+
+    def _create_metadata_resolver(self, **kwargs):
+        return MetadataResolver(**kwargs)
 
     def call(self, files):
         """
         This function pulls a ``FileInfo`` or ``TaskInfo`` object from
-        a list ``files``.  Each object is then deemed if it will be a
-        multipart operation and add the necessary attributes if so.  Each
-        object is then wrapped with a ``BasicTask`` object which is
-        essentially a thread of execution for a thread to follow.  These
-        tasks are then submitted to the main executor.
+        an iterable ``files``, which is consumed lazily so it may be a
+        generator over a very large manifest.  Each object is then deemed
+        if it will be a multipart operation and add the necessary
+        attributes if so.  Each object is then wrapped with a
+        ``BasicTask`` object which is essentially a thread of execution
+        for a thread to follow.  These tasks are then submitted to the
+        main executor.
+
+        If the ``persistent`` param is set the handler may be called
+        again, see ``_call_batch``.
         """
+        if self.params['persistent']:
+            return self._call_batch(files)
+        if self.reporter is not None:
+            # The events of each file are reported by its future.
+            files = self._track(files)
+        else:
+            files = ((filename, None) for filename in files)
         try:
             self.executor.start()
             total_files, total_parts = self._enqueue_tasks(files)
@@ -103,15 +232,187 @@ class Handler(object):
             self.executor.wait_until_shutdown()
 
         return CommandResult(self.executor.num_tasks_failed,
-                             self.executor.num_tasks_warned)
+                             self.executor.num_tasks_warned,
+                             self.num_duplicates, self.num_collisions)
+
+    def _call_batch(self, files):
+        """
+        Downloads ``files`` with the threads and connections kept since
+        the first call, and returns once they are all done, rather than
+        once the threads have been stopped.  The result counts this batch
+        alone.  The threads are stopped with ``close``.
+        """
+        if self._closed:
+            raise RuntimeError("Cannot call a handler that has been closed")
+        self.start()
+        counts_before = self._counts()
+        futures = []
+        try:
+            try:
+                self._submit(self._track(files, futures))
+            except Exception as e:
+                # The files submitted before the error are still
+                # downloaded, and the threads kept for the next batch.
+                LOGGER.debug('Exception caught submitting batch: %s',
+                             str(e), exc_info=True)
+                self.result_queue.put(PrintTask(message=str(e), error=True))
+            # Waiting in steps keeps the main thread interruptible.
+            for future in futures:
+                while not future.wait(1):
+                    pass
+            self.executor.wait_for_results()
+            self._clean_up_multipart_downloads()
+        except KeyboardInterrupt:
+            self.result_queue.put(PrintTask(message=("Cleaning up. "
+                                                     "Please wait..."),
+                                            error=True))
+            self._closed = True
+            self.executor.initiate_shutdown(
+                priority=self.executor.IMMEDIATE_PRIORITY)
+            self._shutdown()
+            self.executor.wait_until_shutdown()
+        return CommandResult(*[after - before for after, before in
+                               zip(self._counts(), counts_before)])
+
+    def _track(self, files, futures=None):
+        # Gives every file a future, e.g. so a batch can wait for them,
+        # and yields them in pairs.
+        for filename in files:
+            future = DownloadFuture(filename, reporter=self.reporter)
+            if futures is not None:
+                futures.append(future)
+            yield filename, future
+
+    def _counts(self):
+        return CommandResult(self.executor.num_tasks_failed,
+                             self.executor.num_tasks_warned,
+                             self.num_duplicates, self.num_collisions)
+
+    def start(self):
+        """
+        Starts the threads for ``submit``.  Unlike with ``call``, they are
+        kept for every batch of files submitted until ``close``.
+        """
+        if not self._started:
+            self._started = True
+            self.executor.start()
+
+    def submit(self, files, futures=None):
+        """
+        Enqueues the downloads of ``files`` without waiting for them.  If
+        given, ``futures`` has a ``DownloadFuture`` for each ``FileInfo``
+        in ``files``, in the same order, to report its outcome to.
+        """
+        if futures is None:
+            self._submit((filename, None) for filename in files)
+        else:
+            futures = list(futures)
+            self._submit(zip(files, futures), futures)
+
+    def _submit(self, files, futures=()):
+        # Submits the FileInfo and future, or None, pairs of ``files``,
+        # failing the futures not enqueued should it fail.
+        self._forget_completed()
+        self._unresolved = unresolved = set(futures)
+        errors = []
+        try:
+            total_files, total_parts = self._enqueue_tasks(
+                self._hold_futures(files, unresolved, errors))
+        except Exception as e:
+            # Whatever was not enqueued will never be done, including a
+            # file the feeder thread reads after this.
+            errors.append(str(e))
+            for future in list(unresolved):
+                future.set_exception(str(e))
+            raise
+        # The progress is of everything submitted so far.
+        self._total_files += total_files
+        self._total_parts += total_parts
+        self.executor.print_thread.set_total_files(self._total_files)
+        self.executor.print_thread.set_total_parts(self._total_parts)
+
+    def _forget_completed(self):
+        # Files are deduplicated against those of earlier batches still
+        # being downloaded or copied, but not against those done, which
+        # are downloaded again.  Only the downloads still in progress
+        # need cleaning up at shutdown.  The maps are pruned in place as
+        # the fan outs keep their records in ``self._fan_outs``.
+        self._multipart_downloads = [
+            (context, local_filename) for context, local_filename
+            in self._multipart_downloads if not context.is_completed()]
+        self._fan_out_tasks = [
+            (task, dest) for task, dest in self._fan_out_tasks
+            if not task.is_completed()]
+        copying = set(dest for task, dest in self._fan_out_tasks)
+        in_progress = set(
+            source for source, fan_out in list(self._fan_outs.items())
+            if not isinstance(fan_out, tasks.FanOutRecord))
+        for dest, source in list(self._destinations.items()):
+            if source not in in_progress and dest not in copying:
+                del self._destinations[dest]
+        sources = set(self._destinations.values())
+        for source in list(self._fan_outs):
+            if source not in sources:
+                del self._fan_outs[source]
+        for dest in list(self._claims):
+            if dest not in self._destinations:
+                del self._claims[dest]
+
+    def _hold_futures(self, files, unresolved, errors):
+        # Runs in the feeder thread of the ``MetadataResolver``.
+        for filename, future in files:
+            if future is not None:
+                unresolved.add(future)
+                if errors:
+                    future.set_exception(errors[0])
+            yield filename, future
+
+    def close(self):
+        """
+        Waits for the downloads submitted to finish and stops the
+        threads.  Returns the counts of every batch.
+        """
+        if not self._closed:
+            self._closed = True
+            if self._started:
+                self.executor.initiate_shutdown()
+                self.executor.wait_until_shutdown()
+            self._shutdown()
+        return self._counts()
 
     def _shutdown(self):
+        self._clean_up_multipart_downloads()
+        if self.tuner is not None:
+            self.tuner.log_summary()
+        if self.cache is not None:
+            LOGGER.debug("Made %s file(s) from the cache and cached %s.",
+                         self.cache.num_hits, self.cache.num_stored)
+        stats = self.connection_stats()
+        LOGGER.debug("Made %s requests over %s connections.",
+                     stats.num_requests, stats.num_connections)
+        resolver = self.metadata_resolver
+        LOGGER.debug("Made %s probes in %.2f seconds (%.1f probes/s).",
+                     resolver.num_probes, resolver.elapsed,
+                     resolver.probes_per_second)
+        if self.reporter is not None:
+            self.reporter.report(SummaryEvent(
+                time=time.time(), num_probes=resolver.num_probes,
+                probe_duration=resolver.elapsed,
+                probes_per_second=resolver.probes_per_second,
+                num_requests=stats.num_requests,
+                num_connections=stats.num_connections))
+            self.reporter.close()
+
+    def _clean_up_multipart_downloads(self):
         # The downloads case is easier than the uploads case because we don't
         # need to make any service calls.  To properly cleanup we just need
         # to go through the multipart downloads that were in progress but
-        # cancelled and remove the local file.
+        # cancelled and remove the local file.  When resuming is enabled
+        # the file is kept, as its journal records which parts of it can
+        # be reused by the next run.
         for context, local_filename in self._multipart_downloads:
             if (context.is_cancelled() or context.is_started()) and \
+                    not self.params['resume'] and \
                     os.path.exists(local_filename):
                 # The file is in an inconsistent state (not all the parts
                 # were written to the file) so we should remove the
@@ -122,16 +423,70 @@ class Handler(object):
                 # deleting the file entirely.
                 os.remove(local_filename)
             context.cancel()
+        self._multipart_downloads = []
+
+    def connection_stats(self):
+        """
+        Return the number of requests made and connections opened by the
+        session so far.
+        """
+        return connection_stats(self._adapters)
 
     def _enqueue_tasks(self, files):
+        if self.DEDUPLICATE and not self.params['dryrun']:
+            files = self._claim_destinations(files)
+        resolved = self.metadata_resolver.resolve(files)
+        try:
+            return self._enqueue_resolved(resolved)
+        finally:
+            # Stops the probes should the files fail part way.
+            resolved.close()
+
+    def _enqueue_resolved(self, resolved):
         total_files = 0
         total_parts = 0
-        for filename in files:
+        for (filename, error), future in resolved:
             num_downloads = 1
-            if filename.size is None:
-                response = self.session.head(filename.src, allow_redirects=True)
-                filename.set_info_from_headers(response)
+            self._unresolved.discard(future)
+            if error is not None:
+                message = tasks.print_operation(filename, True,
+                                                self.params['dryrun'])
+                self.result_queue.put(PrintTask(
+                    message=message + ' ' + str(error), error=True))
+                if future is not None:
+                    future.set_exception(str(error))
+                total_files += 1
+                total_parts += num_downloads
+                continue
+            fan_out = None
+            if self.DEDUPLICATE and not self.params['dryrun']:
+                fan_out, planned = self._deduplicate(filename, future)
+                if planned is not None:
+                    total_files += planned
+                    total_parts += planned
+                    continue
+            compare_md5 = False
             is_multipart_task = self._is_multipart_task(filename)
+            if self.params['sync']:
+                unchanged = self._is_unchanged(filename)
+                if unchanged:
+                    self.result_queue.put(PrintTask(
+                        message=tasks.print_skip(filename), error=False))
+                    if future is not None:
+                        future.set_result('unchanged')
+                    if fan_out is not None:
+                        fan_out.complete(True)
+                    total_files += 1
+                    total_parts += num_downloads
+                    continue
+                # Only the md5 can tell, which a worker compares before
+                # the parts are downloaded should it differ.  A smaller
+                # file is downloaded with a conditional request instead.
+                compare_md5 = unchanged is None and bool(is_multipart_task)
+            if self._is_cached(filename):
+                # The file is made from the cache instead, or downloaded
+                # in one go should it have been evicted since.
+                is_multipart_task = False
             if is_multipart_task and not self.params['dryrun']:
                 # If we're in dryrun mode, then we don't need the
                 # real multipart tasks.  We can just use a BasicTask
@@ -139,17 +494,134 @@ class Handler(object):
                 # fact that it's transferring a file rather than
                 # the specific part tasks required to perform the
                 # transfer.
-                num_downloads = self._enqueue_range_download_tasks(filename)
+                num_downloads = self._enqueue_range_download_tasks(
+                    filename, fan_out=fan_out, future=future,
+                    compare_md5=compare_md5)
             else:
-                task = tasks.BasicTask(
+                slot = None
+                if self.reorder_buffer is not None:
+                    slot = self.reorder_buffer.allocate()
+                task = self.BASIC_TASK_CLASS(
                     session=self.session, filename=filename,
                     parameters=self.params,
-                    result_queue=self.result_queue)
+                    result_queue=self.result_queue,
+                    rate_limiter=self.rate_limiter, cache=self.cache,
+                    fan_out=fan_out, reorder_buffer=self.reorder_buffer,
+                    slot=slot, future=future, compare_md5=compare_md5)
                 self.executor.submit(task)
             total_files += 1
             total_parts += num_downloads
+        if self.num_duplicates or self.num_collisions:
+            self.result_queue.put(PrintTask(
+                message="warning: %s duplicate source(s) were downloaded "
+                "once and %s destination collision(s) were skipped" % (
+                    self.num_duplicates, self.num_collisions),
+                error=False, warning=True))
         return total_files, total_parts
 
+    def _claim_destinations(self, files):
+        """
+        Records the first source of each destination known before the
+        files are probed, in the order of ``files``.  This runs in the
+        feeder thread of the ``MetadataResolver``, ahead of the probes.
+        """
+        for filename, future in files:
+            if filename.dest is not None and not filename.is_stream:
+                self._claims.setdefault(filename.dest, _source(filename))
+            yield filename, future
+
+    def _deduplicate(self, filename, future=None):
+        """
+        Returns the ``FanOut`` of ``filename`` if it is to be downloaded,
+        and None, or None and the number of files it counts as if it is
+        not.  A source given again for another destination is copied
+        there once downloaded.  A destination given again is skipped,
+        silently if it is for the same source or as an error otherwise.
+        A source given again with another md5 or size is an error too.
+
+        The probes return in any order, so a destination known up front
+        goes to the first source given for it, whichever is resolved
+        first.  A destination only known once its file is probed, e.g.
+        from a Content-Disposition header, goes to the first resolved.
+        """
+        source = _source(filename)
+        fan_out = self._fan_outs.get(source)
+        if isinstance(fan_out, tasks.FanOutRecord):
+            fan_out = tasks.FanOut.from_record(fan_out, self.result_queue,
+                                               sync=self.params['sync'])
+        other_source = self._claims.get(filename.dest)
+        if other_source is None or other_source == source:
+            other_source = self._destinations.get(filename.dest)
+        error_message = None
+        if other_source is not None and other_source != source:
+            error_message = "Destination is also the destination of " + \
+                other_source
+        elif fan_out is not None:
+            error_message = _conflict(fan_out.filename, filename)
+        if error_message is not None:
+            self.num_collisions += 1
+            message = tasks.print_operation(filename, True)
+            self.result_queue.put(PrintTask(
+                message=message + ' ' + error_message, error=True))
+            if future is not None:
+                future.set_exception(error_message)
+            return None, 1
+        if other_source == source:
+            LOGGER.debug("Skipping duplicate of %s to %s.", filename.src,
+                         filename.dest)
+            self.num_duplicates += 1
+            self._add_to_fan_out(fan_out, filename, future, duplicate=True)
+            # It is a file of its own if its md5 is checked separately.
+            return None, int(fan_out.reports_duplicate(filename))
+        self._destinations[filename.dest] = source
+        if fan_out is not None:
+            LOGGER.debug("Copying %s to %s once downloaded to %s.",
+                         filename.src, filename.dest, fan_out.filename.dest)
+            self.num_duplicates += 1
+            self._add_to_fan_out(fan_out, filename, future)
+            return None, 1
+        # Only what later duplicates need is kept once it is complete.
+        fan_out = tasks.FanOut(
+            filename, self.result_queue,
+            on_completed=partial(_keep_record, self._fan_outs, source),
+            sync=self.params['sync'])
+        self._fan_outs[source] = fan_out
+        return fan_out, None
+
+    def _add_to_fan_out(self, fan_out, filename, future, duplicate=False):
+        task = tasks.FanOutTask(fan_out, filename, future, duplicate)
+        if fan_out.is_completed():
+            # Copying or checking the file is left to a worker.
+            self.executor.submit(task)
+            self._fan_out_tasks.append((task, filename.dest))
+        else:
+            task()
+
+    def _is_cached(self, filename):
+        return self.cache is not None and filename.md5 is not None and \
+            not filename.is_stream and \
+            self.cache.contains(filename.md5, filename.size)
+
+    def _needs_probe(self, filename):
+        # A file of known size still needs the metadata of its source to
+        # tell whether the local file is up to date, even if it has an md5
+        # that could, unless it is small enough to download with a
+        # conditional request instead.
+        if filename.size <= self.multi_threshold:
+            return False
+        try:
+            return os.path.getsize(filename.dest) == filename.size
+        except (OSError, TypeError):
+            return False
+
+    def _is_unchanged(self, filename):
+        # A journal means the file is partially downloaded.  None means
+        # only the md5 of the file could tell, which is not read here.
+        if filename.dest is None or \
+                os.path.exists(filename.dest + DownloadJournal.SUFFIX):
+            return False
+        return filename.is_unchanged(compare_md5=False)
+
     def _is_multipart_task(self, filename):
         # First we need to determine if it's an operation that even
         # qualifies for multipart download.
@@ -160,32 +632,98 @@ class Handler(object):
         else:
             return False
 
-    def _enqueue_range_download_tasks(self, filename):
-        chunksize = find_chunksize(filename.size, self.chunksize)
+    def _enqueue_range_download_tasks(self, filename, fan_out=None,
+                                      future=None, compare_md5=False):
+        chunksize = self.chunksize
+        # A resumed download has to keep the part size of its journal.
+        if self.tuner is not None and not self.params['resume']:
+            chunksize = self.tuner.suggest_chunksize(filename.size,
+                                                     chunksize)
+            if chunksize != self.chunksize:
+                LOGGER.debug("Auto-tune chose a chunksize of %s bytes for "
+                             "%s.", chunksize, filename.src)
+        planned_chunksize = find_chunksize(filename.size, chunksize)
+        if planned_chunksize != chunksize:
+            LOGGER.debug("Raised the chunksize of %s to %s bytes to stay "
+                         "within %s parts.", filename.src, planned_chunksize,
+                         MAX_PARTS)
+        chunksize = planned_chunksize
         num_downloads = int(filename.size / chunksize)
-        context = tasks.MultipartDownloadContext(num_downloads)
-        create_file_task = tasks.CreateLocalFileTask(context=context,
-                                                     filename=filename)
-        self.executor.submit(create_file_task)
+        journal = None
+        completed_parts = set()
+        if self.params['resume']:
+            journal = DownloadJournal(filename.dest, filename.src,
+                                      filename.size, chunksize,
+                                      filename.last_update)
+            if os.path.exists(filename.dest):
+                completed_parts = journal.load()
+                LOGGER.debug("Resuming %s with %s of %s parts completed.",
+                             filename.dest, len(completed_parts),
+                             num_downloads)
+        # With memory mapping or positional writes, where available, the
+        # parts are written directly by the worker threads rather than by
+        # the IO thread.  Neither is the default as neither was found to
+        # write faster than the IO thread, see benchmarks/writers.py.
+        writer = None
+        if self.params['mmap'] and MappedFileWriter.SUPPORTED:
+            writer = MappedFileWriter(filename.dest, filename.size)
+        elif (self.params['pwrite'] or self.POSITIONAL_WRITES) and \
+                PositionalWriter.SUPPORTED:
+            writer = PositionalWriter(filename.dest)
+        verifier = None
+        if filename.md5:
+            verifier = IncrementalMD5(filename.dest, filename.size,
+                                      chunksize, num_downloads,
+                                      written_parts=completed_parts)
+        create_file_task = tasks.CreateLocalFileTask(
+            filename=filename, journal=journal,
+            completed_parts=completed_parts, writer=writer,
+            compare_md5=compare_md5)
+        complete_file_task = tasks.CompleteDownloadTask(
+            filename=filename, result_queue=self.result_queue,
+            params=self.params, io_queue=self.write_queue, journal=journal,
+            writer=writer, verifier=verifier, cache=self.cache,
+            fan_out=fan_out, future=future)
+        context = tasks.MultipartDownloadContext(
+            num_downloads, completed_parts=completed_parts,
+            create_file=create_file_task, on_completed=complete_file_task,
+            on_cancelled=complete_file_task.cancel,
+            on_skipped=complete_file_task.skip,
+            create_file_first=compare_md5)
+        if len(completed_parts) == num_downloads:
+            self.executor.submit(tasks.StartDownloadTask(context))
         self._do_enqueue_range_download_tasks(
             filename=filename, chunksize=chunksize,
             num_downloads=num_downloads, context=context,
+            journal=journal, completed_parts=completed_parts, writer=writer,
+            verifier=verifier, future=future,
         )
-        complete_file_task = tasks.CompleteDownloadTask(
-            context=context, filename=filename, result_queue=self.result_queue,
-            params=self.params, io_queue=self.write_queue)
-        self.executor.submit(complete_file_task)
         self._multipart_downloads.append((context, filename.dest))
-        return num_downloads
+        return num_downloads - len(completed_parts)
 
     def _do_enqueue_range_download_tasks(self, filename, chunksize,
                                          num_downloads, context,
-                                         remove_remote_file=False):
+                                         remove_remote_file=False,
+                                         journal=None, completed_parts=(),
+                                         writer=None, verifier=None,
+                                         future=None):
+        file_slots = [None] * num_downloads
+        if self.reorder_buffer is not None:
+            # A stream is never resumed, every part is downloaded.
+            first_slot = self.reorder_buffer.allocate(num_downloads)
+            file_slots = range(first_slot, first_slot + num_downloads)
         for i in range(num_downloads):
-            task = tasks.DownloadPartTask(
+            if i in completed_parts:
+                continue
+            task = self.PART_TASK_CLASS(
                 part_number=i, chunk_size=chunksize,
                 result_queue=self.result_queue, session=self.session,
-                filename=filename, context=context, io_queue=self.write_queue)
+                filename=filename, context=context, io_queue=self.write_queue,
+                journal=journal, writer=writer, buffer_pool=self.buffer_pool,
+                verifier=verifier, tuner=self.tuner,
+                rate_limiter=self.rate_limiter,
+                reorder_buffer=self.reorder_buffer, slot=file_slots[i],
+                file_slots=file_slots, future=future)
             self.executor.submit(task)
 
 
@@ -196,17 +734,46 @@ class StreamHandler(Handler):
     downloading streams.
     """
 
-    # This ensures that the number of multipart chunks waiting in the
-    # executor queue and in the threads is limited.
+    # The parts are downloaded by the threads at once and put back in
+    # order by the ``reorder_buffer``, there is no need to queue many.
     MAX_EXECUTOR_QUEUE_SIZE = 2
     EXECUTOR_NUM_THREADS = 6
+    PRESERVE_ORDER = True
+    # Parts wait for room in the reorder buffer while downloading, which
+    # is only made by the part being written, so limiting the number
+    # downloading at once, or starting them out of order, could deadlock.
+    SUPPORTS_AUTO_TUNE = False
+    FAIR_HOST_SCHEDULING = False
+    # Every document given is written to the stream.
+    DEDUPLICATE = False
 
-    def _enqueue_range_download_tasks(self, filename):
+    def __init__(self, *args, **kwargs):
+        super(StreamHandler, self).__init__(*args, **kwargs)
+        self.reorder_buffer = tasks.StreamReorderBuffer(
+            self.write_queue, self.params['stream_buffer_size'],
+            buffer_pool=self.buffer_pool)
+
+    def _shutdown(self):
+        super(StreamHandler, self)._shutdown()
+        # Wakes any part still waiting for room after an interrupt.
+        self.reorder_buffer.cancel()
+        LOGGER.debug("Held at most %s bytes to write the stream in order.",
+                     self.reorder_buffer.max_held_size)
+
+    def _enqueue_range_download_tasks(self, filename, fan_out=None,
+                                      future=None, compare_md5=False):
 
         # Create the context for the multipart download.
         chunksize = find_chunksize(filename.size, self.chunksize)
         num_downloads = int(filename.size / chunksize)
-        context = tasks.MultipartDownloadContext(num_downloads)
+        on_completed = on_cancelled = None
+        if future is not None:
+            on_completed = partial(future.set_result, 'downloaded')
+            on_cancelled = partial(future.set_exception,
+                                   "Download has been cancelled.")
+        context = tasks.MultipartDownloadContext(
+            num_downloads, on_completed=on_completed,
+            on_cancelled=on_cancelled)
 
         # No file is needed for downloading a stream.  So just announce
         # that it has been made since it is required for the context to
@@ -216,6 +783,26 @@ class StreamHandler(Handler):
         # Submit download part tasks to the executor.
         self._do_enqueue_range_download_tasks(
             filename=filename, chunksize=chunksize,
-            num_downloads=num_downloads, context=context,
+            num_downloads=num_downloads, context=context, future=future,
         )
         return num_downloads
+
+
+def _source(filename):
+    # The fragment only holds metadata for wgot.
+    return filename.src.split('#', 1)[0]
+
+
+def _keep_record(fan_outs, source, fan_out):
+    fan_outs[source] = fan_out.record()
+
+
+def _conflict(filename, other):
+    # Why ``other`` cannot be the same source as ``filename``, if the
+    # metadata listed for them says so.
+    if filename.md5 and other.md5 and filename.md5 != other.md5:
+        return "Source is also listed with md5 " + filename.md5
+    if filename.size is not None and other.size is not None and \
+            filename.size != other.size:
+        return "Source is also listed with size %s" % filename.size
+    return None
@@ -2,12 +2,19 @@ import logging
 import os
 import time
 import threading
+from collections import namedtuple
+from functools import partial
 
 import requests
+from requests.packages.urllib3.exceptions import ProtocolError, \
+    ReadTimeoutError
 
-from .utils import MD5Error, \
-    relative_path, IORequest, IOCloseRequest, \
-    IncompleteReadError, StreamingBody, PrintTask
+from .cache import place_file
+from .fileinfo import FileInfo, check_status, file_md5, set_last_update
+from .futures import read_callback
+from .utils import MD5Error, set_local_etag, \
+    relative_path, IORequest, IOCloseRequest, IOCallbackRequest, \
+    IncompleteReadError, MappedFileWriter, StreamingBody, PrintTask
 
 
 LOGGER = logging.getLogger(__name__)
@@ -25,6 +32,11 @@ class RetriesExeededError(Exception):
     pass
 
 
+class FileUnchangedError(Exception):
+    """Raised to skip a download as its local file is up to date."""
+    pass
+
+
 def print_operation(filename, failed, dryrun=False):
     """
     Helper function used to print out what an operation did and whether
@@ -37,11 +49,22 @@ def print_operation(filename, failed, dryrun=False):
         print_str += " failed"
     print_str += ": "
     print_str = print_str + filename.src
-    if not filename.is_stream:
+    if not filename.is_stream and filename.dest is not None:
         print_str += " to " + relative_path(filename.dest)
     return print_str
 
 
+def print_skip(filename):
+    """
+    Helper function used to print out that a file was skipped because the
+    local copy is up to date.
+    """
+    print_str = "skip: " + filename.src
+    if filename.dest is not None:
+        print_str += " to " + relative_path(filename.dest)
+    return print_str + " (unchanged)"
+
+
 class OrderableTask(object):
     PRIORITY = 10
 
@@ -52,18 +75,47 @@ class BasicTask(OrderableTask):
     It is practically a thread of execution.  It also injects the necessary
     attributes like ``session`` object in order for the filename to
     perform its designated operation.
+
+    If ``compare_md5`` is set the local file is skipped should it match
+    the md5 of the source, or downloaded unconditionally otherwise.
     """
     def __init__(self, session, filename, parameters,
-                 result_queue):
+                 result_queue, rate_limiter=None, cache=None, fan_out=None,
+                 reorder_buffer=None, slot=None, future=None,
+                 compare_md5=False):
         self.session = session
 
         self.filename = filename
 
         self.parameters = parameters
         self.result_queue = result_queue
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.fan_out = fan_out
+        self.reorder_buffer = reorder_buffer
+        self.slot = slot
+        self.future = future
+        self.compare_md5 = compare_md5
+        self._failed = False
+        self._md5_verified = False
+        # The md5 computed from the data downloaded.
+        self._md5 = None
+
+    @property
+    def host(self):
+        return self.filename.host
 
     def __call__(self):
-        self._execute_task(attempts=3)
+        if self.future is not None:
+            self.future.set_running()
+        try:
+            if not self._skip_unchanged():
+                self._execute_task(attempts=3)
+        finally:
+            if self.reorder_buffer is not None:
+                self.reorder_buffer.finish(self.slot, discard=self._failed)
+        if self.fan_out is not None:
+            self.fan_out.complete(not self._failed, self._md5_verified)
 
     def _execute_task(self, attempts, last_error=''):
         if attempts == 0:
@@ -75,16 +127,56 @@ class BasicTask(OrderableTask):
         filename = self.filename
         try:
             if not self.parameters['dryrun']:
-                filename.download(self.session)
+                if self._fetch_from_cache():
+                    return
+                throttle = read_size = None
+                if self.rate_limiter is not None:
+                    throttle = self.rate_limiter.throttle_for(
+                        filename.host)
+                    read_size = self.rate_limiter.read_size_for(
+                        filename.host)
+                throttle = read_callback(throttle, self.future)
+                stream_write = None
+                if self.reorder_buffer is not None:
+                    stream_write = partial(self.reorder_buffer.write,
+                                           self.slot)
+                self._md5 = filename.download(
+                    self.session, self.parameters['stream_verify'], throttle,
+                    conditional=self.parameters['sync'] and
+                    not self.compare_md5,
+                    stream_write=stream_write, read_size=read_size)
+                if self._md5 is None:
+                    self.result_queue.put(PrintTask(
+                        message=print_skip(filename), error=False))
+                    self._set_result('unchanged')
+                    return
+                # save_file raises an MD5Error unless the data matches
+                # the md5, if one is known by then.
+                self._md5_verified = bool(filename.md5)
+                if self.cache is not None and filename.md5 and \
+                        not filename.is_stream:
+                    self.cache.store(filename.md5, filename.dest)
         except requests.ConnectionError as e:
             connect_error = str(e)
             LOGGER.debug("%s %s failure: %s",
                          filename.src, filename.operation_name, connect_error)
-            self._execute_task(attempts - 1, last_error=str(e))
+            self._retry(attempts - 1, last_error=str(e))
         except MD5Error as e:
             LOGGER.debug("%s %s failure: Data was corrupted: %s",
                          filename.src, filename.operation_name, e)
-            self._execute_task(attempts - 1, last_error=str(e))
+            self._retry(attempts - 1, last_error=str(e))
+        except (ProtocolError, IncompleteReadError) as e:
+            # The connection was lost while reading the body.  The file
+            # is written again from the start, but not a stream, which
+            # already has what was read.
+            LOGGER.debug("%s %s failure: %s", filename.src,
+                         filename.operation_name, e)
+            if filename.is_stream:
+                self._queue_print_message(filename, failed=True,
+                                          dryrun=self.parameters['dryrun'],
+                                          error_message=str(e))
+            else:
+                self._retry(attempts - 1, last_error=str(e))
         except Exception as e:
             LOGGER.debug(str(e), exc_info=True)
             self._queue_print_message(filename, failed=True,
@@ -94,8 +186,51 @@ class BasicTask(OrderableTask):
             self._queue_print_message(filename, failed=False,
                                       dryrun=self.parameters['dryrun'])
 
+    def _retry(self, attempts, last_error):
+        if attempts and self.future is not None:
+            self.future.retried()
+        self._execute_task(attempts, last_error=last_error)
+
+    def _set_result(self, status, md5_verified=False):
+        if self.future is not None:
+            self.future.set_result(status, md5_verified)
+
+    def _skip_unchanged(self):
+        # Reading the whole local file to compare its md5 is left to the
+        # worker rather than the thread enqueuing the files.
+        if not self.compare_md5:
+            return False
+        try:
+            if not self.filename.is_unchanged():
+                return False
+        except (IOError, OSError) as e:
+            LOGGER.debug("Error comparing the md5 of %s: %s",
+                         self.filename.dest, e, exc_info=True)
+            return False
+        self.result_queue.put(PrintTask(message=print_skip(self.filename),
+                                        error=False))
+        self._md5_verified = True
+        self._set_result('unchanged', True)
+        return True
+
+    def _fetch_from_cache(self):
+        filename = self.filename
+        if self.cache is None or not filename.md5 or filename.is_stream:
+            return False
+        if not self.cache.fetch(filename.md5, filename.dest, filename.size):
+            return False
+        # The file is stamped as if it was downloaded, so -N and --sync
+        # find it up to date.
+        set_last_update(filename.dest, filename.last_update)
+        set_local_etag(filename.dest, filename.etag)
+        message = print_operation(filename, False) + ' (cached)'
+        self.result_queue.put(PrintTask(message=message, error=False))
+        self._set_result('cached')
+        return True
+
     def _queue_print_message(self, filename, failed, dryrun,
                              error_message=None):
+        self._failed = failed
         try:
             if filename.operation_name != 'list_objects':
                 message = print_operation(filename, failed,
@@ -106,59 +241,400 @@ class BasicTask(OrderableTask):
                 self.result_queue.put(PrintTask(**result))
         except Exception as e:
             LOGGER.debug('%s' % str(e))
+        if self.future is not None:
+            if failed:
+                self.future.set_exception(error_message)
+            else:
+                self.future.set_result('downloaded', self._md5_verified,
+                                       self._md5)
+
+
+# What is kept of a ``FanOut`` once its download is done, enough to copy
+# the file for destinations added after.
+FanOutRecord = namedtuple('FanOutRecord', ['src', 'dest', 'md5', 'size',
+                                           'succeeded', 'md5_verified'])
+
+
+class FanOut(object):
+    """
+    The other destinations of a source that is downloaded once.  Once the
+    download of ``filename`` is complete, ``complete`` is called and the
+    downloaded file is copied to each destination added, before or
+    after.  If the download failed, so do the others.  The
+    ``DownloadFuture`` given for a destination, or for a duplicate of the
+    download itself, is resolved once it is done, with the md5 verified
+    if it was for the download.  A destination listed with an md5 the
+    download was not verified against is checked against its own.  If
+    given, ``on_completed`` is called with the fan out once it is
+    complete and the destinations added so far are done, e.g. to keep its
+    ``record`` instead.  If ``sync`` is set, a destination whose local
+    file is up to date is skipped rather than copied to.
+    """
+    def __init__(self, filename, result_queue, on_completed=None,
+                 sync=False):
+        self.filename = filename
+        self._result_queue = result_queue
+        self._on_completed = on_completed
+        self._sync = sync
+        self._pending = []
+        self._duplicates = []
+        self._succeeded = None
+        self._md5_verified = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_record(cls, record, result_queue, sync=False):
+        """The completed ``FanOut`` that ``record`` was made of."""
+        filename = FileInfo(record.src, dest=record.dest, size=record.size,
+                            md5=record.md5)
+        fan_out = cls(filename, result_queue, sync=sync)
+        fan_out._succeeded = record.succeeded
+        fan_out._md5_verified = record.md5_verified
+        return fan_out
+
+    def record(self):
+        return FanOutRecord(self.filename.src, self.filename.dest,
+                            self.filename.md5, self.filename.size,
+                            self._succeeded, self._md5_verified)
+
+    def is_completed(self):
+        return self._succeeded is not None
+
+    def add(self, filename, future=None):
+        with self._lock:
+            if self._succeeded is None:
+                self._pending.append((filename, future))
+                return
+        self._finish(filename, future)
+
+    def add_duplicate(self, filename, future=None):
+        """
+        Adds a duplicate of the download itself, which is reported as a
+        file of its own if ``reports_duplicate`` says so.
+        """
+        report = self.reports_duplicate(filename)
+        with self._lock:
+            if self._succeeded is None:
+                self._duplicates.append((filename, future, report))
+                return
+        self._finish_duplicate(filename, future, report)
+
+    def reports_duplicate(self, filename):
+        # Only a duplicate with an md5 of its own to check the download
+        # against has anything to report.
+        return bool(filename.md5) and not self.filename.md5
+
+    def complete(self, succeeded, md5_verified=False):
+        with self._lock:
+            self._succeeded = succeeded
+            self._md5_verified = md5_verified
+            pending, self._pending = self._pending, []
+            duplicates, self._duplicates = self._duplicates, []
+        for filename, future in pending:
+            self._finish(filename, future)
+        for filename, future, report in duplicates:
+            self._finish_duplicate(filename, future, report)
+        if self._on_completed is not None:
+            self._on_completed(self)
+
+    def _finish_duplicate(self, filename, future=None, report=False):
+        error_message = None
+        md5_verified = self._md5_verified
+        if not self._succeeded:
+            error_message = "Download of %s failed" % self.filename.src
+        elif report:
+            error_message, md5_verified = self._verify_md5(filename)
+        if report:
+            message = print_operation(filename, error_message is not None)
+            if error_message is not None:
+                message += ' ' + error_message
+            else:
+                message += ' (duplicate of %s)' % self.filename.src
+            self._result_queue.put(PrintTask(
+                message=message, error=error_message is not None))
+        if future is not None:
+            if error_message is not None:
+                future.set_exception(error_message)
+            else:
+                future.set_result('duplicate', md5_verified)
+
+    def _finish(self, filename, future=None):
+        error_message = None
+        md5_verified = False
+        if not self._succeeded:
+            error_message = "Download of %s failed" % self.filename.src
+        elif self._sync and self._is_unchanged(filename):
+            self._result_queue.put(PrintTask(message=print_skip(filename),
+                                             error=False))
+            if future is not None:
+                future.set_result('unchanged')
+            return
+        else:
+            try:
+                place_file(self.filename.dest, filename.dest)
+                error_message, md5_verified = self._verify_md5(filename)
+                if error_message is not None:
+                    os.remove(filename.dest)
+                else:
+                    # As a download would, so that the copy is up to date
+                    # for the next sync.
+                    set_last_update(filename.dest, filename.last_update)
+                    set_local_etag(filename.dest, filename.etag)
+            except Exception as e:
+                LOGGER.debug("Error copying %s to %s: %s",
+                             self.filename.dest, filename.dest, e,
+                             exc_info=True)
+                error_message = str(e)
+        message = print_operation(filename, error_message is not None)
+        if error_message is not None:
+            message += ' ' + error_message
+        else:
+            message += ' (copied from %s)' % relative_path(
+                self.filename.dest)
+        self._result_queue.put(PrintTask(message=message,
+                                         error=error_message is not None))
+        if future is not None:
+            if error_message is not None:
+                future.set_exception(error_message)
+            else:
+                future.set_result('copied', md5_verified)
+
+    def _is_unchanged(self, filename):
+        try:
+            return filename.is_unchanged()
+        except (IOError, OSError) as e:
+            LOGGER.debug("Error comparing the md5 of %s: %s",
+                         filename.dest, e, exc_info=True)
+            return False
+
+    def _verify_md5(self, filename):
+        # Returns the error, if any, and whether the md5 of ``filename``
+        # was verified, by the download or by hashing its file.
+        if not filename.md5 or (self._md5_verified and
+                                filename.md5 == self.filename.md5):
+            return None, self._md5_verified
+        md5_hex = file_md5(filename.dest)
+        if md5_hex != filename.md5:
+            error_message = "Data was corrupted: md5 %s != %s" % (
+                md5_hex, filename.md5)
+            LOGGER.debug("%s download failure: %s", filename.src,
+                         error_message)
+            return error_message, False
+        return None, True
+
+
+class FanOutTask(OrderableTask):
+    """
+    Adds a destination, or a duplicate if ``duplicate`` is set, to a
+    ``FanOut`` whose download is already complete, so that the file is
+    copied or checked by a worker rather than the thread enqueuing them.
+    """
+    def __init__(self, fan_out, filename, future=None, duplicate=False):
+        self._fan_out = fan_out
+        self._filename = filename
+        self._future = future
+        self._duplicate = duplicate
+        self._completed = False
+
+    def __call__(self):
+        try:
+            if self._duplicate:
+                self._fan_out.add_duplicate(self._filename, self._future)
+            else:
+                self._fan_out.add(self._filename, self._future)
+        finally:
+            self._completed = True
+
+    def is_completed(self):
+        return self._completed
 
 
 class CreateLocalFileTask(OrderableTask):
-    def __init__(self, context, filename):
-        self._context = context
+    """
+    Creates the local file of a multipart download.  This is run by the
+    ``MultipartDownloadContext`` for the first part that needs the file.
+    If ``compare_md5`` is set, the md5 of the local file is compared
+    first, and a ``FileUnchangedError`` raised if it is up to date.
+    """
+    def __init__(self, filename, journal=None, completed_parts=(),
+                 writer=None, compare_md5=False):
         self._filename = filename
+        self._journal = journal
+        self._completed_parts = completed_parts
+        self._writer = writer
+        self._compare_md5 = compare_md5
 
     def __call__(self):
+        if self._compare_md5 and self._is_unchanged():
+            raise FileUnchangedError(self._filename.dest)
         dirname = os.path.dirname(self._filename.dest)
-        try:
-            if not os.path.isdir(dirname):
-                try:
-                    os.makedirs(dirname)
-                except OSError:
-                    # It's possible that between the if check and the makedirs
-                    # check that another thread has come along and created the
-                    # directory.  In this case the directory already exists and we
-                    # can move on.
-                    pass
-            # Always create the file.  Even if it exists, we need to
-            # wipe out the existing contents.
-            with open(self._filename.dest, 'wb'):
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # It's possible that between the if check and the makedirs
+                # check that another thread has come along and created the
+                # directory.  In this case the directory already exists and we
+                # can move on.
                 pass
-        except Exception as e:
-            self._context.cancel()
+        # Always create the file.  Even if it exists, we need to wipe
+        # out the existing contents, unless we're resuming a download
+        # and keep the parts that have already been written.
+        truncate = not self._completed_parts
+        if self._writer is not None:
+            self._writer.open(truncate=truncate)
         else:
-            self._context.announce_file_created()
+            with open(self._filename.dest, 'wb' if truncate else 'ab'):
+                pass
+        # The file is no longer the one its ETag was recorded for.
+        set_local_etag(self._filename.dest, None)
+        if self._journal is not None:
+            self._journal.start(self._completed_parts)
 
+    def _is_unchanged(self):
+        try:
+            return self._filename.is_unchanged()
+        except (IOError, OSError) as e:
+            LOGGER.debug("Error comparing the md5 of %s: %s",
+                         self._filename.dest, e, exc_info=True)
+            return False
 
-class CompleteDownloadTask(OrderableTask):
-    def __init__(self, context, filename, result_queue, params, io_queue):
+
+class StartDownloadTask(OrderableTask):
+    """
+    Starts a multipart download that has no parts left to download, e.g.
+    a resumed download whose parts were all written by a previous run.
+    Starting it creates the file, which completes the download.
+    """
+    def __init__(self, context):
         self._context = context
+
+    def __call__(self):
+        self._context.wait_for_file_created()
+
+
+class CompleteDownloadTask(OrderableTask):
+    """
+    Finishes a multipart download.  This is run by the
+    ``MultipartDownloadContext`` in the thread that completes the last
+    part, or its ``cancel`` method is run if the download is cancelled.
+    """
+    def __init__(self, filename, result_queue, params, io_queue,
+                 journal=None, writer=None, verifier=None, cache=None,
+                 fan_out=None, future=None):
         self._filename = filename
         self._result_queue = result_queue
         self._parameters = params
         self._io_queue = io_queue
+        self._journal = journal
+        self._writer = writer
+        self._verifier = verifier
+        self._cache = cache
+        self._fan_out = fan_out
+        self._future = future
+        self._error_message = None
 
     def __call__(self):
         # When the file is downloading, we have a few things we need to do:
-        # 1) Fix up the last modified time to match s3.
-        # 2) Tell the result_queue we're done.
-        # 3) Queue an IO request to the IO thread letting it know we're
+        # 1) Close the file if the parts were written to it directly.
+        # 2) Check the md5 of the file, if we know it.
+        # 3) Tell the result_queue we're done.
+        # 4) Queue an IO request to the IO thread letting it know we're
         #    done with the file.
-        self._context.wait_for_completion()
+        # 5) Once the file is closed, fix up the last modified time to
+        #    match s3, or remove the file if it was corrupted.
+        error_message = None
+        try:
+            if self._writer is not None:
+                self._writer.close(fsync=self._parameters['fsync'])
+            error_message = self._verify_md5()
+        except Exception as e:
+            LOGGER.debug("Error completing download of %s: %s",
+                         self._filename.dest, e, exc_info=True)
+            error_message = str(e)
+        message = print_operation(self._filename, error_message is not None,
+                                  self._parameters['dryrun'])
+        if error_message is not None:
+            message += ' ' + error_message
+            self._error_message = error_message
+            finish = self._remove_file
+        else:
+            finish = self._finish_file
+        print_task = {'message': message, 'error': error_message is not None}
+        self._result_queue.put(PrintTask(**print_task))
+        if self._writer is None:
+            self._io_queue.put(IOCloseRequest(self._filename.dest,
+                                              self._parameters['fsync']))
+            self._io_queue.put(IOCallbackRequest(self._filename.dest, finish))
+        else:
+            finish()
+
+    def cancel(self):
+        try:
+            if self._writer is not None:
+                self._writer.close()
+        finally:
+            # Whoever waits on the download must hear of it regardless.
+            if self._fan_out is not None:
+                self._fan_out.complete(False)
+            if self._future is not None:
+                self._future.set_exception("Download has been cancelled.")
+
+    def skip(self):
+        # The local file was found to be up to date by its md5 before it
+        # was opened.
+        self._result_queue.put(PrintTask(message=print_skip(self._filename),
+                                         error=False))
+        if self._future is not None:
+            self._future.set_result('unchanged', True)
+        if self._fan_out is not None:
+            self._fan_out.complete(True, True)
+
+    def _verify_md5(self):
+        if self._verifier is None:
+            return None
+        try:
+            md5_hex = self._verifier.hexdigest()
+        except Exception as e:
+            LOGGER.debug("Error computing md5 of %s: %s",
+                         self._filename.dest, e, exc_info=True)
+            return str(e)
+        if md5_hex != self._filename.md5:
+            error_message = "Data was corrupted: md5 %s != %s" % (
+                md5_hex, self._filename.md5)
+            LOGGER.debug("%s download failure: %s", self._filename.src,
+                         error_message)
+            return error_message
+        return None
+
+    def _finish_file(self):
+        if self._journal is not None:
+            self._journal.remove()
         if self._filename.last_update:
             last_update_tuple = self._filename.last_update.timetuple()
             mod_timestamp = time.mktime(last_update_tuple)
             os.utime(self._filename.dest, (int(mod_timestamp), int(mod_timestamp)))
-        message = print_operation(self._filename, False,
-                                  self._parameters['dryrun'])
-        print_task = {'message': message, 'error': False}
-        self._result_queue.put(PrintTask(**print_task))
-        self._io_queue.put(IOCloseRequest(self._filename.dest))
+        set_local_etag(self._filename.dest, self._filename.etag)
+        if self._cache is not None and self._verifier is not None:
+            # Only a file whose md5 was verified can be cached under it.
+            self._cache.store(self._filename.md5, self._filename.dest)
+        # The md5 was compared by _verify_md5 if there is a verifier.
+        md5_verified = self._verifier is not None
+        if self._future is not None:
+            self._future.set_result('downloaded', md5_verified)
+        if self._fan_out is not None:
+            self._fan_out.complete(True, md5_verified)
+
+    def _remove_file(self):
+        # None of the parts can be trusted, so don't resume from them.
+        if self._journal is not None:
+            self._journal.remove()
+        if os.path.exists(self._filename.dest):
+            os.remove(self._filename.dest)
+        if self._future is not None:
+            self._future.set_exception(self._error_message)
+        if self._fan_out is not None:
+            self._fan_out.complete(False)
 
 
 class DownloadPartTask(OrderableTask):
@@ -177,7 +653,10 @@ class DownloadPartTask(OrderableTask):
     TOTAL_ATTEMPTS = 5
 
     def __init__(self, part_number, chunk_size, result_queue, session,
-                 filename, context, io_queue):
+                 filename, context, io_queue, journal=None, writer=None,
+                 buffer_pool=None, verifier=None, tuner=None,
+                 rate_limiter=None, reorder_buffer=None, slot=None,
+                 file_slots=None, future=None):
         self._part_number = part_number
         self._chunk_size = chunk_size
         self._result_queue = result_queue
@@ -185,172 +664,392 @@ class DownloadPartTask(OrderableTask):
         self.session = session
         self._context = context
         self._io_queue = io_queue
+        self._journal = journal
+        self._writer = writer
+        self._buffer_pool = buffer_pool
+        self._verifier = verifier
+        self._tuner = tuner
+        self._reorder_buffer = reorder_buffer
+        self._slot = slot
+        # The slots of all of the parts of the file.
+        self._file_slots = file_slots
+        self._future = future
+        # For the events of the part.
+        self._amount_read = 0
+        self._start_time = None
+        self._retries = 0
+        self._http_status = None
+        throttle = None
+        # Throttled reads are kept small, see TokenBucket.
+        self._read_size = self.ITERATE_CHUNK_SIZE
+        if rate_limiter is not None:
+            throttle = rate_limiter.throttle_for(filename.host)
+            read_size = rate_limiter.read_size_for(filename.host)
+            if read_size is not None:
+                self._read_size = min(self._read_size, read_size)
+        self._throttle = read_callback(throttle, future)
+
+    @property
+    def host(self):
+        return self._filename.host
 
     def __call__(self):
         try:
-            self._download_part()
+            if self._tuner is None:
+                self._download_part()
+            else:
+                self._download_part_tuned()
         except Exception as e:
-            LOGGER.debug(
-                'Exception caught downloading byte range: %s',
-                e, exc_info=True)
-            self._context.cancel()
+            self._part_failed(e)
             raise e
+        if self._reorder_buffer is not None:
+            self._reorder_buffer.finish(self._slot)
 
-    def _download_part(self):
+    def _part_failed(self, e):
+        LOGGER.debug(
+            'Exception caught downloading byte range: %s',
+            e, exc_info=True)
+        if self._future is not None and \
+                not isinstance(e, DownloadCancelledError):
+            self._future.part_done(
+                self._part_number, self._amount_read,
+                self._part_duration(), self._retries,
+                self._http_status, error=str(e))
+        if not isinstance(e, DownloadCancelledError) and \
+                not self._context.is_cancelled():
+            # Only the part that cancels the download reports it, the
+            # others fail because of it.
+            message = print_operation(self._filename, True) + ' ' + \
+                str(e)
+            self._result_queue.put(PrintTask(message=message,
+                                             error=True))
+            if self._future is not None:
+                self._future.set_exception(str(e))
+        self._context.cancel()
+        if self._reorder_buffer is not None:
+            # The other parts of the file are left out of the stream too.
+            self._reorder_buffer.discard(self._file_slots)
+
+    def _download_part_tuned(self):
+        # The tuner limits how many parts are downloaded at once and
+        # learns from how long each one took.
+        self._tuner.acquire()
+        self._amount_read = 0
+        start_time = time.time()
+        try:
+            self._download_part()
+        finally:
+            self._tuner.release(self._amount_read, time.time() - start_time)
+
+    def _start_part(self):
+        # Returns the start and end of the range of the part.
         total_file_size = self._filename.size
         start_range = self._part_number * self._chunk_size
         if self._part_number == int(total_file_size / self._chunk_size) - 1:
             end_range = ''
+            part_size = total_file_size - start_range
         else:
             end_range = start_range + self._chunk_size - 1
-        range_param = 'bytes=%s-%s' % (start_range, end_range)
-        LOGGER.debug("Downloading bytes range of %s for file %s", range_param,
-                     self._filename.dest)
+            part_size = self._chunk_size
+        LOGGER.debug("Downloading bytes range of %s-%s for file %s",
+                     start_range, end_range, self._filename.dest)
+        # The number of bytes of the part that have been queued for
+        # writing.  A retry only requests the bytes after these.
+        self._amount_read = 0
+        self._part_size = part_size
+        self._start_time = time.time()
+        if self._future is not None:
+            self._future.set_running()
+        return start_range, end_range
+
+    def _download_part(self):
+        start_range, end_range = self._start_part()
+        part_size = self._part_size
+        if self._context.create_file_first:
+            self._context.wait_for_file_created()
         for i in range(self.TOTAL_ATTEMPTS):
+            self._retries = i
+            if i and self._future is not None:
+                self._future.retried()
             try:
-                LOGGER.debug("Making GetObject requests with byte range: %s",
-                             range_param)
-                response = self.session.get(
-                    self._filename.src,
-                    headers={'Range': range_param},
-                    stream=True,
-                    timeout=(self.CONNECT_TIMEOUT, self.READ_TIMEOUT))
-                LOGGER.debug("Response received from GetObject")
-                self._filename.set_info_from_headers(response)
-                body = StreamingBody(response)
-                self._queue_writes(body)
-                self._context.announce_completed_part(self._part_number)
-
-                message = print_operation(self._filename, 0)
-                total_parts = int(self._filename.size / self._chunk_size)
-                result = {'message': message, 'error': False,
-                          'total_parts': total_parts}
-                self._result_queue.put(PrintTask(**result))
-                LOGGER.debug("Task complete: %s", self)
+                if self._amount_read < part_size:
+                    range_param = 'bytes=%s-%s' % (
+                        start_range + self._amount_read, end_range)
+                    LOGGER.debug(
+                        "Making GetObject requests with byte range: %s",
+                        range_param)
+                    response = self.session.get(
+                        self._filename.src,
+                        headers={'Range': range_param},
+                        stream=True,
+                        timeout=(self.CONNECT_TIMEOUT, self.READ_TIMEOUT))
+                    LOGGER.debug("Response received from GetObject")
+                    self._http_status = response.status_code
+                    # Anything but the range asked for would be written
+                    # at the wrong place.
+                    check_status(response, 206)
+                    self._filename.set_info_from_headers(response)
+                    body = StreamingBody(response, self._throttle)
+                    self._queue_writes(body)
+                self._part_completed()
                 return
-            except requests.Timeout as e:
-                LOGGER.debug("Socket timeout caught, retrying request, "
-                             "(attempt %s / %s)", i, self.TOTAL_ATTEMPTS,
-                             exc_info=True)
+            except (requests.Timeout, ReadTimeoutError) as e:
+                LOGGER.debug("Socket timeout caught after %s bytes, retrying "
+                             "request, (attempt %s / %s)", self._amount_read,
+                             i, self.TOTAL_ATTEMPTS, exc_info=True)
                 continue
-            except IncompleteReadError as e:
-                LOGGER.debug("Incomplete read detected: %s, (attempt %s / %s)",
-                             e, i, self.TOTAL_ATTEMPTS)
+            except (IncompleteReadError, ProtocolError) as e:
+                LOGGER.debug("Incomplete read detected after %s bytes: %s, "
+                             "(attempt %s / %s)", self._amount_read, e, i,
+                             self.TOTAL_ATTEMPTS)
                 continue
         raise RetriesExeededError("Maximum number of attempts exceeded: %s" %
                                   self.TOTAL_ATTEMPTS)
 
+    def _part_completed(self):
+        self._record_part()
+        if self._future is not None:
+            self._future.part_done(
+                self._part_number, self._amount_read,
+                self._part_duration(), self._retries,
+                self._http_status)
+        self._context.announce_completed_part(self._part_number)
+
+        message = print_operation(self._filename, 0)
+        total_parts = int(self._filename.size / self._chunk_size)
+        result = {'message': message, 'error': False,
+                  'total_parts': total_parts}
+        self._result_queue.put(PrintTask(**result))
+        LOGGER.debug("Task complete: %s", self)
+
+    def _part_duration(self):
+        if self._start_time is None:
+            return 0.0
+        return time.time() - self._start_time
+
+    def _record_part(self):
+        if self._journal is None and self._verifier is None:
+            return
+        if self._writer is not None:
+            # The part has already been written to the file.
+            self._part_written()
+        else:
+            # The IO thread records the part only after the writes
+            # queued before it have been made.
+            self._io_queue.put(
+                IOCallbackRequest(self._filename.dest, self._part_written))
+
+    def _part_written(self):
+        if self._journal is not None:
+            self._journal.record(self._part_number)
+        if self._verifier is not None:
+            self._verifier.part_written(self._part_number)
+
     def _queue_writes(self, body):
+        # The first part to get here creates the file.
         self._context.wait_for_file_created()
         LOGGER.debug("Writing part number %s to file: %s",
                      self._part_number, self._filename.dest)
-        iterate_chunk_size = self.ITERATE_CHUNK_SIZE
+        iterate_chunk_size = self._read_size
         if self._filename.is_stream:
             self._queue_writes_for_stream(body)
+        elif isinstance(self._writer, MappedFileWriter):
+            self._read_into_window(body, iterate_chunk_size)
         else:
             self._queue_writes_in_chunks(body, iterate_chunk_size)
 
     def _queue_writes_for_stream(self, body):
         # We have to handle an output stream differently.  The main reason is
-        # that we cannot seek() in the output stream.  This means that we need
-        # to queue the writes in order.  If we queue IO writes in smaller than
-        # part size chunks, on the case of a retry we'll need to do a range GET
-        # for only the remaining parts.  The other alternative, which is what
-        # we do here, is to just request the entire chunk size write.
-        self._context.wait_for_turn(self._part_number)
-        chunk = body.read()
-        offset = self._part_number * self._chunk_size
-        LOGGER.debug("Submitting IORequest to write queue.")
-        self._io_queue.put(
-            IORequest(self._filename.dest, offset, chunk,
-                      self._filename.is_stream)
-        )
-        self._context.done_with_turn()
+        # that we cannot seek() in the output stream.  The reorder buffer
+        # writes the chunks of the part being written and holds on to the
+        # chunks of the parts after it until their turn.  A retry only
+        # requests the bytes after the ones already written so it's safe
+        # to write them in smaller chunks.
+        current = self._read_chunk(body, self._read_size)
+        while current:
+            if self._context.is_cancelled():
+                raise DownloadCancelledError("Download has been cancelled.")
+            self._reorder_buffer.write(self._slot, current)
+            self._amount_read += len(current)
+            current = self._read_chunk(body, self._read_size)
+        LOGGER.debug("Done queueing writes for part number %s to stream.",
+                     self._part_number)
+
+    def _read_into_window(self, body, iterate_chunk_size):
+        # The response is read straight into the part's window of the
+        # memory mapped file, there is nothing to queue.
+        start_range = self._part_number * self._chunk_size
+        window = self._writer.window(start_range, self._part_size)
+        try:
+            while self._amount_read < self._part_size:
+                end = min(self._amount_read + iterate_chunk_size,
+                          self._part_size)
+                chunk = window[self._amount_read:end]
+                try:
+                    amount = body.readinto(chunk)
+                finally:
+                    chunk.release()
+                if not amount:
+                    break
+                self._amount_read += amount
+        finally:
+            self._writer.release_window(window)
+        # Drain the response so its content length is verified.
+        body.read()
+        LOGGER.debug("Done reading part number %s into file: %s",
+                     self._part_number, self._filename.dest)
+
+    def _read_chunk(self, body, iterate_chunk_size):
+        if self._buffer_pool is None:
+            return body.read(iterate_chunk_size)
+        return body.read_pooled(self._buffer_pool, iterate_chunk_size)
 
     def _queue_writes_in_chunks(self, body, iterate_chunk_size):
-        amount_read = 0
-        current = body.read(iterate_chunk_size)
+        current = self._read_chunk(body, iterate_chunk_size)
         while current:
-            offset = self._part_number * self._chunk_size + amount_read
-            LOGGER.debug("Submitting IORequest to write queue.")
-            self._io_queue.put(
-                IORequest(self._filename.dest, offset, current,
-                          self._filename.is_stream)
-            )
-            LOGGER.debug("Request successfully submitted.")
-            amount_read += len(current)
-            current = body.read(iterate_chunk_size)
+            offset = self._part_number * self._chunk_size + self._amount_read
+            amount = len(current)
+            if self._writer is not None:
+                self._writer.write(current, offset)
+                if self._buffer_pool is not None:
+                    self._buffer_pool.release(current)
+            else:
+                # The IO thread releases pooled buffers once written.
+                LOGGER.debug("Submitting IORequest to write queue.")
+                self._io_queue.put(
+                    IORequest(self._filename.dest, offset, current,
+                              self._filename.is_stream)
+                )
+                LOGGER.debug("Request successfully submitted.")
+            self._amount_read += amount
+            current = self._read_chunk(body, iterate_chunk_size)
         # Change log message.
         LOGGER.debug("Done queueing writes for part number %s to file: %s",
                      self._part_number, self._filename.dest)
 
 
 class MultipartDownloadContext(object):
+    """
+    Tracks the state of a multipart download.  Rather than having threads
+    wait for the file to be created or for the download to complete, the
+    context creates the file with ``create_file`` for the first part that
+    needs it and calls ``on_completed`` in the thread that completes the
+    last part (or ``on_cancelled`` if the download is cancelled).
+
+    If ``create_file`` raises a ``FileUnchangedError`` the download is
+    skipped instead, calling ``on_skipped``.  A context made with
+    ``create_file_first`` set is expected to be, so its parts wait for
+    the file to be created before requesting their range.
+    """
 
     _STATES = {
         'UNSTARTED': 'UNSTARTED',
         'STARTED': 'STARTED',
         'COMPLETED': 'COMPLETED',
-        'CANCELLED': 'CANCELLED'
+        'CANCELLED': 'CANCELLED',
+        'SKIPPED': 'SKIPPED'
     }
 
-    def __init__(self, num_parts, lock=None):
+    def __init__(self, num_parts, lock=None, completed_parts=(),
+                 create_file=None, on_completed=None, on_cancelled=None,
+                 on_skipped=None, create_file_first=False):
         self.num_parts = num_parts
+        self.create_file_first = create_file_first
 
         if lock is None:
             lock = threading.Lock()
         self._lock = lock
         self._created_condition = threading.Condition(self._lock)
-        self._submit_write_condition = threading.Condition(self._lock)
         self._completed_condition = threading.Condition(self._lock)
         self._state = self._STATES['UNSTARTED']
-        self._finished_parts = set()
-        self._current_stream_part_number = 0
+        self._finished_parts = set(completed_parts)
+        self._create_file = create_file
+        self._on_completed = on_completed
+        self._on_cancelled = on_cancelled
+        self._on_skipped = on_skipped
 
     def announce_completed_part(self, part_number):
         with self._completed_condition:
             self._finished_parts.add(part_number)
-            if len(self._finished_parts) == self.num_parts:
-                self._state = self._STATES['COMPLETED']
-                self._completed_condition.notifyAll()
+            is_completed = self._check_completed()
+        if is_completed:
+            self._run_callback(self._on_completed)
 
     def announce_file_created(self):
         with self._created_condition:
             self._state = self._STATES['STARTED']
             self._created_condition.notifyAll()
+            # Every part may have been completed by a previous, resumed run.
+            is_completed = self._check_completed()
+        if is_completed:
+            self._run_callback(self._on_completed)
+
+    def _check_completed(self):
+        if len(self._finished_parts) == self.num_parts and \
+                self._state == self._STATES['STARTED']:
+            self._state = self._STATES['COMPLETED']
+            self._completed_condition.notifyAll()
+            return True
+        return False
+
+    def _run_callback(self, callback):
+        if callback is None:
+            return
+        try:
+            callback()
+        except Exception as e:
+            LOGGER.debug('Error calling download callback: %s', e,
+                         exc_info=True)
 
     def wait_for_file_created(self):
         with self._created_condition:
-            while not self._state == self._STATES['STARTED']:
-                if self._state == self._STATES['CANCELLED']:
-                    raise DownloadCancelledError(
-                        "Download has been cancelled.")
+            create_file, self._create_file = self._create_file, None
+        if create_file is not None:
+            # Only the first caller creates the file, the others wait for
+            # it below, which only takes as long as opening the file.
+            try:
+                create_file()
+            except FileUnchangedError:
+                self.skip()
+            except Exception as e:
+                LOGGER.debug('Error creating file: %s', e, exc_info=True)
+                self.cancel()
+            else:
+                self.announce_file_created()
+        with self._created_condition:
+            while self._state == self._STATES['UNSTARTED']:
                 self._created_condition.wait(timeout=1)
+            if self._state in (self._STATES['CANCELLED'],
+                               self._STATES['SKIPPED']):
+                raise DownloadCancelledError(
+                    "Download has been cancelled.")
 
     def wait_for_completion(self):
         with self._completed_condition:
             while not self._state == self._STATES['COMPLETED']:
-                if self._state == self._STATES['CANCELLED']:
+                if self._state in (self._STATES['CANCELLED'],
+                                   self._STATES['SKIPPED']):
                     raise DownloadCancelledError(
                         "Download has been cancelled.")
                 self._completed_condition.wait(timeout=1)
 
-    def wait_for_turn(self, part_number):
-        with self._submit_write_condition:
-            while self._current_stream_part_number != part_number:
-                if self._state == self._STATES['CANCELLED']:
-                    raise DownloadCancelledError(
-                        "Download has been cancelled.")
-                self._submit_write_condition.wait(timeout=0.2)
-
-    def done_with_turn(self):
-        with self._submit_write_condition:
-            self._current_stream_part_number += 1
-            self._submit_write_condition.notifyAll()
-
     def cancel(self):
         with self._lock:
-            self._state = self._STATES['CANCELLED']
+            was_running = self._state in (self._STATES['UNSTARTED'],
+                                          self._STATES['STARTED'])
+            if self._state != self._STATES['SKIPPED']:
+                self._state = self._STATES['CANCELLED']
+            self._created_condition.notifyAll()
+        if was_running:
+            self._run_callback(self._on_cancelled)
+
+    def skip(self):
+        with self._lock:
+            if self._state != self._STATES['UNSTARTED']:
+                return
+            self._state = self._STATES['SKIPPED']
+            self._created_condition.notifyAll()
+        self._run_callback(self._on_skipped)
 
     def is_cancelled(self):
         with self._lock:
@@ -359,3 +1058,153 @@ class MultipartDownloadContext(object):
     def is_started(self):
         with self._lock:
             return self._state == self._STATES['STARTED']
+
+    def is_completed(self):
+        # A skipped download is done with too.
+        with self._lock:
+            return self._state in (self._STATES['COMPLETED'],
+                                   self._STATES['SKIPPED'])
+
+
+class StreamReorderBuffer(object):
+    """
+    Puts the parts written to an output stream back in order.  Each part,
+    or whole file if it is not downloaded in parts, is given a ``slot``
+    with ``allocate`` in the order it is to be written, so the documents
+    are concatenated in the order given too.  The chunks written for the
+    earliest unfinished slot go straight to the ``io_queue``, those of
+    later slots are held in memory until the slots before them are
+    finished, so parts and the files after them can download concurrently
+    while the stream is written in order.
+
+    No more than ``max_size`` bytes are held, past that ``write`` blocks
+    until there is room or it is the slot's turn.  The earliest slot never
+    waits for room, so the stream keeps moving as long as the part being
+    written is downloading, which it is if the parts are started in
+    order.
+
+    The slots of a file that fails are abandoned with ``discard``, all of
+    them, so none of its parts is written.  Should some of its chunks have
+    been written already, the stream is cancelled instead, as the rest of
+    the file can't be left out from the middle of it.
+    """
+
+    def __init__(self, io_queue, max_size, buffer_pool=None):
+        if max_size < 0:
+            raise ValueError("The stream buffer size must not be negative: "
+                             "%s" % max_size)
+        self.max_size = max_size
+        self._io_queue = io_queue
+        self._buffer_pool = buffer_pool
+        self._condition = threading.Condition(threading.Lock())
+        self._num_slots = 0
+        self._current_slot = 0
+        self._held = {}
+        self._finished = set()
+        self._discarded = set()
+        self._held_size = 0
+        # The last slot of which chunks were queued, the slots are written
+        # in order.
+        self._last_written_slot = -1
+        self._cancelled = False
+        # The most held at once, for the debug log.
+        self.max_held_size = 0
+
+    def allocate(self, num_slots=1):
+        """
+        Returns the next slot of the stream, the first of ``num_slots``
+        consecutive ones if more are needed, e.g. for the parts of a file.
+        """
+        with self._condition:
+            slot = self._num_slots
+            self._num_slots += num_slots
+            return slot
+
+    def write(self, slot, data):
+        with self._condition:
+            while slot != self._current_slot and \
+                    self._held_size + len(data) > self.max_size and \
+                    not self._cancelled:
+                self._condition.wait(timeout=1)
+            if self._cancelled or slot in self._discarded:
+                raise DownloadCancelledError("Download has been cancelled.")
+            if slot == self._current_slot:
+                # The lock is held while queueing so that nothing is
+                # queued out of order as the slots move on.
+                self._queue_write(slot, data)
+            else:
+                self._held.setdefault(slot, []).append(data)
+                self._held_size += len(data)
+                self.max_held_size = max(self.max_held_size,
+                                         self._held_size)
+
+    def finish(self, slot, discard=False):
+        """
+        Marks ``slot`` as written in full, or, if ``discard`` is set, as
+        abandoned, see ``discard``.
+        """
+        if discard:
+            self.discard([slot])
+            return
+        with self._condition:
+            if slot in self._discarded:
+                return
+            self._finished.add(slot)
+            self._advance()
+
+    def discard(self, slots):
+        """
+        Abandons ``slots``, the chunks held for them are dropped and no
+        more is written for them.  The stream is cancelled if any was
+        written already.  Slots discarded before are left alone, so each
+        part of a failed file may discard all of the file's slots.
+        """
+        with self._condition:
+            slots = [slot for slot in slots if slot not in self._discarded]
+            if not slots or self._cancelled:
+                return
+            if min(slots) <= self._last_written_slot:
+                LOGGER.debug("Cancelling the stream as slots %s-%s were "
+                             "partly written.", min(slots), max(slots))
+                self._cancel()
+                return
+            for slot in slots:
+                self._discarded.add(slot)
+                for data in self._held.pop(slot, ()):
+                    self._held_size -= len(data)
+                    self._release(data)
+                self._finished.add(slot)
+            self._advance()
+
+    def cancel(self):
+        """Drops the chunks held and stops writes waiting for room."""
+        with self._condition:
+            self._cancel()
+
+    def _advance(self):
+        # Writes the chunks held for the slots that are next in turn.
+        while self._current_slot in self._finished and \
+                not self._cancelled:
+            self._finished.remove(self._current_slot)
+            self._current_slot += 1
+            for data in self._held.pop(self._current_slot, ()):
+                self._held_size -= len(data)
+                self._queue_write(self._current_slot, data)
+        self._condition.notify_all()
+
+    def _cancel(self):
+        self._cancelled = True
+        for chunks in self._held.values():
+            for data in chunks:
+                self._release(data)
+        self._held.clear()
+        self._held_size = 0
+        self._condition.notify_all()
+
+    def _queue_write(self, slot, data):
+        self._last_written_slot = slot
+        self._io_queue.put(IORequest(None, None, data, True))
+
+    def _release(self, data):
+        if self._buffer_pool is not None and isinstance(data, memoryview):
+            self._buffer_pool.release(data)
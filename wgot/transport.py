@@ -0,0 +1,469 @@
+import inspect
+import logging
+import threading
+import zlib
+from collections import deque, namedtuple
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.packages.urllib3.exceptions import DecodeError, ProtocolError
+from requests.packages.urllib3.response import DeflateDecoder, GzipDecoder, \
+    MultiDecoder
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers, select_proxy
+
+try:
+    import h2
+    import httpx
+except ImportError:
+    h2 = httpx = None
+
+
+LOGGER = logging.getLogger(__name__)
+
+ConnectionStats = namedtuple('ConnectionStats',
+                             ['num_requests', 'num_connections'])
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    An ``HTTPAdapter`` that keeps connection pools for up to
+    ``pool_connections`` hosts with up to ``pool_maxsize`` connections
+    each, and counts how many requests were made over how many
+    connections so the reuse of kept-alive connections can be reported.
+    """
+    def __init__(self, pool_connections, pool_maxsize, **kwargs):
+        self._stats_lock = threading.Lock()
+        # The totals of the pools that have already been discarded.
+        self._num_requests = 0
+        self._num_connections = 0
+        super(PooledHTTPAdapter, self).__init__(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+            **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        pools = self.poolmanager.pools
+        dispose_func = pools.dispose_func
+
+        def dispose_pool(pool):
+            self._add_pool_stats(pool)
+            if dispose_func is not None:
+                dispose_func(pool)
+
+        pools.dispose_func = dispose_pool
+
+    def _add_pool_stats(self, pool):
+        with self._stats_lock:
+            self._num_requests += pool.num_requests
+            self._num_connections += pool.num_connections
+
+    def stats(self):
+        """Return the ``ConnectionStats`` of every pool so far."""
+        with self._stats_lock:
+            num_requests = self._num_requests
+            num_connections = self._num_connections
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                # Discarded since the keys were listed, it has been
+                # counted already.
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+        return ConnectionStats(num_requests, num_connections)
+
+
+# The content codings a body can be decoded from, as by urllib3.
+_DECODERS = {'gzip': GzipDecoder, 'x-gzip': GzipDecoder,
+             'deflate': DeflateDecoder}
+
+
+class HTTP2RawStream(object):
+    """
+    The ``raw`` body of a response from the ``HTTP2Adapter``, offering
+    the ``read``, ``readinto`` and ``stream`` of a urllib3 response.
+    Errors reading it are raised as the exceptions requests and urllib3
+    would raise, and close the response.
+
+    As with urllib3, the body is only decoded from its Content-Encoding
+    when ``decode_content`` is set, as ``iter_content`` and ``content``
+    do through ``stream``.  gzip and deflate are decoded, the codings
+    requests accepts by default, any other is left as it is.
+
+    The frames received are kept as they are until read, and only the
+    bytes returned are copied, so the cost of a read does not grow with
+    its size.
+    """
+    def __init__(self, response):
+        self._response = response
+        self._chunks = None
+        # The frames not read yet, the first of them from _offset.
+        self._frames = deque()
+        self._offset = 0
+        self._size = 0
+        self._decoder = None
+        self._decoder_flushed = False
+
+    def read(self, amt=None, decode_content=None):
+        if decode_content:
+            return self._read_decoded(amt)
+        views = self._read_views(amt)
+        if len(views) == 1 and len(views[0]) == len(views[0].obj):
+            # A whole frame, which needs no copy.
+            return views[0].obj
+        return b''.join(views)
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        """Yields the body in chunks of up to ``amt`` bytes read."""
+        while True:
+            data = self.read(amt, decode_content)
+            if not data:
+                break
+            yield data
+
+    def _read_decoded(self, amt):
+        # Reads until some data is decoded or the body ends, as a
+        # compressed read may decode to nothing.
+        if self._decoder is None:
+            self._decoder = _content_decoder(
+                self._response.headers.get('Content-Encoding', ''))
+        while True:
+            data = self.read(amt)
+            if self._decoder is False:
+                return data
+            try:
+                if data:
+                    data = self._decoder.decompress(data)
+                elif not self._decoder_flushed:
+                    self._decoder_flushed = True
+                    data = self._decoder.decompress(b'') + \
+                        self._decoder.flush()
+                else:
+                    return b''
+            except (IOError, zlib.error) as e:
+                self.close()
+                raise DecodeError("Received response with content-encoding "
+                                  "gzip or deflate that failed to decode",
+                                  e)
+            if data or self._decoder_flushed:
+                return data
+
+    def readinto(self, buffer):
+        amount = 0
+        for view in self._read_views(len(buffer)):
+            buffer[amount:amount + len(view)] = view
+            amount += len(view)
+        return amount
+
+    def _read_views(self, amt):
+        # Returns memoryviews of up to amt bytes of the frames in order.
+        try:
+            self._receive(amt)
+        except Exception:
+            # Otherwise the stream is left open until the response is
+            # garbage collected.
+            self.close()
+            raise
+        views = []
+        while self._frames and (amt is None or amt > 0):
+            view = memoryview(self._frames[0])[self._offset:]
+            if amt is not None and len(view) > amt:
+                view = view[:amt]
+                self._offset += amt
+            else:
+                self._frames.popleft()
+                self._offset = 0
+            views.append(view)
+            self._size -= len(view)
+            if amt is not None:
+                amt -= len(view)
+        return views
+
+    def _receive(self, amt):
+        if self._chunks is None:
+            self._chunks = self._response.iter_raw()
+        try:
+            while amt is None or self._size < amt:
+                try:
+                    chunk = next(self._chunks)
+                except StopIteration:
+                    break
+                self._frames.append(chunk)
+                self._size += len(chunk)
+        except httpx.TimeoutException as e:
+            raise requests.ReadTimeout(e)
+        except httpx.TransportError as e:
+            raise ProtocolError(str(e), e)
+
+    def close(self):
+        self._response.close()
+
+    def release_conn(self):
+        self.close()
+
+
+def _content_decoder(content_encoding):
+    # The decoder of ``content_encoding``, or False if it is not one that
+    # can be decoded, e.g. identity.
+    encodings = [encoding.strip().lower()
+                 for encoding in content_encoding.split(',')
+                 if encoding.strip()]
+    if not encodings or not all(encoding in _DECODERS
+                                for encoding in encodings):
+        return False
+    if len(encodings) == 1:
+        return _DECODERS[encodings[0]]()
+    return MultiDecoder(content_encoding)
+
+
+class HTTP2Adapter(BaseAdapter):
+    """
+    A transport adapter that makes requests with httpx over HTTP/2 where
+    the server supports it, multiplexing the concurrent requests to an
+    origin over a single connection instead of one connection each.
+    HTTP/2 is negotiated during the TLS handshake, so it is only mounted
+    for https urls.  httpx and h2 are optional dependencies, installed
+    with the ``http2`` extra.
+
+    httpcore picks the id of a new stream and encodes its headers with
+    the HPACK table of the connection without a lock, so threads opening
+    streams at once may send them out of order or garble their headers,
+    and the server closes the connection with a PROTOCOL_ERROR.  The
+    streams to an origin are opened one at a time instead, each holding
+    the lock of the origin until its headers are sent.
+
+    A server may also close a connection with a GOAWAY at any time, e.g.
+    after a number of requests, as nginx and hypercorn do by default.
+    httpcore sends the requests the server says it did not process again
+    on a new connection, but fails any other request in flight, as it
+    does those on a connection torn down before the GOAWAY is read.  A
+    GET or HEAD request that fails with its connection is sent again, up
+    to ``CONNECTION_RETRIES`` times, as the server may have dropped it.
+
+    The proxy that requests picks for a url, from the session or the
+    environment, is passed on to httpx, which tunnels the connection to
+    the origin through it.
+    """
+    SUPPORTED = httpx is not None
+    CONNECTION_RETRIES = 3
+
+    def __init__(self, max_connections):
+        super(HTTP2Adapter, self).__init__()
+        self.max_connections = max_connections
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._open_locks = {}
+        self._num_requests = 0
+        self._num_connections = 0
+
+    def _get_client(self, verify, cert, proxy):
+        key = (verify, cert, proxy)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                limits = httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections)
+                kwargs = {}
+                if proxy is not None:
+                    kwargs = _proxy_argument(proxy)
+                client = httpx.Client(http2=True, verify=verify, cert=cert,
+                                      limits=limits, follow_redirects=False,
+                                      **kwargs)
+                self._clients[key] = client
+        return client
+
+    def _get_open_lock(self, url):
+        origin = (url.scheme, url.host, url.port)
+        with self._lock:
+            lock = self._open_locks.get(origin)
+            if lock is None:
+                lock = self._open_locks[origin] = threading.Lock()
+        return lock
+
+    def _trace(self, event_name, info):
+        if event_name == 'connection.connect_tcp.complete':
+            with self._lock:
+                self._num_connections += 1
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        if isinstance(timeout, tuple):
+            connect_timeout, read_timeout = timeout
+        else:
+            connect_timeout = read_timeout = timeout
+        client = self._get_client(verify, cert,
+                                  select_proxy(request.url, proxies))
+        http2_request = client.build_request(
+            request.method, request.url, headers=dict(request.headers),
+            content=request.body,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+        retries = 0
+        if request.method in ('GET', 'HEAD'):
+            retries = self.CONNECTION_RETRIES
+        while True:
+            with self._lock:
+                self._num_requests += 1
+            try:
+                http2_response = self._send(client, http2_request)
+                return self._build_response(request, http2_response, stream)
+            except httpx.ConnectTimeout as e:
+                raise requests.ConnectTimeout(e, request=request)
+            except httpx.TimeoutException as e:
+                raise requests.ReadTimeout(e, request=request)
+            except (httpx.NetworkError, httpx.RemoteProtocolError,
+                    KeyError, requests.exceptions.ChunkedEncodingError) as e:
+                # httpcore raises a KeyError for a stream it already
+                # forgot when its connection closes under it, and the
+                # connection may be lost reading a body that is not
+                # streamed.
+                if not retries:
+                    if isinstance(e, requests.RequestException):
+                        raise
+                    raise requests.ConnectionError(e, request=request)
+                retries -= 1
+                LOGGER.debug("Sending %s %s again as its connection was "
+                             "lost: %r", request.method, request.url, e)
+            except httpx.TransportError as e:
+                raise requests.ConnectionError(e, request=request)
+
+    def _send(self, client, http2_request):
+        # Sends the request holding the lock of its origin until its
+        # headers are sent, or until it fails.
+        open_lock = self._get_open_lock(http2_request.url)
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                open_lock.release()
+
+        def trace(event_name, info):
+            self._trace(event_name, info)
+            if event_name.endswith(('.send_request_headers.complete',
+                                    '.send_request_headers.failed')):
+                release()
+
+        http2_request.extensions['trace'] = trace
+        open_lock.acquire()
+        try:
+            return client.send(http2_request, stream=True)
+        finally:
+            release()
+
+    def _build_response(self, request, http2_response, stream):
+        response = requests.Response()
+        response.status_code = http2_response.status_code
+        response.headers = CaseInsensitiveDict(http2_response.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.reason = http2_response.reason_phrase
+        response.raw = HTTP2RawStream(http2_response)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        if not stream:
+            response.content
+        return response
+
+    def close(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients = {}
+        for client in clients:
+            client.close()
+
+    def stats(self):
+        """Return the ``ConnectionStats`` of the requests so far."""
+        with self._lock:
+            return ConnectionStats(self._num_requests, self._num_connections)
+
+
+def _proxy_argument(proxy):
+    # httpx 0.26 takes the proxy as ``proxy``, and 0.28 no longer takes it
+    # as ``proxies``.
+    if 'proxy' in inspect.signature(httpx.Client).parameters:
+        return {'proxy': proxy}
+    return {'proxies': proxy}
+
+
+def mount_pooled_adapters(session, pool_maxsize, pool_connections,
+                          http2=False):
+    """
+    Mount ``PooledHTTPAdapter`` objects for http and https on ``session``
+    unless it already has ones with at least ``pool_maxsize`` connections
+    per host, so every thread using the session can keep its connection
+    alive instead of making a new one (and a new TLS handshake) per
+    request.  With ``http2`` an ``HTTP2Adapter`` is mounted for https
+    instead.  Returns the adapters.
+
+    Only requests' own ``HTTPAdapter``, as mounted by ``Session``, is
+    replaced, and its ``max_retries`` and ``pool_block`` are kept by the
+    pooled adapter.  Any other adapter was mounted by the caller for a
+    reason, e.g. to configure TLS, so it is left as it is, without its
+    connections counted.  The ``HTTP2Adapter`` does not retry, so an
+    ``HTTPAdapter`` that does is pooled for https instead.
+    """
+    adapters = []
+    for prefix in ('https://', 'http://'):
+        adapter = session.adapters.get(prefix)
+        if not _is_replaceable(adapter):
+            LOGGER.debug("Keeping the %s of the session for %s.",
+                         type(adapter).__name__, prefix)
+            adapters.append(adapter)
+            continue
+        if isinstance(adapter, HTTP2Adapter):
+            if http2 and prefix == 'https://':
+                adapters.append(adapter)
+                continue
+            # Mounted for another handler, it has nothing to keep.
+            adapter = None
+        if http2 and prefix == 'https://':
+            if adapter is None or not adapter.max_retries.total:
+                LOGGER.debug("Mounting an HTTP/2 adapter for %s with up to "
+                             "%s connections.", prefix, pool_maxsize)
+                adapter = HTTP2Adapter(max_connections=pool_maxsize)
+                session.mount(prefix, adapter)
+                adapters.append(adapter)
+                continue
+            LOGGER.warning("Not using HTTP/2 for %s as the adapter of the "
+                           "session retries requests.", prefix)
+        if not isinstance(adapter, PooledHTTPAdapter) or \
+                adapter._pool_maxsize < pool_maxsize:
+            LOGGER.debug("Mounting an adapter for %s with %s connections "
+                         "for each of %s hosts.", prefix, pool_maxsize,
+                         pool_connections)
+            kwargs = {}
+            if adapter is not None:
+                kwargs = {'max_retries': adapter.max_retries,
+                          'pool_block': adapter._pool_block}
+            adapter = PooledHTTPAdapter(pool_connections=pool_connections,
+                                        pool_maxsize=pool_maxsize, **kwargs)
+            session.mount(prefix, adapter)
+        adapters.append(adapter)
+    return adapters
+
+
+def _is_replaceable(adapter):
+    # Whether ``adapter`` is requests' default or one mounted by wgot, as
+    # opposed to one the caller mounted.
+    return adapter is None or \
+        type(adapter) in (HTTPAdapter, PooledHTTPAdapter, HTTP2Adapter)
+
+
+def connection_stats(adapters):
+    """
+    Return the ``ConnectionStats`` summed over ``adapters``, of those
+    that count them.
+    """
+    num_requests = 0
+    num_connections = 0
+    for adapter in adapters:
+        if not hasattr(adapter, 'stats'):
+            continue
+        stats = adapter.stats()
+        num_requests += stats.num_requests
+        num_connections += stats.num_connections
+    return ConnectionStats(num_requests, num_connections)
@@ -14,8 +14,11 @@ from datetime import datetime
 import mimetypes
 import hashlib
 import math
+import mmap
 import os
 import sys
+import threading
+import time
 from collections import namedtuple, deque
 from functools import partial
 
@@ -27,6 +30,21 @@ from .compat import PY3
 from .compat import queue
 
 
+# The extended attribute holding the ETag of a downloaded file.
+ETAG_XATTR = 'user.wgot.etag'
+
+SIZE_SUFFIX = {
+    'kb': 1024,
+    'mb': 1024 ** 2,
+    'gb': 1024 ** 3,
+    'tb': 1024 ** 4,
+    'kib': 1024,
+    'mib': 1024 ** 2,
+    'gib': 1024 ** 3,
+    'tib': 1024 ** 4,
+}
+
+
 class MD5Error(Exception):
     """
     Exception for md5's that do not match.
@@ -34,6 +52,14 @@ class MD5Error(Exception):
     pass
 
 
+class StreamMD5Error(Exception):
+    """
+    Exception for md5's that do not match after the data has already been
+    written to a stream, so the download cannot be retried.
+    """
+    pass
+
+
 class StablePriorityQueue(queue.Queue):
     """Priority queue that maintains FIFO order for same priority items.
 
@@ -77,6 +103,146 @@ class StablePriorityQueue(queue.Queue):
                 continue
             return bucket.popleft()
 
+    def release(self, item):
+        """Called by the consumer of ``item`` once it is done with it."""
+        pass
+
+    def acquire_host(self, host):
+        """
+        Called before a request to ``host`` made outside of the queue, so
+        it can count towards a limit of requests in flight to each host.
+        """
+        pass
+
+    def release_host(self, host):
+        """Called once the request of ``acquire_host`` is done."""
+        pass
+
+
+class HostFairQueue(StablePriorityQueue):
+    """Priority queue that takes turns between the hosts of its items.
+
+    Items with the same priority are grouped by their ``host`` attribute
+    and retrieved round-robin across hosts, FIFO within a host, so a long
+    run of items for one host doesn't hold up the items for the others.
+    If ``max_per_host`` is set, no more than that many items of one host
+    are handed out until the consumers ``release`` them; ``get()`` blocks
+    while every queued item of the most important priority belongs to a
+    host at its limit.  Less important items are not retrieved in the
+    meantime, so shutdown requests still come after the queued tasks.
+    Items without a ``host`` are never limited.  Requests made outside
+    the queue count towards the limit of their host with
+    ``acquire_host`` and ``release_host``.
+
+    """
+    def __init__(self, maxsize=0, max_priority=20, max_per_host=None):
+        StablePriorityQueue.__init__(self, maxsize=maxsize,
+                                     max_priority=max_priority)
+        self.max_per_host = max_per_host
+        # For each priority, the items of each host and the order in which
+        # the hosts take turns.
+        self.priorities = [{} for i in range(max_priority + 1)]
+        self.turns = [deque([]) for i in range(max_priority + 1)]
+        self.in_flight = {}
+        # Callers of acquire_host wait on a condition of their own, so
+        # they never take the wakeups meant for the consumers.
+        self.host_released = threading.Condition(self.mutex)
+        self._size = 0
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not block:
+                if self._select() is None:
+                    raise queue.Empty
+            elif timeout is None:
+                while self._select() is None:
+                    self.not_empty.wait()
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            else:
+                endtime = time.time() + timeout
+                while self._select() is None:
+                    remaining = endtime - time.time()
+                    if remaining <= 0.0:
+                        raise queue.Empty
+                    self.not_empty.wait(remaining)
+            item = self._get()
+            self.not_full.notify()
+            if self._select() is not None:
+                # Taking the item may have made others available, such as
+                # the less important items queued behind it, and the other
+                # consumers would not have been woken for them.
+                self.not_empty.notify()
+            return item
+
+    def release(self, item):
+        self.release_host(getattr(item, 'host', None))
+
+    def acquire_host(self, host):
+        if host is None or self.max_per_host is None:
+            return
+        with self.host_released:
+            while not self._has_capacity(host):
+                self.host_released.wait()
+            self.in_flight[host] = self.in_flight.get(host, 0) + 1
+
+    def release_host(self, host):
+        if host is None or self.max_per_host is None:
+            return
+        with self.not_empty:
+            self.in_flight[host] -= 1
+            if not self.in_flight[host]:
+                del self.in_flight[host]
+            self.not_empty.notify()
+            self.host_released.notify_all()
+
+    def _qsize(self):
+        return self._size
+
+    def _put(self, item):
+        priority = min(getattr(item, 'PRIORITY', self.default_priority),
+                       self.default_priority)
+        host = getattr(item, 'host', None)
+        hosts = self.priorities[priority]
+        if host not in hosts:
+            hosts[host] = deque([])
+            self.turns[priority].append(host)
+        hosts[host].append(item)
+        self._size += 1
+
+    def _select(self):
+        # Returns the priority whose next host in turn may be handed an
+        # item, having rotated that host to the front of its turns.
+        for priority, turns in enumerate(self.turns):
+            if not turns:
+                continue
+            for i in range(len(turns)):
+                if self._has_capacity(turns[0]):
+                    return priority
+                turns.rotate(-1)
+            return None
+        return None
+
+    def _has_capacity(self, host):
+        if host is None or self.max_per_host is None:
+            return True
+        return self.in_flight.get(host, 0) < self.max_per_host
+
+    def _get(self):
+        priority = self._select()
+        turns = self.turns[priority]
+        host = turns.popleft()
+        items = self.priorities[priority][host]
+        item = items.popleft()
+        if items:
+            turns.append(host)
+        else:
+            del self.priorities[priority][host]
+        if host is not None and self.max_per_host is not None:
+            self.in_flight[host] = self.in_flight.get(host, 0) + 1
+        self._size -= 1
+        return item
+
 
 def get_file_stat(path):
     """
@@ -85,13 +251,45 @@ def get_file_stat(path):
     """
     try:
         stats = os.stat(path)
-        update_time = datetime.fromtimestamp(stats.st_mtime, tzlocal())
-    except (ValueError, IOError) as e:
+        update_time = datetime.fromtimestamp(stats.st_mtime)
+    except (ValueError, OSError) as e:
         raise ValueError('Could not retrieve file stat of "%s": %s' % (
             path, e))
     return stats.st_size, update_time
 
 
+def get_local_etag(path):
+    """
+    Return the ETag recorded for the local file ``path`` by
+    ``set_local_etag``, or None if there isn't one or extended attributes
+    aren't supported.
+    """
+    if not hasattr(os, 'getxattr'):
+        return None
+    try:
+        return os.getxattr(path, ETAG_XATTR).decode('ascii')
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def set_local_etag(path, etag):
+    """
+    Record the ETag of the download that wrote the local file ``path`` in
+    an extended attribute, or remove it if ``etag`` is None.  This is
+    best effort, not every filesystem supports extended attributes.
+    """
+    if not hasattr(os, 'setxattr'):
+        return
+    try:
+        if etag is None:
+            os.removexattr(path, ETAG_XATTR)
+        else:
+            os.setxattr(path, ETAG_XATTR, etag.encode('ascii'))
+    except (OSError, UnicodeEncodeError):
+        # Removing an attribute that isn't there fails too.
+        pass
+
+
 def check_etag(etag, fileobj):
     """
     This fucntion checks the etag and the md5 checksum to ensure no
@@ -147,6 +345,63 @@ def find_chunksize(size, current_chunksize):
         return chunksize
 
 
+def validate_transfer_config(multi_threshold, chunksize, num_threads,
+                             max_queue_size, max_io_queue_size,
+                             num_probe_threads, max_per_host=None):
+    """
+    Raises a ``ValueError`` if the transfer settings can't work together.
+    The ``chunksize`` may still be raised by ``find_chunksize`` for files
+    that would otherwise have more than ``MAX_PARTS`` parts.
+    """
+    counts = [('num_threads', num_threads), ('max_queue_size', max_queue_size),
+              ('max_io_queue_size', max_io_queue_size),
+              ('num_probe_threads', num_probe_threads)]
+    for name, value in counts:
+        if value < 1:
+            raise ValueError("%s must be at least 1, not %s" % (name, value))
+    if max_per_host is not None and max_per_host < 1:
+        raise ValueError("max_per_host must be at least 1, not %s" %
+                         max_per_host)
+    if chunksize < 1:
+        raise ValueError("chunksize must be at least 1 byte, not %s" %
+                         chunksize)
+    if chunksize > MAX_SINGLE_UPLOAD_SIZE:
+        raise ValueError("chunksize must be at most %s bytes, not %s" %
+                         (MAX_SINGLE_UPLOAD_SIZE, chunksize))
+    if multi_threshold < chunksize:
+        # Otherwise a file just over the threshold would have no parts.
+        raise ValueError("multi_threshold (%s bytes) must be at least the "
+                         "chunksize (%s bytes)" % (multi_threshold, chunksize))
+
+
+def human_readable_to_bytes(value):
+    """Converts a human readable size to bytes.
+
+    :param value: A string such as "10MB".  If a suffix is not included,
+        then the value is assumed to be an integer representing the size
+        in bytes.
+    :returns: The converted value in bytes as an integer
+    """
+    value = value.lower()
+    if value[-1:] in ('k', 'm', 'g', 't'):
+        # Allow the wget style suffixes, e.g. 20k.
+        value += 'b'
+    if value[-2:] == 'ib':
+        # Assume IEC suffix.
+        suffix = value[-3:]
+    else:
+        suffix = value[-2:]
+    has_size_identifier = (len(value) >= 2 and suffix in SIZE_SUFFIX)
+    if not has_size_identifier:
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError("Invalid size value: %s" % value)
+    else:
+        multiplier = SIZE_SUFFIX[suffix]
+        return int(value[:-len(suffix)]) * multiplier
+
+
 class MultiCounter(object):
     """
     This class is used as a way to keep track of how many multipart
@@ -190,7 +445,7 @@ def bytes_print(statement):
         else:
             # If it is not possible to write to the standard out buffer.
             # The next best option is to decode and write to standard out.
-            sys.stdout.write(statement.decode('utf-8'))
+            sys.stdout.write(bytes(statement).decode('utf-8'))
     else:
         sys.stdout.write(statement)
 
@@ -237,11 +492,453 @@ class PrintTask(namedtuple('PrintTask',
                                              warning)
 
 
+# Used to pass a ``FileInfo`` whose metadata has been resolved (or failed
+# to be resolved, in which case ``error`` is set) back to the handler.
+ProbeResult = namedtuple('ProbeResult', ['filename', 'error'])
 IORequest = namedtuple('IORequest',
                        ['filename', 'offset', 'data', 'is_stream'])
 # Used to signal that IO for the filename is finished, and that
-# any associated resources may be cleaned up.
-IOCloseRequest = namedtuple('IOCloseRequest', ['filename'])
+# any associated resources may be cleaned up.  If ``fsync`` is set the
+# file is flushed to disk before it is closed.
+IOCloseRequest = namedtuple('IOCloseRequest', ['filename', 'fsync'])
+# Used to run a callback once the writes to the filename queued before it
+# have been made and flushed, e.g. to record a part in a journal.
+IOCallbackRequest = namedtuple('IOCallbackRequest', ['filename', 'callback'])
+# Used to run a callback once the results queued before it have been
+# printed.
+PrintCallbackRequest = namedtuple('PrintCallbackRequest', ['callback'])
+
+
+class PositionalWriter(object):
+    """Writes data at given offsets of a file from any number of threads.
+
+    All of the threads share a single file descriptor and use
+    ``os.pwrite``, which leaves the file position alone, so writes need no
+    seek and are made outside of any lock.  The lock is only taken around
+    a write to count the writes in progress: closing the file while other
+    threads are writing to it is deferred until the last of those writes
+    returns, so the descriptor is never reused under them.  Nothing is
+    buffered in user space, the data is handed to the OS as soon as
+    ``write`` is called.
+    """
+    SUPPORTED = hasattr(os, 'pwrite')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = None
+        self._lock = threading.Lock()
+        self._num_writing = 0
+        self._close_pending = False
+
+    def open(self, truncate=True):
+        flags = os.O_WRONLY | os.O_CREAT
+        if truncate:
+            flags |= os.O_TRUNC
+        self._fd = os.open(self.filename, flags, 0o666)
+
+    def write(self, data, offset):
+        with self._lock:
+            if self._fd is None or self._close_pending:
+                raise IOError("%s has been closed." % self.filename)
+            self._num_writing += 1
+        try:
+            view = memoryview(data)
+            while len(view):
+                written = os.pwrite(self._fd, view, offset)
+                view = view[written:]
+                offset += written
+        finally:
+            with self._lock:
+                self._num_writing -= 1
+                if self._close_pending and not self._num_writing:
+                    self._close()
+
+    def close(self, fsync=False):
+        with self._lock:
+            if self._num_writing:
+                self._close_pending = True
+                return
+            if fsync and self._fd is not None:
+                os.fsync(self._fd)
+            self._close()
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._close_pending = False
+
+
+class BufferPool(object):
+    """A pool of reusable ``bytearray`` buffers of ``buffer_size`` bytes.
+
+    Response bodies are read into buffers acquired from the pool rather
+    than into a new ``bytes`` object per chunk.  Whoever writes out the
+    data releases the buffer, so it can be filled again.  The pool only
+    allocates a buffer when none are free, so it grows to the number of
+    chunks in flight at the busiest point and no further.
+    """
+    # Releasing a memoryview back to the pool relies on ``memoryview.obj``.
+    SUPPORTED = PY3
+
+    def __init__(self, buffer_size):
+        self.buffer_size = buffer_size
+        self._free = deque()
+
+    def acquire(self):
+        try:
+            return self._free.pop()
+        except IndexError:
+            return bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        """Return a buffer, or a memoryview of one, to the pool."""
+        if isinstance(buffer, memoryview):
+            buffer = buffer.obj
+        self._free.append(buffer)
+
+
+class MappedFileWriter(object):
+    """Memory maps a file preallocated to its final size.
+
+    Parts are read straight from the response into a ``window`` of the
+    mapping, so no intermediate ``bytes`` objects or writes are needed.
+    The pages are written back by the OS, or when the file is closed
+    with ``fsync``.  A mapping can't be closed while views of it exist,
+    so closing the file while other threads hold windows is deferred
+    until the last of them is released.
+    """
+    # Slicing a memoryview of a mmap requires the new buffer protocol.
+    SUPPORTED = PY3
+
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = size
+        self._fd = None
+        self._map = None
+        self._lock = threading.Lock()
+        self._num_windows = 0
+        self._close_pending = False
+
+    def open(self, truncate=True):
+        flags = os.O_RDWR | os.O_CREAT
+        if truncate:
+            flags |= os.O_TRUNC
+        self._fd = os.open(self.filename, flags, 0o666)
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self._fd, 0, self.size)
+        else:
+            os.ftruncate(self._fd, self.size)
+        self._map = mmap.mmap(self._fd, self.size)
+
+    def window(self, offset, length):
+        """Return a writable memoryview of ``length`` bytes at ``offset``.
+
+        The view must be given back with ``release_window``, after any
+        views taken of it have been released.
+        """
+        with self._lock:
+            if self._map is None or self._close_pending:
+                raise IOError("%s has been closed." % self.filename)
+            self._num_windows += 1
+            with memoryview(self._map) as view:
+                return view[offset:offset + length]
+
+    def release_window(self, window):
+        with self._lock:
+            window.release()
+            self._num_windows -= 1
+            if self._close_pending and not self._num_windows:
+                self._close()
+
+    def write(self, data, offset):
+        self._map[offset:offset + len(data)] = data
+
+    def close(self, fsync=False):
+        with self._lock:
+            if self._num_windows:
+                self._close_pending = True
+                return
+            if fsync and self._map is not None:
+                self._map.flush()
+            if fsync and self._fd is not None:
+                os.fsync(self._fd)
+            self._close()
+
+    def _close(self):
+        try:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+        finally:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._close_pending = False
+
+
+class IncrementalMD5(object):
+    """Computes the md5 of a multipart download as its parts are written.
+
+    Parts may be written in any order but must be hashed in order.  The
+    thread that writes a part only records it, the parts are read back
+    and hashed by a hasher thread of the download's own, so neither the
+    IO thread nor the workers wait on the md5.  The hasher thread is
+    started once the part extending the run of written parts from the
+    start of the file is written, and hashes the parts after it that
+    were already written too.  It ends when it finds the next part not
+    written yet, whose writer starts another.  Parts are read back just
+    after being written, so they come from the page cache rather than
+    the disk.
+    """
+    READ_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, filename, size, chunksize, num_parts,
+                 written_parts=()):
+        self.filename = filename
+        self.size = size
+        self.chunksize = chunksize
+        self.num_parts = num_parts
+        self._md5 = hashlib.md5()
+        self._written_parts = set(written_parts)
+        self._next_part = 0
+        self._hasher = None
+        self._error = None
+        self._condition = threading.Condition(threading.Lock())
+
+    def part_written(self, part_number):
+        with self._condition:
+            self._written_parts.add(part_number)
+            self._start_hasher()
+
+    def hexdigest(self):
+        """Block until every part has been hashed and return the md5."""
+        with self._condition:
+            # Parts written by a previous, resumed run may not have been
+            # hashed by anyone yet.
+            self._start_hasher()
+            while self._next_part < self.num_parts and self._error is None:
+                self._condition.wait(timeout=1)
+            if self._error is not None:
+                raise self._error
+        return self._md5.hexdigest()
+
+    def _start_hasher(self):
+        # Called with the condition held.
+        if self._hasher is not None or self._error is not None or \
+                self._next_part not in self._written_parts:
+            return
+        self._hasher = threading.Thread(target=self._hash_written_parts)
+        self._hasher.daemon = True
+        self._hasher.start()
+
+    def _hash_written_parts(self):
+        try:
+            with open(self.filename, 'rb') as fileobj:
+                while True:
+                    with self._condition:
+                        if self._next_part not in self._written_parts:
+                            self._hasher = None
+                            return
+                        part_number = self._next_part
+                    self._hash_part(fileobj, part_number)
+                    with self._condition:
+                        self._written_parts.discard(part_number)
+                        self._next_part += 1
+                        self._condition.notifyAll()
+        except Exception as e:
+            with self._condition:
+                self._error = e
+                self._hasher = None
+                self._condition.notifyAll()
+
+    def _hash_part(self, fileobj, part_number):
+        start = part_number * self.chunksize
+        if part_number == self.num_parts - 1:
+            remaining = self.size - start
+        else:
+            remaining = self.chunksize
+        fileobj.seek(start)
+        while remaining:
+            chunk = fileobj.read(min(remaining, self.READ_CHUNK_SIZE))
+            if not chunk:
+                raise IncompleteReadError(actual_bytes=fileobj.tell(),
+                                          expected_bytes=self.size)
+            self._md5.update(chunk)
+            remaining -= len(chunk)
+
+
+class DownloadJournal(object):
+    """Sidecar file recording the completed parts of a multipart download.
+
+    The first line identifies the download (size, part size, last
+    modified time and source) so that a journal left behind by a
+    different version of the file is ignored.  Every following line is
+    the number of a part that has been completely written to the file.
+    """
+    SUFFIX = '.wgot-journal'
+
+    def __init__(self, filename, src, size, chunksize, last_update=None):
+        self.target = filename
+        self.filename = filename + self.SUFFIX
+        self._header = '%s %s %s %s\n' % (size, chunksize, last_update, src)
+        self._fileobj = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Return the set of part numbers recorded as completed."""
+        completed_parts = set()
+        try:
+            with open(self.filename) as fileobj:
+                if fileobj.readline() != self._header:
+                    return completed_parts
+                for line in fileobj:
+                    # A line without a newline was cut short by a crash.
+                    if line.endswith('\n'):
+                        completed_parts.add(int(line))
+        except (IOError, OSError, ValueError):
+            pass
+        return completed_parts
+
+    def start(self, completed_parts):
+        """Rewrite the journal with only the given completed parts."""
+        with open(self.filename, 'w') as fileobj:
+            fileobj.write(self._header)
+            for part_number in sorted(completed_parts):
+                fileobj.write('%d\n' % part_number)
+
+    def record(self, part_number):
+        with self._lock:
+            if self._fileobj is None:
+                self._fileobj = open(self.filename, 'a')
+            self._fileobj.write('%d\n' % part_number)
+            self._fileobj.flush()
+
+    def close(self):
+        with self._lock:
+            if self._fileobj is not None:
+                self._fileobj.close()
+                self._fileobj = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+class TokenBucket(object):
+    """Limits the rate at which bytes are read by any number of threads.
+
+    Tokens accrue at ``rate`` per second up to ``capacity``.  A read takes
+    as many tokens as it read bytes, going into debt if there aren't
+    enough, and the thread sleeps until the debt has been paid off.  The
+    threads sharing the bucket therefore read no more than ``rate`` bytes
+    per second between them, after an initial burst of ``capacity``.
+
+    Each thread waits for the debt of every thread, so reads should be
+    no larger than ``read_size``, ``READ_SECONDS`` of the rate.  Then the
+    sleeps stay short and the connections don't sit idle for long.
+    Callers that can't sleep, such as coroutines, take the tokens with
+    ``reserve`` and wait the seconds it returns themselves.
+    """
+    READ_SECONDS = 0.1
+    MIN_READ_SIZE = 1024
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("rate must be more than 0 bytes per second, "
+                             "not %s" % rate)
+        self.rate = float(rate)
+        if capacity is None:
+            capacity = rate
+        self.capacity = capacity
+        self.read_size = max(self.MIN_READ_SIZE,
+                             int(self.rate * self.READ_SECONDS))
+        self._tokens = capacity
+        self._last_refill = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+    def reserve(self, amount):
+        """Take ``amount`` tokens, returning the seconds to wait for them."""
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            self._tokens -= amount
+            debt = -self._tokens
+        return max(debt, 0) / self.rate
+
+
+class RateLimiter(object):
+    """Holds the ``TokenBucket`` objects limiting the download rate.
+
+    ``rate`` limits the rate of all downloads together and
+    ``host_rates`` maps hosts to a limit for the downloads from each of
+    them.  A download from a host with its own limit is held to both.
+    """
+    def __init__(self, rate=None, host_rates=None):
+        self._bucket = None
+        if rate is not None:
+            self._bucket = TokenBucket(rate)
+        self._host_buckets = {}
+        for host, host_rate in (host_rates or {}).items():
+            self._host_buckets[host.lower()] = TokenBucket(host_rate)
+
+    def throttle_for(self, host):
+        """
+        Return the function a ``StreamingBody`` of a download from ``host``
+        calls with the size of each read, or None if it isn't limited.
+        """
+        host_bucket = self._host_buckets.get(host)
+        if host_bucket is None:
+            if self._bucket is None:
+                return None
+            return self._bucket.consume
+        if self._bucket is None:
+            return host_bucket.consume
+        return partial(_consume_all, (self._bucket, host_bucket))
+
+    def delay_for(self, host):
+        """
+        Return the function that takes the size of each read of a download
+        from ``host`` and returns the seconds to wait before the next, or
+        None if it isn't limited.
+        """
+        buckets = self._buckets_for(host)
+        if not buckets:
+            return None
+        return partial(_reserve_all, buckets)
+
+    def read_size_for(self, host):
+        """
+        Return the most a download from ``host`` should read at a time, or
+        None if it isn't limited.
+        """
+        buckets = self._buckets_for(host)
+        if not buckets:
+            return None
+        return min(bucket.read_size for bucket in buckets)
+
+    def _buckets_for(self, host):
+        return [bucket for bucket in
+                (self._bucket, self._host_buckets.get(host))
+                if bucket is not None]
+
+
+def _consume_all(buckets, amount):
+    for bucket in buckets:
+        bucket.consume(amount)
+
+
+def _reserve_all(buckets, amount):
+    return max(bucket.reserve(amount) for bucket in buckets)
 
 
 class IncompleteReadError(Exception):
@@ -266,14 +963,19 @@ class StreamingBody(object):
           is raised.
 
     """
-    def __init__(self, response):
+    def __init__(self, response, throttle=None):
         self._raw_stream = response.raw
         self._content_length = response.headers.get('content-length')
         self._amount_read = 0
+        # Called with the number of bytes of each read, see RateLimiter.
+        self._throttle = throttle
+        self._readinto = _direct_readinto(self._raw_stream)
 
     def read(self, amt=None):
         chunk = self._raw_stream.read(amt)
         self._amount_read += len(chunk)
+        if self._throttle is not None:
+            self._throttle(len(chunk))
         if not chunk or amt is None:
             # If the server sends empty contents or
             # we ask to read all of the contents, then we know
@@ -281,6 +983,36 @@ class StreamingBody(object):
             self._verify_content_length()
         return chunk
 
+    def readinto(self, buffer):
+        amount = self._readinto(buffer)
+        self._amount_read += amount
+        if self._throttle is not None:
+            self._throttle(amount)
+        if not amount:
+            self._verify_content_length()
+        return amount
+
+    def read_pooled(self, pool, amt=None):
+        """Read up to ``amt`` bytes into a buffer acquired from ``pool``.
+
+        Returns a memoryview of the bytes read, which must be given back
+        with ``pool.release`` once it has been written, or None once the
+        body has been read.
+        """
+        buffer = pool.acquire()
+        view = memoryview(buffer)
+        if amt is not None:
+            view = view[:amt]
+        try:
+            amount = self.readinto(view)
+        except Exception:
+            pool.release(buffer)
+            raise
+        if not amount:
+            pool.release(buffer)
+            return None
+        return view[:amount]
+
     def _verify_content_length(self):
         if self._content_length is not None and \
                 self._amount_read != int(self._content_length):
@@ -289,6 +1021,32 @@ class StreamingBody(object):
                 expected_bytes=int(self._content_length))
 
 
+def _direct_readinto(raw):
+    """
+    Returns the function reading the urllib3 response ``raw`` into a
+    buffer.  urllib3's own ``readinto`` reads a new ``bytes`` object and
+    copies it into the buffer, so where the body is neither chunked nor
+    decoded the ``http.client`` response under it is read from instead,
+    with urllib3 still translating the errors and counting the bytes.
+    """
+    fp = getattr(raw, '_fp', None)
+    error_catcher = getattr(raw, '_error_catcher', None)
+    if not hasattr(fp, 'readinto') or error_catcher is None or \
+            not hasattr(raw, '_fp_bytes_read') or \
+            getattr(raw, 'chunked', True) or \
+            (raw.decode_content and raw.headers.get('content-encoding')):
+        return raw.readinto
+
+    def readinto(buffer):
+        with error_catcher():
+            amount = fp.readinto(buffer)
+        raw._fp_bytes_read += amount
+        if raw.length_remaining is not None:
+            raw.length_remaining -= amount
+        return amount
+    return readinto
+
+
 def _validate_content_length(expected_content_length, body_length):
     # See: https://github.com/kennethreitz/requests/issues/1855
     # Basically, our http library doesn't do this for us, so we have